@@ -0,0 +1,262 @@
+"""Benchmarks for keygen, keying and encrypted inference, recorded to JSON and compared against a saved baseline.
+
+   python -m keynet.benchmark --outfile results.json                         # run all benchmarks
+   python -m keynet.benchmark --only lenet --baseline results.json           # compare, exit code 1 on regression
+   python -m keynet.benchmark --precision                                    # accuracy of reduced precision keyed weights
+"""
+import os
+import sys
+import time
+import json
+import copy
+import platform
+import argparse
+import numpy as np
+import scipy
+import scipy.sparse
+import torch
+import torchvision
+from torchvision import transforms
+from torch import nn
+import numba
+import keynet.sparse
+import keynet.layer
+import keynet.system
+import keynet.mnist
+import keynet.cifar10
+import keynet.vgg
+import keynet.version
+import keynet.globals
+from keynet.sparse import sparse_toeplitz_conv2d, sparse_toeplitz_avgpool2d
+from vipy.util import tempdir
+
+
+def _keygen(shape, **kwargs):
+    keys = dict(global_geometric='identity', local_geometric='identity', global_photometric='identity', local_photometric='identity')
+    keys.update(kwargs)
+    return lambda: ({'nnz':keynet.system.keygen(shape, **keys)[0].nnz()})
+
+
+def _toeplitz_conv2d(shape, outchannels):
+    w = np.random.randn(outchannels, shape[0], 3, 3).astype(np.float32)
+    b = np.random.randn(outchannels).astype(np.float32)
+    return lambda: {'nnz':sparse_toeplitz_conv2d(shape, w, bias=b).nnz}
+
+
+def _keyedlayer_conv2d(shape, outchannels, tileshape=None):
+    conv = nn.Conv2d(shape[0], outchannels, 3, padding=1)
+    (A, Ainv) = keynet.system.keygen(shape, 'identity', 'permutation', 'identity', 'uniform_random_affine', blocksize=8, beta=1.0, gamma=1.0)  # input
+    (B, Binv) = keynet.system.keygen((outchannels, *shape[1:]), 'identity', 'permutation', 'identity', 'uniform_random_affine', blocksize=8, beta=1.0, gamma=1.0)  # output
+    return lambda: {'nnz':keynet.layer.KeyedLayer(conv, shape, (outchannels, *shape[1:]), B, Ainv, tileshape=tileshape).nnz()}
+
+
+def _tiled_build(shape, tileshape, conv2d=False):
+    if conv2d:
+        W = sparse_toeplitz_conv2d(shape, np.random.randn(shape[0], shape[0], 3, 3).astype(np.float32), bias=np.random.randn(shape[0]).astype(np.float32))
+        return lambda: {'nnz':keynet.sparse.Conv2dTiledMatrix(W, shape, shape, tileshape, bias=True, sanitycheck=False).nnz()}
+    W = sparse_toeplitz_avgpool2d(shape, (shape[0], shape[0], 3, 3), 2)
+    return lambda: {'nnz':keynet.sparse.TiledMatrix(W, tileshape).nnz()}
+
+
+def _tiled_forward(shape, tileshape, batchsize, conv2d=False):
+    if conv2d:
+        W = sparse_toeplitz_conv2d(shape, np.random.randn(shape[0], shape[0], 3, 3).astype(np.float32), bias=np.random.randn(shape[0]).astype(np.float32))
+        T = keynet.sparse.Conv2dTiledMatrix(W, shape, shape, tileshape, bias=True, sanitycheck=False)
+    else:
+        T = keynet.sparse.TiledMatrix(sparse_toeplitz_avgpool2d(shape, (shape[0], shape[0], 3, 3), 2), tileshape)
+    x = torch.rand(T.shape[1], batchsize)
+    return lambda: {'images':batchsize, 'nnz':T.nnz(), 'shape':tuple(T.torchdot(x).shape)}
+
+
+def _net(name):
+    if name == 'lenet':
+        return (keynet.mnist.LeNet_AvgPool(), (1,28,28), 7)
+    elif name == 'allconvnet':
+        return (keynet.cifar10.AllConvNet(batchnorm=False), (3,32,32), 8)
+    elif name == 'vgg16':
+        return (keynet.vgg.VGG16(num_classes=10, width=8, features=256, imsize=64), (3,64,64), 8)  # reduced
+    raise ValueError('Unknown net "%s"' % name)
+
+
+def _keynet(name, tiled=False):
+    (net, inshape, blocksize) = _net(name)
+    return (net, inshape, lambda: keynet.system.Keynet(inshape, net, local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=blocksize, beta=1.0, gamma=1.0,
+                                                        tileshape=(blocksize, blocksize) if tiled else None))
+
+
+def _keynet_build(name, tiled=False):
+    (net, inshape, f) = _keynet(name, tiled)
+    return lambda: {'nnz':f()[1].num_parameters()}
+
+
+def _keynet_forward(name, batchsize, tiled=False, frozen=False):
+    (net, inshape, f) = _keynet(name, tiled)
+    (sensor, knet) = f()
+    knet = knet.freeze() if frozen else knet
+    x_cipher = sensor.encrypt_batch(torch.rand(batchsize, *inshape))
+    return lambda: {'images':batchsize, 'nnz':knet.num_parameters(), 'shape':tuple(knet.forward(x_cipher).shape)}
+
+
+def benchmarks():
+    """Return {name:setup}, where setup() prepares inputs and returns a function that runs the benchmarked work once and returns a dictionary of statistics"""
+    d = {}
+    for (k, kw) in [('identity', {}),
+                    ('global_permutation', dict(global_geometric='permutation')),
+                    ('hierarchical_permutation', dict(global_geometric='hierarchical_permutation', hierarchical_blockshape=(2,2), hierarchical_permute_at_level=(0,1), blocksize=8)),
+                    ('hierarchical_rotation', dict(global_geometric='hierarchical_rotation', hierarchical_blockshape=(2,2), hierarchical_permute_at_level=(0,), blocksize=8)),
+                    ('local_permutation', dict(local_geometric='permutation', blocksize=8)),
+                    ('local_doubly_stochastic', dict(local_geometric='doubly_stochastic', alpha=2.0, blocksize=8)),
+                    ('local_givens_orthogonal', dict(local_geometric='givens_orthogonal', alpha=2.0, blocksize=8)),
+                    ('uniform_random_affine', dict(global_photometric='uniform_random_affine', beta=1.0, gamma=1.0)),
+                    ('local_uniform_random_affine', dict(local_photometric='uniform_random_affine', beta=1.0, gamma=1.0, blocksize=8))]:
+        d['keygen_%s' % k] = (lambda kw: lambda: _keygen((16,64,64), **kw))(kw)
+    d['toeplitz_conv2d'] = lambda: _toeplitz_conv2d((32,64,64), 32)
+    d['keyedlayer_conv2d'] = lambda: _keyedlayer_conv2d((32,64,64), 32)
+    d['keyedlayer_conv2d_tiled'] = lambda: _keyedlayer_conv2d((32,64,64), 32, tileshape=(8,8))
+    d['tiledmatrix_build'] = lambda: _tiled_build((16,64,64), (8,8))
+    d['tiledmatrix_forward'] = lambda: _tiled_forward((16,64,64), (8,8), 16)
+    d['conv2dtiledmatrix_build'] = lambda: _tiled_build((16,64,64), (8,8), conv2d=True)
+    d['conv2dtiledmatrix_forward'] = lambda: _tiled_forward((16,64,64), (8,8), 16, conv2d=True)
+    for net in ['lenet', 'allconvnet', 'vgg16']:
+        d['keynet_%s_build' % net] = (lambda net: lambda: _keynet_build(net))(net)
+        d['keynet_%s_build_tiled' % net] = (lambda net: lambda: _keynet_build(net, tiled=True))(net)
+        d['keynet_%s_forward' % net] = (lambda net: lambda: _keynet_forward(net, 16))(net)
+        d['keynet_%s_forward_tiled' % net] = (lambda net: lambda: _keynet_forward(net, 16, tiled=True))(net)
+        d['keynet_%s_forward_frozen' % net] = (lambda net: lambda: _keynet_forward(net, 16, frozen=True))(net)
+    return d
+
+
+def environment():
+    return {'keynet':keynet.version.VERSION, 'python':platform.python_version(), 'numpy':np.__version__, 'scipy':scipy.__version__, 'torch':torch.__version__, 'numba':numba.__version__,
+            'platform':platform.platform(), 'processor':platform.processor(), 'spgemm':keynet.globals.spgemm(), 'threads':keynet.globals.num_threads(), 'numba_threads':numba.config.NUMBA_NUM_THREADS}
+
+
+def run(names=None, repeat=3, seed=42, outfile=None):
+    """Run the benchmarks with name containing any of the strings in names (default all), and return {'environment', 'results':{name:{'seconds', 'median', 'repeat', ...}}}.
+       Each benchmark is set up once (untimed) with a fixed seed and then timed repeat times.  The reported time is the minimum, which excludes numba compilation on the first call.
+       Throughput is reported as images per second when the benchmark processes a batch.
+    """
+    verbose = keynet.globals.verbose()
+    keynet.globals.verbose(False)
+    results = {}
+    try:
+        for (k, setup) in benchmarks().items():
+            if names is not None and not any([n in k for n in names]):
+                continue
+            (np.random.seed(seed), torch.manual_seed(seed))
+            f = setup()
+            seconds = []
+            for r in range(0, repeat):
+                t = time.perf_counter()
+                stats = f()
+                seconds.append(time.perf_counter() - t)
+            results[k] = dict(stats, seconds=min(seconds), median=float(np.median(seconds)), repeat=repeat)
+            if 'images' in stats:
+                results[k]['images_per_second'] = stats['images'] / max(min(seconds), 1E-9)
+            print('[keynet.benchmark]: %s=%1.4f seconds' % (k, results[k]['seconds']))
+    finally:
+        keynet.globals.verbose(verbose)
+
+    results = {'environment':environment(), 'results':results}
+    if outfile is not None:
+        with open(outfile, 'w') as f:
+            json.dump(results, f, indent=2, default=lambda x: x.tolist() if isinstance(x, np.ndarray) else int(x))
+    return results
+
+
+def compare(results, baseline, tolerance=0.25, mintime=1E-3):
+    """Compare results to baseline (dictionaries or JSON files from run()), return {name:(seconds, baseline seconds, ratio)} for benchmarks slower than baseline by more than tolerance.
+       Benchmarks faster than mintime seconds in the baseline are ignored as timer noise.
+    """
+    (results, baseline) = [json.load(open(r)) if isinstance(r, str) else r for r in (results, baseline)]
+    regressions = {}
+    for (k, r) in results['results'].items():
+        if k in baseline['results'] and baseline['results'][k]['seconds'] >= mintime:
+            ratio = r['seconds'] / baseline['results'][k]['seconds']
+            if ratio > 1.0 + tolerance:
+                regressions[k] = (r['seconds'], baseline['results'][k]['seconds'], ratio)
+    return regressions
+
+
+def _models():
+    """Bundled pretrained models {name:(net, inshape, modelfile, f_testset)}, where f_testset(datadir) returns the test set of the model"""
+    modeldir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models')
+    mnist = lambda datadir: torchvision.datasets.MNIST(datadir, download=True, train=False, transform=keynet.mnist.LeNet().transform())
+    cifar10_grayscale = lambda datadir: torchvision.datasets.CIFAR10(datadir, download=True, train=False, transform=transforms.Compose([transforms.Grayscale(), transforms.Resize(28), transforms.ToTensor()]))
+    return {'mnist_lenet_avgpool':(keynet.mnist.LeNet_AvgPool(), (1,28,28), os.path.join(modeldir, 'mnist_lenet_avgpool.pth'), mnist),
+            'cifar10_grayscale28_lenet_avgpool':(keynet.mnist.LeNet_AvgPool(), (1,28,28), os.path.join(modeldir, 'cifar10_lenet_avgpool.pth'), cifar10_grayscale)}  # MNIST LeNet on 28x28 grayscale CIFAR-10
+            
+
+def precision_report(precisions=('float16', 'bfloat16'), n=64, seed=42, names=None, datadir=tempdir(), **kwargs):
+    """Return {model:{precision:{'bytes', 'bytes_float32', 'maxerror', 'meanerror', 'relerror', 'agreement', 'accuracy', 'accuracy_float32', 'pretrained'}}} for the bundled models 
+       keyed with keynet.system.Keynet(**kwargs) (default: local permutation and local affine keys) and stored in each reduced precision.  The decrypted outputs for the 
+       first n images of the test set of the model (downloaded to datadir) are compared to the same float32 keynet, where agreement is the fraction of images with the same 
+       top-1 class, relerror is the maximum error relative to the largest float32 output, and accuracy is the fraction of images classified correctly.  Models without a bundled 
+       model file use random weights (pretrained=False).
+    """
+    kwargs = kwargs if len(kwargs) > 0 else dict(local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=7, beta=1.0, gamma=1.0)
+    verbose = keynet.globals.verbose()
+    keynet.globals.verbose(False)
+    report = {}
+    try:
+        for (name, (net, inshape, modelfile, f_testset)) in _models().items():
+            if names is not None and name not in names:
+                continue
+            (np.random.seed(seed), torch.manual_seed(seed))
+            pretrained = os.path.exists(modelfile)
+            if pretrained:
+                net.load_state_dict(torch.load(modelfile, map_location='cpu'))
+            (images, labels) = next(iter(torch.utils.data.DataLoader(f_testset(datadir), batch_size=n, shuffle=False)))  # fixed batch of real images
+            (sensor, knet) = keynet.system.Keynet(inshape, net, seed=seed, **kwargs)
+            nbytes = lambda knet: int(sum([sum([v.nbytes for v in m.to_arrays().values()]) for m in knet._keynet.children() if isinstance(m, keynet.layer.KeyedLayer)]))
+            x_cipher = sensor.encrypt_batch(images)
+            y = knet.forward(x_cipher).detach().numpy().reshape(len(labels), -1)
+            report[name] = {}
+            for precision in precisions:
+                knet_reduced = copy.deepcopy(knet).reduce_precision(precision)
+                yh = knet_reduced.forward(x_cipher).detach().numpy().reshape(len(labels), -1)
+                err = np.abs(yh - y)
+                report[name][precision] = {'bytes':nbytes(knet_reduced), 'bytes_float32':nbytes(knet), 'maxerror':float(np.max(err)), 'meanerror':float(np.mean(err)),
+                                           'relerror':float(np.max(err) / max(np.max(np.abs(y)), 1E-12)), 'agreement':float(np.mean(np.argmax(yh, axis=1) == np.argmax(y, axis=1))), 
+                                           'accuracy':float(np.mean(np.argmax(yh, axis=1) == labels.numpy())), 'accuracy_float32':float(np.mean(np.argmax(y, axis=1) == labels.numpy())), 'pretrained':pretrained}
+                print('[keynet.benchmark]: %s %s bytes=%d (float32=%d), maxerror=%1.2E, relerror=%1.2E, agreement=%1.3f, accuracy=%1.3f (float32=%1.3f)' % (name, precision, report[name][precision]['bytes'], report[name][precision]['bytes_float32'],
+                                                                                                                                                   report[name][precision]['maxerror'], report[name][precision]['relerror'], report[name][precision]['agreement'],
+                                                                                                                                                   report[name][precision]['accuracy'], report[name][precision]['accuracy_float32']))
+    finally:
+        keynet.globals.verbose(verbose)
+    return report
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='keynet benchmarks')
+    parser.add_argument('--only', nargs='*', default=None, help='Run benchmarks with names containing any of these strings')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--outfile', default=None, help='Save results JSON')
+    parser.add_argument('--baseline', default=None, help='Baseline results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed fractional slowdown relative to baseline')
+    parser.add_argument('--list', action='store_true', help='List benchmark names')
+    parser.add_argument('--datadir', default=tempdir(), help='Download directory for the test images of --precision')
+    parser.add_argument('--precision', action='store_true', help='Report accuracy of reduced precision keyed weights on the bundled models and test images')
+    args = parser.parse_args(args)
+
+    if args.list:
+        print('\n'.join(benchmarks().keys()))
+        return 0
+    if args.precision:
+        report = precision_report(seed=args.seed, datadir=args.datadir)
+        if args.outfile is not None:
+            with open(args.outfile, 'w') as f:
+                json.dump(report, f, indent=2)
+        return 0
+    results = run(args.only, repeat=args.repeat, seed=args.seed, outfile=args.outfile)
+    if args.baseline is not None:
+        regressions = compare(results, args.baseline, tolerance=args.tolerance)
+        for (k, (seconds, baseline_seconds, ratio)) in regressions.items():
+            print('[keynet.benchmark]: REGRESSION %s=%1.4f seconds, baseline=%1.4f seconds (%1.2fx)' % (k, seconds, baseline_seconds, ratio))
+        return 1 if len(regressions) > 0 else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
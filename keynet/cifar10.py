@@ -81,22 +81,25 @@ class AllConvNet(nn.Module):
         return F.log_softmax(x, dim=1)
 
 
-def validate(net, cifardir=tempdir(), secretkey=None, transform=AllConvNet().transform_test(), num_workers=1, testloader=None):
+def validate(net, cifardir=tempdir(), secretkey=None, transform=AllConvNet().transform_test(), num_workers=1, testloader=None, sensor=None, batchsize=4):
+    """Validate net, or keyed net (KeyedModel) on images encrypted by KeyedSensor sensor, on batches of batchsize images"""
     if testloader is None:
         testset = torchvision.datasets.CIFAR10(root=cifardir, train=False, download=True, transform=transform)
-        testloader = torch.utils.data.DataLoader(testset, batch_size=4, shuffle=False, num_workers=num_workers)
+        testloader = torch.utils.data.DataLoader(testset, batch_size=batchsize, shuffle=False, num_workers=num_workers)
     net.eval()
 
     torch.set_grad_enabled(False)
     (total, correct) = (0,0)
     for images,labels in testloader:
-        for i in range(len(labels)):
-            with torch.no_grad():
+        with torch.no_grad():
+            if sensor is not None:
+                output = F.log_softmax(net.forward_batch(sensor.encrypt_batch(images), batchsize=batchsize).reshape(len(labels), -1), dim=1)
+            else:
                 output = net.loss(net(images if secretkey is None else net.encrypt(secretkey,images)))
-            _, pred = torch.max(output, 1)
-            #pred = output.argmax(dim=1, keepdim=True) 
-            total += labels.size(0)
-            correct += (pred == labels).sum().item()
+        _, pred = torch.max(output, 1)
+        #pred = output.argmax(dim=1, keepdim=True) 
+        total += labels.size(0)
+        correct += (pred == labels).sum().item()
 
     print("Mean classification accuracy = %f" % (correct/total))
 
@@ -1,7 +1,7 @@
 from vipy.util import try_import
 import tempfile
 
-GLOBAL = {'PROCESSES': 1, 'VERBOSE': True, 'DASK_CLIENT': None}
+GLOBAL = {'PROCESSES': 1, 'VERBOSE': True, 'DASK_CLIENT': None, 'SPGEMM': 'scipy', 'THREADS': None, 'PROFILE': False}
 
 def backend():
     return 'scipy'
@@ -24,10 +24,30 @@ def num_processes(n=None, backend='joblib'):
 
     return GLOBAL['PROCESSES']
 
+def spgemm(backend=None):
+    """Sparse matrix multiplication backend for keying, 'scipy' (single threaded) or 'numba' (multithreaded, bit-identical to scipy)"""
+    if backend is not None:
+        assert backend in ['scipy', 'numba'], "Invalid spgemm backend '%s'" % backend
+        GLOBAL['SPGEMM'] = backend
+    return GLOBAL['SPGEMM']
+
+def num_threads(n=None):
+    """Number of threads for parallel sparse kernels (e.g. KeyedLayer.forward), None for all cores"""
+    if n is not None:
+        assert n > 0
+        GLOBAL['THREADS'] = n
+    return GLOBAL['THREADS']
+
 def dask_client():
     assert GLOBAL['DASK_CLIENT'] is not None, "Must set keynet.globals.num_processes(n>1)"
     return GLOBAL['DASK_CLIENT'] 
 
+def profile(b=None):
+    """Record per-layer wall time, peak traced memory, nnz and tiles for keying and forward, reported by KeyedModel.profile()"""
+    if b is not None:
+        GLOBAL['PROFILE'] = b
+    return GLOBAL['PROFILE']
+
 def verbose(b=None):
     if b is not None:
         GLOBAL['VERBOSE'] = b
@@ -6,20 +6,63 @@ import keynet.torch
 import keynet.sparse
 from keynet.torch import affine_to_linear, linear_to_affine
 from keynet.torch import affine_to_linear_matrix
-from keynet.sparse import is_scipy_sparse, sparse_toeplitz_avgpool2d, sparse_toeplitz_conv2d, SparseMatrix
+from keynet.sparse import is_scipy_sparse, sparse_toeplitz_avgpool2d, sparse_toeplitz_conv2d, sparse_key_compose, sparse_key_dot, SparseMatrix
 import vipy
-from keynet.globals import GLOBAL, verbose
+from keynet.globals import GLOBAL, verbose, dask_client
 import scipy.sparse
 from vipy.util import Stopwatch
+import keynet.util
+import keynet.profile
+import json
+import os
+
+def key_layer(A, W, Ainv, minnnz=2**20, records=None):
+    """Return keyed layer sparse_key_compose(A, W, Ainv).  W is the unkeyed layer matrix, or a function returning it so that the unkeyed matrix is freed as soon as A*W is computed.
+       If W is a dense numpy array, the keyed layer is the dense array keynet.sparse.dense_key_compose(A, W, Ainv).
+       If the local dask client is set up with keynet.globals.num_processes(n, backend='dask') and W has at least minnnz nonzeros, the keyed layer is built as row panels 
+       on the dask workers and assembled.  If profiling, the 'toeplitz' and 'key' stages are appended to records.
+    """
+    with keynet.profile.stage(records, 'toeplitz') as r:
+        W = W() if callable(W) else W
+        r['nnz'] = W.nnz if is_scipy_sparse(W) else np.count_nonzero(W)
+    with keynet.profile.stage(records, 'key') as r:
+        if isinstance(W, np.ndarray):
+            W = keynet.sparse.dense_key_compose(A, W, Ainv)
+        elif GLOBAL['DASK_CLIENT'] is not None and W.nnz >= minnnz:
+            client = dask_client()
+            panels = 4*len(client.scheduler_info()['workers'])
+            if verbose():
+                print('[KeyedLayer]: keying %d row panels on dask workers' % panels)
+            W = keynet.sparse.sparse_key_compose_rowpanels(A, W, Ainv, panels, f_map=lambda f, args: client.gather(client.map(f, args, pure=False)))
+        else:
+            W = sparse_key_dot(A, W) if A is not None else W  # intermediates are freed eagerly
+            W = sparse_key_dot(W, Ainv) if Ainv is not None else W
+        r['nnz'] = W.nnz if is_scipy_sparse(W) else np.count_nonzero(W)
+    return W
+
+
+def toeplitz(module, inshape, dense=False):
+    """Return the unkeyed affine augmented sparse matrix of a Conv2d, AvgPool2d or Linear module for an input of shape inshape=(C,H,W), or a dense numpy array for Linear if dense=True"""
+    if isinstance(module, nn.Conv2d):
+        return sparse_toeplitz_conv2d(inshape, module.weight.detach().numpy(), bias=module.bias.detach().numpy(), stride=module.stride[0], groups=module.groups)
+    elif isinstance(module, nn.AvgPool2d):
+        (kernel_size, stride) = [x if isinstance(x, int) else x[0] for x in (module.kernel_size, module.stride)]
+        return sparse_toeplitz_avgpool2d(inshape, (inshape[0], inshape[0], kernel_size, kernel_size), stride)
+    elif isinstance(module, nn.Linear):
+        W = keynet.torch.affine_to_linear_matrix(module.weight, module.bias).detach().numpy().transpose()  # transposed for right multiply
+        return W if dense else scipy.sparse.coo_matrix(W)
+    raise ValueError('unsupported layer type "%s"' % str(type(module)))
+
 
 class KeyedLayer(nn.Module):
-    def __init__(self, module, inshape, outshape, A, Ainv, tileshape=None):
+    def __init__(self, module, inshape, outshape, A, Ainv, tileshape=None, precision='float32', format='csr', mindensity=0.25, blocksize=None):
         super(KeyedLayer, self).__init__()
         self._layertype = str(type(module))
         self._tileshape = tileshape
         self._inshape = inshape
         self._outshape = outshape
         self._tileshape = tileshape
+        self._profile = []  # keying records, see keynet.profile
         
         if isinstance(module, nn.Conv2d):
             assert len(module.kernel_size)==1 or len(module.kernel_size)==2 and (module.kernel_size[0] == module.kernel_size[1]), "Kernel must be square"
@@ -27,23 +70,22 @@ class KeyedLayer(nn.Module):
             assert len(inshape) == 3, "Inshape must be (C,H,W) for the shape of the tensor at the input to this layer"""
             assert module.padding[0] == module.kernel_size[0]//2 and module.padding[1] == module.kernel_size[1]//2, "Padding is assumed to be equal to (kernelsize-1)/2"            
             stride = module.stride[0] if len(module.stride)==2 else module.stride
-            self._repr = 'Conv2d: in_channels=%d, out_channels=%d, kernel_size=%s, stride=%s' % (module.in_channels, module.out_channels, str(module.kernel_size), str(stride))      
+            self._repr = 'Conv2d: in_channels=%d, out_channels=%d, kernel_size=%s, stride=%s%s' % (module.in_channels, module.out_channels, str(module.kernel_size), str(stride), (', groups=%d' % module.groups) if module.groups > 1 else '')
             sw = Stopwatch()
-            self.W = sparse_toeplitz_conv2d(inshape, module.weight.detach().numpy(), bias=module.bias.detach().numpy(), stride=module.stride[0])            
-            if verbose():
-                print('[KeyedLayer]: sparse_toeplitz_conv2d=%1.1f seconds' % sw.since())
-            self.W = A.dot(self.W).dot(Ainv)  # Key!            
+            self.W = key_layer(A, lambda: toeplitz(module, inshape), Ainv, records=self._profile)  # Key!
             if verbose():
-                print('[KeyedLayer]: conv2d dot=%1.1f seconds' % sw.since())
+                print('[KeyedLayer]: sparse_toeplitz_conv2d and dot=%1.1f seconds' % sw.since())
             if tileshape is not None:
-                self.W = keynet.sparse.Conv2dTiledMatrix(self.W, self._inshape, self._outshape, self._tileshape, bias=True, sanitycheck=False)
+                with keynet.profile.stage(self._profile, 'tile') as r:
+                    self.W = keynet.sparse.Conv2dTiledMatrix(self.W, self._inshape, self._outshape, self._tileshape, bias=True, sanitycheck=False)
+                    (r['nnz'], r['tiles']) = (self.W.nnz(), len(self.W._tiles))
                 if verbose():
                     print('[KeyedLayer]: conv2d tiled=%1.1f seconds' % sw.since())
 
         elif isinstance(module, nn.ReLU):
             # Include keyed ReLU only if forced, typically this is merged with previous layer
             self._repr = 'ReLU' 
-            self.W = A.dot(Ainv)  # key and store as sparse matrix (expensive)
+            self.W = sparse_key_compose(A, Ainv).tocsr()  # key and store as sparse matrix (expensive)
 
         elif isinstance(module, nn.AvgPool2d):
             assert isinstance(module.kernel_size, int) or len(module.kernel_size)==2 and (module.kernel_size[0] == module.kernel_size[1]), "Kernel must be square"
@@ -53,21 +95,21 @@ class KeyedLayer(nn.Module):
             kernel_size = module.kernel_size if isinstance(module.kernel_size, int) else module.kernel_size[0]
             self._repr = 'AvgPool2d: kernel_size=%s, stride=%s' % (str(kernel_size), str(stride))
             sw = Stopwatch()
-            self.W = sparse_toeplitz_avgpool2d(inshape, (inshape[0], inshape[0], kernel_size, kernel_size), stride)
+            self.W = key_layer(A, lambda: toeplitz(module, inshape), Ainv, records=self._profile)  # optional outkey
             if verbose():
-                print('[KeyedLayer]: sparse_toeplitz_conv2d=%1.1f seconds' % sw.since())
-            self.W = A.dot(self.W).dot(Ainv) if A is not None else self.W.dot(Ainv)  # optional outkey
-            if verbose():
-                print('[KeyedLayer]: avgpool2d dot=%1.1f seconds' % sw.since())
+                print('[KeyedLayer]: sparse_toeplitz_avgpool2d and dot=%1.1f seconds' % sw.since())
             if tileshape is not None:
-                self.W = keynet.sparse.TiledMatrix(self.W, self._tileshape)
+                with keynet.profile.stage(self._profile, 'tile') as r:
+                    self.W = keynet.sparse.TiledMatrix(self.W, self._tileshape)
+                    (r['nnz'], r['tiles']) = (self.W.nnz(), len(self.W._tiles))
                 if verbose():
                     print('[KeyedLayer]: avgpool2d tiled=%1.1f seconds' % sw.since())
             
         elif isinstance(module, nn.Linear):
             self._repr = 'Linear: in_features=%d, out_features=%d' % (module.in_features, module.out_features)
-            self.W = scipy.sparse.coo_matrix(keynet.torch.affine_to_linear_matrix(module.weight, module.bias).detach().numpy()).transpose()  # transposed for right multiply            
-            self.W = self.W.dot(Ainv) if A is None else A.dot(self.W).dot(Ainv)  # optional outkey
+            self.W = key_layer(A, lambda: toeplitz(module, inshape, dense=True), Ainv, records=self._profile)  # optional outkey, dense x sparse
+            if np.count_nonzero(self.W) < mindensity*self.W.size:
+                self.W = scipy.sparse.csr_matrix(self.W)  # sparse enough for CSR, otherwise dense float32 for GEMM
             
         elif isinstance(module, nn.BatchNorm2d):
             raise ValueError('batchnorm layer should be named "mylayer_bn" for batchnorm of "mylayer" and should come right before "mylayer" to merge keyed layers')
@@ -80,9 +122,17 @@ class KeyedLayer(nn.Module):
         
         if not isinstance(self.W, SparseMatrix) or not isinstance(self.W, keynet.sparse.SparseMatrix):
             self.W = SparseMatrix(self.W)
+        if type(self.W) is SparseMatrix:
+            self.W.affine(copy=False)  # (W, b) in place, bias is not stored as a sparse column
+        if format != 'csr' and type(self.W) is SparseMatrix:
+            with keynet.profile.stage(self._profile, 'format') as r:
+                self.W.asformat(format, blocksizes=((blocksize,) if blocksize is not None else ()) + (2,4,8,16,32,64))  # e.g. 'auto' for BSR at the key blocksize, DIA or dense if fewer bytes
+                r['format'] = self.W.format()
+        if precision != 'float32':
+            self.reduce_precision(precision)
             
     def extra_repr(self):
-        str_shape = 'backend=scipy, shape=%s, nnz=%d>' % (str(self.W.shape), self.nnz())
+        str_shape = 'backend=scipy, shape=%s, nnz=%d%s>' % (str(self.W.shape), self.nnz(), (', format=%s' % self.W.format()) if type(self.W) is SparseMatrix and self.W.format() != 'csr' else '')
         return str('<%s, %s>' % (self._repr, str_shape))
 
     def forward(self, x_affine):
@@ -102,6 +152,37 @@ class KeyedLayer(nn.Module):
         assert self.W is not None, "Layer not keyed"
         return self.W.nnz()
 
+    def reduce_precision(self, precision):
+        """Store keyed weights in precision 'float16' or 'bfloat16', forward upcasts on the fly with float32 accumulation (see keynet.sparse.SparseMatrix.reduce_precision)"""
+        self.W.reduce_precision(precision)
+        return self
+
+    def to_arrays(self):
+        """Return dictionary of numpy arrays for this keyed layer, such that KeyedLayer.from_arrays(self.to_arrays()) is equivalent to self"""
+        meta = {'repr':self._repr, 'layertype':self._layertype, 'inshape':self._inshape, 'outshape':self._outshape, 'tileshape':self._tileshape}
+        meta = json.dumps(meta, default=lambda x: x.tolist() if isinstance(x, np.ndarray) else int(x))
+        return dict([('meta', np.array(meta))] + [('W.%s' % k, v) for (k,v) in self.W.to_arrays().items()])
+
+    @staticmethod
+    def from_arrays(d):
+        layer = KeyedLayer.__new__(KeyedLayer)
+        nn.Module.__init__(layer)
+        layer._profile = []
+        meta = json.loads(str(d['meta']))
+        totuple = lambda x: tuple(x) if x is not None else None
+        (layer._repr, layer._layertype, layer._inshape, layer._outshape, layer._tileshape) = (meta['repr'], meta['layertype'], totuple(meta['inshape']), totuple(meta['outshape']), totuple(meta['tileshape']))
+        layer.W = keynet.sparse.sparse_matrix_from_arrays({k[2:]:d[k] for k in d.keys() if k.startswith('W.')})
+        return layer
+
+    def save(self, outfile):
+        """Save keyed layer to npz archive, or to a directory of .npy files that can be memory mapped if outfile does not end in .npz"""
+        return keynet.util.savez(outfile, self.to_arrays()) if outfile.endswith('.npz') else keynet.util.savedir(outfile, self.to_arrays())
+
+    @staticmethod
+    def load(infile, mmap_mode='r'):
+        """Load keyed layer from npz archive, or memory map from directory with the provided mmap_mode"""
+        return KeyedLayer.from_arrays(keynet.util.loaddir(infile, mmap_mode) if os.path.isdir(infile) else dict(np.load(infile)))
+
     def spy(self, mindim=256, showdim=1024, range=None):
         return keynet.sparse.spy(self.W.tocoo(), mindim, showdim, range=range)
 
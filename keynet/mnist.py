@@ -89,20 +89,23 @@ def train(net, modelfile, mnistdir=tempdir(), lr=0.003, epochs=20, transform=LeN
     return net
 
 
-def validate(net, mnistdir='/proj/enigma', secretkey=None, transform=LeNet().transform()):
+def validate(net, mnistdir='/proj/enigma', secretkey=None, transform=LeNet().transform(), sensor=None, batchsize=64):
+    """Validate net, or keyed net (KeyedModel) on images encrypted by KeyedSensor sensor, on batches of batchsize images"""
     valset = datasets.MNIST(mnistdir, download=True, train=False, transform=transform)
-    valloader = torch.utils.data.DataLoader(valset, batch_size=64, shuffle=True)
+    valloader = torch.utils.data.DataLoader(valset, batch_size=batchsize, shuffle=True)
     net.eval()
 
     with Stopwatch() as sw:
         (total, correct) = (0,0)
         for images,labels in valloader:
-            for i in range(len(labels)):
-                with torch.no_grad():
+            with torch.no_grad():
+                if sensor is not None:
+                    output = F.log_softmax(net.forward_batch(sensor.encrypt_batch(images), batchsize=batchsize).reshape(len(labels), -1), dim=1)
+                else:
                     output = net.loss(net(images if secretkey is None else net.encrypt(secretkey,images)))
-                _, pred = torch.max(output, 1)
-                total += labels.size(0)
-                correct += (pred == labels).sum().item()
+            _, pred = torch.max(output, 1)
+            total += labels.size(0)
+            correct += (pred == labels).sum().item()
 
     print("Mean classification accuracy = %f" % (correct/total))
     print('Validation: %s sec' % sw.elapsed)
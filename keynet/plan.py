@@ -0,0 +1,464 @@
+"""Predict the nonzeros, memory, tiles and time of each keyed layer of a Keynet before building it.
+
+   >>> P = keynet.plan.plan(net, (3,32,32), local_geometric='givens_orthogonal', alpha=8, blocksize=8, tileshape=(8,8))
+   >>> print(P.table())
+   >>> assert P.feasible(maxbytes=2**33, maxseconds=3600), P.infeasible(maxbytes=2**33, maxseconds=3600)
+"""
+import time
+import numpy as np
+import scipy.sparse
+import torch
+from torch import nn
+import keynet.system
+import keynet.sparse
+import keynet.layer
+import keynet.util
+import keynet.globals
+from keynet.sparse import sparse_permutation_matrix, sparse_orthogonal_matrix, sparse_random_diagonally_dominant_doubly_stochastic_matrix
+
+
+CALIBRATION = {'toeplitz':2E-8, 'key':2E-8, 'tile':4E-7, 'forward':1E-9}  # seconds per nonzero (forward is per image), see calibrate()
+
+
+def _blocksize(shape, blocksize, strict=False):
+    """Return (blocksize, blocknumel) of the local key blocks as assigned by keynet.system.keygen, including the ragged blocksize correction"""
+    (channels, height, width) = shape
+    if height == 1 and width == 1:
+        return (None, int(np.prod(shape)))  # global transformation
+    elif blocksize is None:
+        return (None, 1)
+    elif not strict and (height % blocksize != 0 or width % blocksize != 0):
+        assert height == width, "Image must be square to correct ragged blocksize"
+        blocksize = keynet.util.find_closest_positive_divisor(height, blocksize)
+    return (blocksize, blocksize*blocksize)
+
+
+def _seeded(f, seed=0):
+    """Call f() with a fixed numpy seed without changing the global random state"""
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        return f()
+    finally:
+        np.random.set_state(state)
+
+
+def _pattern(m):
+    m = scipy.sparse.csr_matrix(m)
+    m.eliminate_zeros()
+    return scipy.sparse.csr_matrix((np.ones(m.nnz, dtype=np.bool_), m.indices, m.indptr), shape=m.shape)
+
+
+def local_pattern(local_geometric, blocknumel, alpha=None):
+    """Return the boolean sparsity (g, ginv) of one block of the local geometric key, generated as in keygen with a fixed seed, or None for identity.
+       Local keys repeat the same block over the image, so one block determines the structure of the key.
+    """
+    if local_geometric == 'identity' or blocknumel <= 1:
+        return None
+    elif local_geometric == 'permutation':
+        (g, ginv) = _seeded(lambda: sparse_permutation_matrix(blocknumel, withinverse=True))
+    elif local_geometric == 'doubly_stochastic':
+        (g, ginv) = _seeded(lambda: sparse_random_diagonally_dominant_doubly_stochastic_matrix(blocknumel, int(alpha), withinverse=True))
+    elif local_geometric == 'givens_orthogonal':
+        def f():
+            (g, ginv) = sparse_orthogonal_matrix(blocknumel, int(alpha), balanced=True, withinverse=True)
+            (A, Ainv) = sparse_permutation_matrix(blocknumel, withinverse=True)
+            return (A.dot(g), ginv.dot(Ainv))
+        (g, ginv) = _seeded(f)
+    else:
+        raise ValueError("Invalid local geometric transform '%s'" % local_geometric)
+    return (_pattern(g), _pattern(ginv))
+
+
+def global_fanout(global_geometric, N, alpha=None, maxsize=4096):
+    """Return the average nonzeros per row of the global geometric key.  Global Givens rotations are estimated on at most maxsize elements with the same rotations per element"""
+    if global_geometric != 'givens_orthogonal':
+        return 1.0
+    n = min(N, maxsize)
+    k = max(1, int(np.round(int(alpha)*n/float(N))))
+    return _seeded(lambda: sparse_orthogonal_matrix(n, k, balanced=True).nnz / float(n))
+
+
+def key_structure(shape, global_geometric='identity', local_geometric='identity', global_photometric='identity', local_photometric='identity', memoryorder='channel',
+                  alpha=None, blocksize=None, tileshape=None, strict=False, **kwargs):
+    """Return the sparsity structure of keygen(shape, ...) without generating the key, with the same validity checks as keygen.
+
+       Returns {'shape', 'N', 'blocksize', 'blocknumel', 'memoryorder', 'local_geometric', 'alpha', 'scrambled', 'fanout', 'bias'}, where scrambled is True if the global geometric
+       transform does not preserve locality (permutation, givens_orthogonal), with fanout nonzeros per row, and bias is True if the key adds a bias.  Global Givens rotations 
+       are modeled as random placement, which overestimates the keyed nonzeros.  Hierarchical permutations and rotations move blocks of at least
+       8x8 pixels, and are modeled as locality preserving.  The local block sparsity is local_pattern(local_geometric, blocknumel, alpha).
+    """
+    assert len(shape) == 3, "Shape must be (C,H,W)"
+    (channels, height, width) = shape
+    if blocksize is not None and tileshape is not None:
+        assert blocksize == tileshape[0] and blocksize == tileshape[1]
+    assert memoryorder in ['channel', 'block'], "Invalid memory order '%s'" % memoryorder
+    assert memoryorder == 'channel' or blocksize is not None
+    assert global_geometric in ['identity', 'permutation', 'hierarchical_permutation', 'hierarchical_rotation', 'givens_orthogonal'], "Invalid global geometric transform '%s'" % global_geometric
+    assert local_geometric in ['identity', 'permutation', 'doubly_stochastic', 'givens_orthogonal'], "Invalid local geometric transform '%s'" % local_geometric
+    assert tileshape is None or global_geometric not in ['permutation', 'givens_orthogonal'], "Global %s is not tile compressible" % global_geometric
+    assert tileshape is None or global_photometric not in ['uniform_random_gain', 'uniform_random_affine'], "Global %s is not tile compressible" % global_photometric
+    assert global_geometric != 'givens_orthogonal' or alpha is not None
+    assert local_geometric == 'identity' or (blocksize is not None and height == width)
+    assert local_geometric in ['identity', 'permutation'] or alpha is not None
+    assert local_photometric == 'identity' or blocksize is not None
+
+    (blocksize, blocknumel) = _blocksize(shape, blocksize, strict) if blocksize is not None else (None, 1)
+    assert local_geometric != 'doubly_stochastic' or blocksize is None or blocksize < 8192, "Blocksize %d must be less than 8192" % blocksize
+    N = int(np.prod(shape))
+    return {'shape':tuple(shape), 'N':N, 'blocksize':blocksize, 'blocknumel':blocknumel, 'memoryorder':memoryorder if blocksize is not None and (height > 1 or width > 1) else 'channel',
+            'local_geometric':local_geometric, 'alpha':alpha, 'scrambled':global_geometric in ['permutation', 'givens_orthogonal'], 'fanout':global_fanout(global_geometric, N, alpha),
+            'bias':any([p not in ['identity', 'uniform_random_gain'] for p in (global_photometric, local_photometric)])}
+
+
+def _pattern_of(K):
+    if 'pattern' not in K:
+        K['pattern'] = local_pattern(K['local_geometric'], K['blocknumel'], K['alpha'])  # lazily, only keys of spatial layers are needed
+    return K['pattern']
+
+
+def _to_memory(K, e):
+    """Channel order element index to key memory order"""
+    if K['memoryorder'] == 'channel':
+        return e
+    (c, h, w) = K['shape']
+    b = K['blocksize']
+    (ch, pix) = np.divmod(e, h*w)
+    (y, x) = np.divmod(pix, w)
+    return ch*h*w + ((y//b)*(w//b) + x//b)*b*b + (y % b)*b + (x % b)
+
+
+def _from_memory(K, m):
+    if K['memoryorder'] == 'channel':
+        return m
+    (c, h, w) = K['shape']
+    b = K['blocksize']
+    (ch, r) = np.divmod(m, h*w)
+    (blk, pos) = np.divmod(r, b*b)
+    return ch*h*w + ((blk // (w//b))*b + pos // b)*w + (blk % (w//b))*b + pos % b
+
+
+def _local(K, e, inverse=False):
+    """Return concatenated support of the rows e of the local geometric key"""
+    pattern = _pattern_of(K)
+    if pattern is None or len(e) == 0:
+        return e
+    M = pattern[1] if inverse else pattern[0]
+    bn = K['blocknumel']
+    m = _to_memory(K, e)
+    (base, pos) = ((m // bn)*bn, m % bn)
+    counts = M.indptr[pos+1] - M.indptr[pos]
+    offset = np.repeat(M.indptr[pos] - np.cumsum(counts) + counts, counts) + np.arange(np.sum(counts))  # gather rows of csr
+    m = np.repeat(base, counts) + M.indices[offset]
+    return _from_memory(K, m[m < K['N']])
+
+
+def _global(K, e, rng):
+    """Return support of the rows e of the global geometric key, randomly placed if it does not preserve locality"""
+    if not K['scrambled']:
+        return e
+    return rng.randint(0, K['N'], size=int(np.round(len(e)*K['fanout'])))
+
+
+def _key_rows(K, e, rng, inverse=False):
+    """Return support of the rows e of the key, or of the inverse key, as channel order element indices"""
+    if inverse:
+        return _local(K, _global(K, e, rng), inverse=True)  # Ginv then ginv
+    return _global(K, _local(K, e), rng)  # g then G
+
+
+def _density(K, inverse=False):
+    """Average nonzeros per row of the key, or of the inverse key"""
+    return K['fanout']*(_pattern_of(K)[1 if inverse else 0].nnz / float(K['blocknumel']) if _pattern_of(K) is not None else 1.0)
+
+
+def _receptive_field(L, e):
+    """Return (group, pixel) pairs of the unique input pixels of each channel group that contribute to output elements e of the unkeyed layer"""
+    (cin, hin, win) = L['inshape']
+    (cout, hout, wout) = L['outshape']
+    (k, s, groups) = (L['kernel'], L['stride'], L['groups'])
+    (ch, pix) = np.divmod(e, hout*wout)
+    (y, x) = np.divmod(pix, wout)
+    (dy, dx) = [d.flatten() - k//2 for d in np.meshgrid(np.arange(k), np.arange(k), indexing='ij')]
+    (y, x) = (y.reshape(-1,1)*s + dy.reshape(1,-1), x.reshape(-1,1)*s + dx.reshape(1,-1))  # padding k//2
+    g = np.repeat((ch // (cout // groups)).reshape(-1,1), k*k, axis=1)
+    valid = (y >= 0) & (y < hin) & (x >= 0) & (x < win)
+    return np.unique(g[valid]*hin*win + y[valid]*win + x[valid])
+
+
+def _sample_row(L, chain, Kin, rows, rng):
+    """Return (nnz of A*W*Ainv, nnz of A*W) for the keyed layer rows, excluding the bias column.
+       The output key A is the product of the keys in chain [(key structure, inverse), ...] and Ainv is the inverse of Kin.
+    """
+    (cin, hin, win) = L['inshape']
+    Nin = cin*hin*win
+    cpg = cin // L['groups']  # input channels per group
+
+    # Output key row support, then unkeyed receptive field
+    e = rows
+    for (K, inverse) in chain:
+        e = np.unique(_key_rows(K, e, rng, inverse))
+    (g, pix) = np.divmod(_receptive_field(L, e), hin*win)
+    nnz_aw = len(pix)*cpg
+
+    # Input key row support
+    if Kin is None or ((_pattern_of(Kin) is None or Kin['local_geometric'] == 'permutation') and not Kin['scrambled']):
+        return (nnz_aw, nnz_aw)
+    elif Kin['scrambled']:
+        return (Nin*(1.0 - np.exp(-nnz_aw*_density(Kin, inverse=True) / float(Nin))), nnz_aw)  # random placement
+    elif cpg == cin and (hin*win) % Kin['blocknumel'] == 0:
+        cols = np.unique(_local(Kin, pix, inverse=True))  # local blocks are within a channel, and repeat over all input channels
+        return (cin*len(cols), nnz_aw)
+    else:
+        e = ((g.reshape(-1,1)*cpg + np.arange(cpg).reshape(1,-1))*hin*win + pix.reshape(-1,1)).flatten()
+        return (len(np.unique(_local(Kin, e, inverse=True))), nnz_aw)
+
+
+def csr_bytes(nnz, rows, cols):
+    """Bytes of a float32 scipy csr matrix, with int64 indices if int32 would overflow"""
+    itemsize = 4 if max(nnz, rows, cols) < 2**31 else 8
+    return int(nnz*(4 + itemsize) + (rows + 1)*itemsize)
+
+
+def layer_structure(module, inshape, outshape):
+    """Return {'type', 'inshape', 'outshape', 'kernel', 'stride', 'groups', 'nnz'} for the affine augmented Toeplitz matrix of the unkeyed layer (bias column and homogeneous row included)"""
+    if isinstance(module, nn.Conv2d):
+        L = {'type':'conv2d', 'kernel':module.kernel_size[0], 'stride':module.stride[0], 'groups':module.groups}
+    elif isinstance(module, nn.AvgPool2d):
+        kernel = module.kernel_size if isinstance(module.kernel_size, int) else module.kernel_size[0]
+        stride = module.stride if isinstance(module.stride, int) else module.stride[0]
+        L = {'type':'avgpool2d', 'kernel':kernel, 'stride':stride, 'groups':inshape[0]}  # depthwise
+    elif isinstance(module, nn.ReLU):
+        L = {'type':'relu', 'kernel':1, 'stride':1, 'groups':inshape[0]}  # identity
+    elif isinstance(module, nn.Linear):
+        nnz = int(np.count_nonzero(module.weight.detach().numpy()) + (np.count_nonzero(module.bias.detach().numpy()) if module.bias is not None else 0)) + 1
+        L = {'type':'linear', 'inshape':(module.in_features, 1, 1), 'outshape':(module.out_features, 1, 1), 'nnz':nnz}
+        return L
+    else:
+        raise ValueError('unsupported layer type "%s"' % str(type(module)))
+
+    (L['inshape'], L['outshape']) = (tuple(inshape), tuple(outshape))
+    (k, s) = (L['kernel'], L['stride'])
+    taps = lambda n, m: sum([sum([(0 <= i*s - k//2 + d < n) for d in range(k)]) for i in range(m)])  # valid taps per axis for padding k//2
+    L['nnz'] = outshape[0]*(inshape[0] // L['groups'])*taps(inshape[1], outshape[1])*taps(inshape[2], outshape[2]) + (int(np.prod(outshape)) + 1 if L['type'] != 'relu' else 1)
+    return L
+
+
+def _sublayer(P, co, ci, inshape, outshape):
+    """Affine augmented keyed matrix of the first co output channels and ci input channels of the keyed layer, given the keyed rows P of at least co output channels"""
+    ((Cin, Hin, Win), (Cout, Hout, Wout)) = (inshape, outshape)
+    (B, b) = (P[0:co*Hout*Wout, 0:ci*Hin*Win], P[0:co*Hout*Wout, -1])
+    return scipy.sparse.bmat([[B, b], [None, scipy.sparse.coo_matrix(np.ones( (1,1) ))]]).astype(np.float32).tocsr()  # homogeneous row
+
+
+def sample_channels(module, inshape, outshape, A, Ainv, f_measure, channels=(2,4)):
+    """Return the costs f_measure(T, inshape, outshape) of the keyed conv or pool layer A*W*Ainv, fit from sublayers T of its keyed channel blocks.
+
+       Only the rows of the first max(channels) output channels are keyed.  The array of costs returned by f_measure for sublayers of the first (output, input) 
+       channels from channels are fit as a + b*Cout + c*Cout*Cin (per output channel storage such as the bias, and per channel block storage), or a + b*C for 
+       depthwise pool, then evaluated for the full layer.  This assumes that the keyed channel blocks of the full layer are as compressible as the sampled blocks (e.g. local keys).
+    """
+    ((Cin, Hin, Win), (Cout, Hout, Wout)) = (inshape, outshape)
+    depthwise = isinstance(module, nn.AvgPool2d) or module.groups > 1
+    (c1, c2) = [min(c, Cout) for c in channels]
+    P = keynet.sparse.sparse_key_compose_rows(A, keynet.layer.toeplitz(module, inshape), Ainv, 0, c2*Hout*Wout)  # keyed rows of the sampled output channels
+    if depthwise:
+        (samples, features) = (sorted(set([(c1, c1), (c2, c2)])), lambda co, ci: [1, co])
+    else:
+        (samples, features) = (sorted(set([(c1, min(c1, Cin)), (c2, min(c1, Cin)), (c2, min(c2, Cin))])), lambda co, ci: [1, co, co*ci])
+    X = np.array([features(co, ci) for (co, ci) in samples], dtype=np.float64)
+    m = np.array([f_measure(_sublayer(P, co, ci, inshape, outshape), (ci, Hin, Win), (co, Hout, Wout)) for (co, ci) in samples], dtype=np.float64)
+    coef = np.linalg.lstsq(X, m, rcond=None)[0]  # exact if the samples determine the fit, minimum norm if channels are fewer than samples
+    return np.maximum(np.array(features(Cout, Cin)).dot(coef), 0)
+
+
+def tiled_storage(module, inshape, outshape, A, Ainv, tileshape):
+    """Return {'bytes', 'tiles', 'blocks'} of the conv or pool layer keyed as A*W*Ainv and tiled by KeyedLayer with tileshape, for the arrays of the unique stored tiles 
+       and the block table (see to_arrays()), the number of unique stored tiles and the number of blocks.  These are sampled from the first channel blocks, see sample_channels()
+    """
+    def f(T, inshape, outshape):
+        M = keynet.sparse.TiledMatrix(T, tileshape) if isinstance(module, nn.AvgPool2d) else keynet.sparse.Conv2dTiledMatrix(T, inshape, outshape, tileshape, bias=True, sanitycheck=False)
+        return np.array([sum([v.nbytes for v in M.to_arrays().values() if v.ndim > 0]), len(M._tiles), len(M._blocks)])
+    (nbytes, tiles, blocks) = [int(np.round(x)) for x in sample_channels(module, inshape, outshape, A, Ainv, f)]
+    return {'bytes':nbytes, 'tiles':tiles, 'blocks':blocks}
+
+
+def layer_cost(L, chain, Kin, samples=64, seed=0, tiled=None, mindensity=0.25):
+    """Predict the cost of keying the unkeyed layer structure L with output key A given by chain (see _sample_row) and input key structure Kin (None for unkeyed).
+       The keyed nonzeros are estimated from a random sample of rows, with the exact support of each row given the key structures.  If the layer is tiled, 
+       tiled is the tiled storage {'bytes', 'tiles', 'blocks'} from tiled_storage().  Keyed linear layers are stored dense unless the predicted density is below mindensity, as in KeyedLayer.
+    """
+    (Nout, Nin) = (int(np.prod(L['outshape'])), int(np.prod(L['inshape'])))
+    if L['type'] == 'linear':
+        (size, fanout) = (Nout*(Nin + 1), np.prod([_density(K, inverse) for (K, inverse) in chain + [(Kin, True)] if K is not None]))
+        if fanout <= 1 or L['nnz'] == size + 1:
+            nnz = L['nnz']  # monomial keys preserve nonzeros, dense stays dense
+        else:
+            nnz = int(np.round(size*(1.0 - np.exp(-(L['nnz'] - 1)*fanout / float(size))))) + 1  # random placement, homogeneous row
+        nnz_aw = nnz
+        dense = nnz >= mindensity*(Nout + 1)*(Nin + 1)
+    else:
+        rng = np.random.RandomState(seed)
+        stats = [_sample_row(L, chain, Kin, np.array([r]), rng) for r in rng.choice(Nout, size=min(samples, Nout), replace=False)]
+        bias = 1 if L['type'] != 'relu' or any([K['bias'] for (K, inverse) in chain + [(Kin, True)] if K is not None]) else 0  # bias column
+        nnz = int(np.round(Nout*(np.mean([s[0] for s in stats]) + bias))) + 1  # homogeneous row
+        nnz_aw = int(np.round(Nout*(np.mean([s[1] for s in stats]) + bias))) + 1
+
+    shape = (Nout + 1, Nin + 1)
+    (W, AW) = [csr_bytes(n, *shape) if L['type'] != 'linear' else 4*shape[0]*shape[1] for n in (L['nnz'], nnz_aw)]  # linear is keyed as dense float32
+    AWAinv = (csr_bytes(nnz - Nout - 1, Nout, Nin) if L['type'] != 'linear' or not dense else 4*Nout*Nin) + 4*Nout  # stored as (W, b), see keynet.sparse.SparseMatrix.affine()
+    if tiled is not None:
+        (nbytes, peakbytes) = (tiled['bytes'], max(W + AW, AW + csr_bytes(nnz, *shape), 2*csr_bytes(nnz, *shape) + tiled['bytes']))  # tiling copies the keyed matrix
+    else:
+        (nbytes, peakbytes) = (AWAinv, max(W + AW, AW + AWAinv))
+    seconds = CALIBRATION['toeplitz']*L['nnz'] + CALIBRATION['key']*(nnz_aw + nnz) + (CALIBRATION['tile']*nnz if tiled is not None else 0)
+    return {'type':L['type'], 'inshape':L['inshape'], 'outshape':L['outshape'], 'shape':shape, 'nnz_toeplitz':L['nnz'], 'nnz_affine':nnz_aw, 'nnz':nnz,
+            'bytes':nbytes, 'peakbytes':peakbytes, 'tiles':tiled['tiles'] if tiled is not None else None, 'blocks':tiled['blocks'] if tiled is not None else None,
+            'build_seconds':seconds, 'forward_seconds':CALIBRATION['forward']*nnz}
+
+
+class Plan(object):
+    """Predicted cost of each keyed layer of a Keynet, see plan()"""
+    def __init__(self, layers, spillbytes=None):
+        self._layers = layers  # [{'layer', 'nnz', 'bytes', 'peakbytes', ...}, ...] in keying order
+        self._spillbytes = spillbytes
+
+    def __repr__(self):
+        return '<keynet.plan.Plan: layers=%d, nnz=%d, bytes=%d, peakbytes=%d, build_seconds=%1.1f>' % (len(self), self.nnz(), self.bytes(), self.peakbytes(), self.build_seconds())
+
+    def __len__(self):
+        return len(self._layers)
+
+    def layers(self):
+        return [dict(d) for d in self._layers]
+
+    def layer(self, k):
+        return dict([d for d in self._layers if d['layer'] == k][-1])
+
+    def nnz(self):
+        return sum([d['nnz'] for d in self._layers])
+
+    def bytes(self):
+        """Bytes of all keyed layers"""
+        return sum([d['bytes'] for d in self._layers])
+
+    def peakbytes(self):
+        """Peak bytes while keying, the peak of each layer plus the keyed layers held in memory (at most spillbytes if spilling)"""
+        (peak, resident) = (0, 0)
+        for d in self._layers:
+            peak = max(peak, d['peakbytes'] + resident)
+            resident = resident + d['bytes'] if self._spillbytes is None else min(self._spillbytes, resident + d['bytes'])
+        return max(peak, resident)
+
+    def build_seconds(self):
+        return sum([d['build_seconds'] for d in self._layers])
+
+    def forward_seconds(self, batchsize=1):
+        return batchsize*sum([d['forward_seconds'] for d in self._layers])
+
+    def infeasible(self, maxbytes=None, maxseconds=None):
+        """Return a list of reasons that the planned Keynet exceeds maxbytes of memory (default: available memory) or maxseconds of build time, empty if feasible"""
+        maxbytes = keynet.util.available_memory() if maxbytes is None else maxbytes
+        reasons = []
+        if self.peakbytes() > maxbytes:
+            reasons.append('peak memory %d bytes exceeds %d bytes (largest layer "%s" needs %d bytes)' % (self.peakbytes(), maxbytes, *max([(d['layer'], d['peakbytes']) for d in self._layers], key=lambda x: x[1])))
+        if maxseconds is not None and self.build_seconds() > maxseconds:
+            reasons.append('build time %1.1f seconds exceeds %1.1f seconds' % (self.build_seconds(), maxseconds))
+        return reasons
+
+    def feasible(self, maxbytes=None, maxseconds=None):
+        return len(self.infeasible(maxbytes, maxseconds)) == 0
+
+    def table(self):
+        """Return a printable table of the predicted cost per layer"""
+        lines = ['%-12s %-10s %16s %14s %12s %12s %10s %10s %12s' % ('layer', 'type', 'shape', 'nnz', 'MB', 'peak MB', 'tiles', 'build s', 'forward ms')]
+        for d in self._layers:
+            lines.append('%-12s %-10s %16s %14d %12.1f %12.1f %10s %10.2f %12.3f' % (d['layer'], d['type'], '%dx%d' % d['shape'], d['nnz'], d['bytes']/1E6, d['peakbytes']/1E6,
+                                                                                  str(d['tiles']) if d['tiles'] is not None else '', d['build_seconds'], 1000*d['forward_seconds']))
+        lines.append('%-12s %-10s %16s %14d %12.1f %12.1f %10s %10.2f %12.3f' % ('total', '', '', self.nnz(), self.bytes()/1E6, self.peakbytes()/1E6, '', self.build_seconds(), 1000*self.forward_seconds()))
+        return '\n'.join(lines)
+
+
+def plan(net, inshape, samples=64, global_photometric='identity', local_photometric='identity', global_geometric='identity', local_geometric='identity', memoryorder='channel',
+         do_output_encryption=False, alpha=None, blocksize=None, tileshape=None, spilldir=None, spillbytes=0, **kwargs):
+    """Return a Plan with the predicted nnz, bytes, tiles and build and forward time of each keyed layer of keynet.system.Keynet(inshape, net, **kwargs), without building it.
+       Layers are merged and keyed as in KeyedModel, and key options are assigned per layer as in Keynet.  Invalid key options raise as in keygen.  The storage of tiled
+       conv and pool layers depends on which tiles repeat, so it is sampled by keying the first output channels with seeded keys of the same structure (see tiled_storage()).
+    """
+    netshape = keynet.system.keyed_netshape(net, inshape)
+    output = netshape['output']['prevlayer']
+    layertileshape = (lambda k: tileshape.get(k)) if isinstance(tileshape, dict) else (lambda k: tileshape)  # per-layer, as in Keynet
+    keyoptions = dict(memoryorder=memoryorder, alpha=alpha, blocksize=blocksize, tileshape=keynet.system.key_tileshape(tileshape, blocksize))
+    d_name_to_key = {}
+    def key(k):
+        if k not in d_name_to_key:
+            d_name_to_key[k] = key_structure(tuple(inshape) if k == 'input' else netshape[k]['outshape'], **keynet.system.layer_keygen_options(k, global_photometric, local_photometric, global_geometric, local_geometric), **keyoptions)
+        return d_name_to_key[k]
+    d_name_to_keypair = {}
+    def keypair(k):
+        if k not in d_name_to_keypair:
+            keyparams = {a:kwargs.get(a) for a in ['beta', 'gamma', 'hierarchical_blockshape', 'hierarchical_permute_at_level']}  # seeded keys with the structure of the Keynet keys, for tiled layers
+            d_name_to_keypair[k] = _seeded(lambda: keynet.system.keygen(tuple(inshape) if k == 'input' else netshape[k]['outshape'], **keynet.system.layer_keygen_options(k, global_photometric, local_photometric, global_geometric, local_geometric), **keyoptions, **keyparams))
+        return d_name_to_keypair[k]
+
+    # Keyed layers (name, module, inshape, outshape, outkey layer, inkey layer), as merged in KeyedModel
+    keyed = []
+    for (k,m) in net.named_children():
+        if isinstance(m, nn.BatchNorm2d):
+            k_prev = k.split('_')[0]
+            keyed.append((k_prev, getattr(net, k_prev), netshape[k_prev]['inshape'], netshape[k]['outshape'], k, netshape[k_prev]['prevlayer']))
+        elif isinstance(m, nn.ReLU):
+            k_prev = netshape[k]['prevlayer']
+            if '_bn' not in k_prev:
+                keyed.append((k_prev, getattr(net, k_prev), netshape[k_prev]['inshape'], netshape[k_prev]['outshape'], k, netshape[k_prev]['prevlayer']))
+            else:
+                keyed.append((k, m, netshape[k]['inshape'], netshape[k]['outshape'], k, k_prev))  # explicit keyed ReLU
+        elif isinstance(m, nn.Dropout):
+            pass
+        elif netshape[k]['nextlayer'] is not None and (('%s_bn' % k) == netshape[k]['nextlayer'] or 'relu' in netshape[k]['nextlayer']):
+            pass  # merged with next layer
+        else:
+            keyed.append((k, m, netshape[k]['inshape'], netshape[k]['outshape'], k, netshape[k]['prevlayer']))
+
+    layers = []
+    for (k, m, layer_inshape, layer_outshape, k_out, k_in) in keyed:
+        if k_out == output and not do_output_encryption:
+            chain = []
+        elif k_out != k:
+            chain = [(key(k_out), False), (key(k), True), (key(k), False)]  # merged outkey A_next*inv(A)*A is not simplified, and has the sparsity of all three
+        else:
+            chain = [(key(k), False)]
+        t = keynet.system.layer_tileshape(layertileshape(k), layer_inshape, layer_outshape) if isinstance(m, (nn.Conv2d, nn.AvgPool2d)) else None  # as in layergen and KeyedLayer
+        tiled = None
+        if t is not None:
+            A = None if len(chain) == 0 else (keypair(k)[0] if k_out == k else keynet.sparse.sparse_key_dot(keynet.sparse.sparse_key_dot(keypair(k_out)[0], keypair(k)[1]), keypair(k)[0]))  # merged outkey, as in KeyedModel
+            tiled = tiled_storage(m, layer_inshape, layer_outshape, A, keypair(k_in)[1], t)
+        d = layer_cost(layer_structure(m, layer_inshape, layer_outshape), chain, key(k_in), samples=samples, tiled=tiled)
+        d['layer'] = k
+        layers.append(d)
+        if keynet.globals.verbose():
+            print('[keynet.plan]: "%s" nnz=%d, bytes=%d, peakbytes=%d' % (k, d['nnz'], d['bytes'], d['peakbytes']))
+    return Plan(layers, spillbytes=spillbytes if spilldir is not None else None)
+
+
+def calibrate(shape=(16,32,32), batchsize=64):
+    """Measure seconds per nonzero for building and forward of a keyed convolutional layer on this machine, update CALIBRATION and return it"""
+    conv = nn.Conv2d(shape[0], shape[0], 3, padding=1)
+    (A, Ainv) = keynet.system.keygen(shape, 'identity', 'permutation', 'identity', 'uniform_random_affine', blocksize=8, beta=1.0, gamma=1.0)
+    profile = keynet.globals.profile()
+    keynet.globals.profile(True)
+    try:
+        for k in range(2):  # first call compiles
+            layer = keynet.layer.KeyedLayer(conv, shape, shape, A, Ainv)
+            r = {s['stage']:s for s in layer._profile}
+            t = time.perf_counter()
+            keynet.sparse.Conv2dTiledMatrix(layer.W.tocoo().tocsr(), shape, shape, (8,8), bias=True, sanitycheck=False)
+            tile = time.perf_counter() - t
+            x = torch.rand(layer.W.shape[1], batchsize)
+            t = time.perf_counter()
+            layer.W.torchdot(x)
+            forward = time.perf_counter() - t
+    finally:
+        keynet.globals.profile(profile)
+    CALIBRATION.update({'toeplitz':r['toeplitz']['seconds'] / r['toeplitz']['nnz'], 'key':r['key']['seconds'] / (2*r['key']['nnz']), 'tile':tile / layer.nnz(), 'forward':forward / (batchsize*layer.nnz())})
+    return CALIBRATION
@@ -0,0 +1,101 @@
+import time
+import json
+import tracemalloc
+from contextlib import contextmanager
+from keynet.globals import GLOBAL
+
+
+_HOOKS = []
+
+
+def add_hook(f):
+    """Call f(record) for each new profiling record (e.g. to export to a metrics system)"""
+    _HOOKS.append(f)
+    return f
+
+
+def remove_hook(f):
+    _HOOKS.remove(f)
+
+
+@contextmanager
+def stage(records, stage, layer=None):
+    """Append a record {'layer', 'stage', 'seconds', 'peakbytes'} for the enclosed block to the list records if keynet.globals.profile() is enabled.
+       The block may add fields to the yielded record (e.g. nnz, tiles).  Peak memory is the peak traced by tracemalloc above the memory at entry, so stages must not be nested.
+    """
+    r = {'layer':layer, 'stage':stage}
+    if not GLOBAL['PROFILE'] or records is None:
+        yield r
+        return
+    is_tracing = tracemalloc.is_tracing()
+    if not is_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    t = time.perf_counter()
+    try:
+        yield r
+    finally:
+        r['seconds'] = time.perf_counter() - t
+        r['peakbytes'] = max(0, tracemalloc.get_traced_memory()[1] - base)
+        if not is_tracing:
+            tracemalloc.stop()
+        records.append(r)
+        for f in _HOOKS:
+            f(r)
+
+
+class Report(object):
+    """Queryable profiling records for keying (toeplitz, key, tile) and inference (forward) of each layer of a KeyedModel"""
+    def __init__(self, records):
+        self._records = list(records)
+
+    def __repr__(self):
+        return '<keynet.profile.Report: layers=%d, records=%d, seconds=%1.3f, peakbytes=%d>' % (len(self.layers()), len(self._records), self.seconds(), self.peakbytes())
+
+    def __len__(self):
+        return len(self._records)
+
+    def records(self, layer=None, stage=None):
+        """Return list of records, optionally for the provided layer name and/or stage"""
+        return [r for r in self._records if (layer is None or r['layer'] == layer) and (stage is None or r['stage'] == stage)]
+
+    def layers(self):
+        return list(dict.fromkeys([r['layer'] for r in self._records]))
+
+    def stages(self):
+        return list(dict.fromkeys([r['stage'] for r in self._records]))
+
+    def seconds(self, layer=None, stage=None):
+        """Total wall time in seconds"""
+        return sum([r['seconds'] for r in self.records(layer, stage)])
+
+    def peakbytes(self, layer=None, stage=None):
+        """Largest peak traced memory in bytes of any record"""
+        return max([r['peakbytes'] for r in self.records(layer, stage)] + [0])
+
+    def summary(self):
+        """Return {layer:{stage:{'calls', 'seconds', 'peakbytes', ...}}}, with time summed over calls and other fields from the last call"""
+        d = {}
+        for r in self._records:
+            s = d.setdefault(r['layer'], {}).setdefault(r['stage'], {'calls':0, 'seconds':0.0, 'peakbytes':0})
+            s.update({k:v for (k,v) in r.items() if k not in ['layer', 'stage', 'seconds', 'peakbytes']})
+            (s['calls'], s['seconds'], s['peakbytes']) = (s['calls']+1, s['seconds']+r['seconds'], max(s['peakbytes'], r['peakbytes']))
+        return d
+
+    def table(self):
+        """Return a printable table of the summary"""
+        lines = ['%-16s %-10s %6s %10s %12s %12s %8s' % ('layer', 'stage', 'calls', 'seconds', 'peak MB', 'nnz', 'tiles')]
+        for (layer, stages) in self.summary().items():
+            for (stage, s) in stages.items():
+                lines.append('%-16s %-10s %6d %10.4f %12.1f %12s %8s' % (layer, stage, s['calls'], s['seconds'], s['peakbytes']/1E6, str(s.get('nnz', '')), str(s.get('tiles', ''))))
+        return '\n'.join(lines)
+
+    def json(self):
+        return json.dumps(self._records, default=int)
+
+    def save(self, outfile):
+        """Save records as JSON to outfile"""
+        with open(outfile, 'w') as f:
+            f.write(self.json())
+        return outfile
@@ -20,6 +20,7 @@ import itertools
 import tempfile
 import numba
 import numba.typed
+import numba.extending
 
 
 def mat2gray(x, dtype=np.float32):
@@ -119,97 +120,117 @@ def diagonal_affine_to_linear(A, bias=None, withinverse=False, dtype=np.float32)
         return L.astype(dtype)
     
 
-@numba.jit(nopython=True, parallel=False, nogil=True)
-def _sparse_toeplitz_conv2d(inshape, f, as_correlation, stride):
+@numba.jit(nopython=True, parallel=True, nogil=True)
+def _sparse_toeplitz_conv2d(inshape, f, bias, C_range, M_range, P_range, Q_range, stride, groups):
+    """Two pass (count, fill) CSR construction over output rows, with optional homogeneous bias column and last row if len(bias)>0"""
     (C,U,V) = inshape
-    (M,C,P,Q) = f.shape
-    C_range = range(0,C) if as_correlation else range(C-1, 0-1, -1)
-    M_range = range(0,M) if as_correlation else range(M-1, 0-1, -1)
-    P_range = range(-((P-1)//2), ((P-1)//2) + 1) if P%2==1 else range(-((P-1)//2), ((P-1)//2) + 2)
-    P_range = P_range if as_correlation else range(max(list(P_range))-1, min(list(P_range))-1, -1)
-    Q_range = range(-((Q-1)//2), ((Q-1)//2) + 1) if P%2==1 else range(-((Q-1)//2), ((Q-1)//2) + 2)
-    Q_range = Q_range if as_correlation else range(max(list(Q_range))-1, min(list(Q_range))-1, -1)
+    (M,C_group,P,Q) = f.shape
+    M_group = M // groups
     (U_div_stride, V_div_stride) = (U//stride, V//stride)
+    UV_div_stride = U_div_stride*V_div_stride
+    n_rows = M*UV_div_stride
+    has_bias = len(bias) > 0
     
-    rows = np.zeros(U_div_stride*V_div_stride*C*M*P*Q, dtype=np.int32)
-    cols = np.zeros(U_div_stride*V_div_stride*C*M*P*Q, dtype=np.int32)
-    vals = np.zeros(U_div_stride*V_div_stride*C*M*P*Q, dtype=np.float32)
-
-    # For every image_row
-    k_entry = 0
-    for (ku,u) in enumerate(np.arange(0,U,stride)):
-        # For every image_column
-        for (kv,v) in enumerate(np.arange(0,V,stride)):
-            # For every inchannel (transposed)
-            for (k_inchannel, c_inchannel) in enumerate(C_range):
-                # For every kernel_row (transposed)
-                for (i,p) in enumerate(P_range):
-                    if not ((u+p)>=0 and (u+p)<U):
-                        continue  
-                    # For every kernel_col (transposed)
-                    for (j,q) in enumerate(Q_range):
-                        # For every outchannel
-                        if ((v+q)>=0 and (v+q)<V):
-                            c = c_inchannel*U*V + (u+p)*V + (v+q)
-                            for (k_outchannel, c_outchannel) in enumerate(M_range):
-                                rows[k_entry] = int(c_outchannel*(U_div_stride)*(V_div_stride) + ku*(V_div_stride) + kv)
-                                cols[k_entry] = int(c)
-                                vals[k_entry] = float(f[k_outchannel,k_inchannel,i,j])
-                                k_entry += 1  # impure loop
-        
-    return (rows[0:k_entry], cols[0:k_entry], vals[0:k_entry])
-
-
-def sparse_toeplitz_conv2d(inshape, f, bias=None, as_correlation=True, stride=1, format='csr'):
-    """ Returns sparse toeplitz matrix (W) in coo format that is equivalent to per-channel pytorch conv2d (spatial correlation) of filter f with a given image with shape=inshape vectorized
+    # Count: the sparsity structure depends only on the output pixel, it is the same for every outchannel
+    indptr = np.zeros(n_rows + 1 + int(has_bias), dtype=np.int64)
+    for r in numba.prange(0, n_rows):
+        (u, v) = (((r % UV_div_stride) // V_div_stride)*stride, ((r % UV_div_stride) % V_div_stride)*stride)
+        (n_p, n_q) = (0, 0)
+        for p in P_range:
+            n_p += int((u+p)>=0 and (u+p)<U)
+        for q in Q_range:
+            n_q += int((v+q)>=0 and (v+q)<V)
+        indptr[r+1] = C_group*n_p*n_q + int(has_bias)
+    if has_bias:
+        indptr[n_rows+1] = 1  # homogeneous row
+    indptr = np.cumsum(indptr)
+
+    # Fill: every output row is independent
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    data = np.empty(indptr[-1], dtype=np.float32)
+    for r in numba.prange(0, n_rows):
+        c_outchannel = r // UV_div_stride
+        (u, v) = (((r % UV_div_stride) // V_div_stride)*stride, ((r % UV_div_stride) % V_div_stride)*stride)
+        k_outchannel = 0
+        for k in range(0, M):
+            if M_range[k] == c_outchannel:
+                k_outchannel = k
+        k_entry = indptr[r]
+        # For every inchannel in the group of this outchannel (transposed)
+        for (k_inchannel, c_groupchannel) in enumerate(C_range):
+            c_inchannel = (c_outchannel // M_group)*C_group + c_groupchannel
+            # For every kernel_row (transposed)
+            for (i,p) in enumerate(P_range):
+                if not ((u+p)>=0 and (u+p)<U):
+                    continue
+                # For every kernel_col (transposed)
+                for (j,q) in enumerate(Q_range):
+                    if ((v+q)>=0 and (v+q)<V):
+                        indices[k_entry] = c_inchannel*U*V + (u+p)*V + (v+q)
+                        data[k_entry] = f[k_outchannel,k_inchannel,i,j]
+                        k_entry += 1
+        if has_bias:
+            indices[k_entry] = C*U*V  # structural zero if bias is zero
+            data[k_entry] = bias[c_outchannel]
+    if has_bias:
+        indices[indptr[n_rows]] = C*U*V
+        data[indptr[n_rows]] = 1.0
+
+    return (indptr, indices, data)
+
+
+def sparse_toeplitz_conv2d(inshape, f, bias=None, as_correlation=True, stride=1, format='csr', groups=1):
+    """ Returns sparse toeplitz matrix (W) in csr format that is equivalent to per-channel pytorch conv2d (spatial correlation) of filter f with a given image with shape=inshape vectorized
         conv2d(img, f) == np.dot(W, img.flatten()), right multiplied
         Example usage: test_keynet.test_sparse_toeplitz_conv2d()
         
         input:
           -inshape=(inchannels, imageheight, imagewidth)
-          -f.shape = (outchannels, inchannels, kernelheight, kernelwidth)
+          -f.shape = (outchannels, inchannels//groups, kernelheight, kernelwidth)
+          -bias.shape = (outchannels,), if provided the toeplitz matrix is affine augmented to [W b; 0 1]
+          -groups:  number of blocked connections from inchannels to outchannels as in torch.nn.Conv2d, groups=inchannels for depthwise 
+
+        All entries in the support of the filter are stored, including zero valued filter coefficients, so that keyed matrices preserve the sparsity structure.
     """
 
     # Valid shapes
     assert(len(inshape) == 3 and len(f.shape) == 4)  # 3D tensor inshape=(inchannels, height, width)
-    assert(f.shape[1] == inshape[0])  # equal inchannels
+    assert(inshape[0] % groups == 0 and f.shape[0] % groups == 0)  # channels divisible by groups
+    assert(f.shape[1]*groups == inshape[0])  # equal inchannels
     assert(f.shape[2]==f.shape[3] and f.shape[2]%2 == 1)  # filter is square, odd (FIXME)
     if bias is not None:
         assert(len(bias.shape) == 1 and bias.shape[0] == f.shape[0])  # filter and bias have composable shapes
     (C,U,V) = inshape
-    (M,C,P,Q) = f.shape
-
-    # Sparse matrix with optional bias and affine augmentation             
-    (row_ind, col_ind, data) = _sparse_toeplitz_conv2d(inshape, f, as_correlation, stride)
-    offset = np.abs(np.min(data))+1.0  # preserve sparsity structure for zero coefficient elements
-    data += offset  
-    A = scipy.sparse.coo_matrix((data, (row_ind, col_ind)), shape=(M*(U//stride)*(V//stride), C*U*V))
-    A.data -= offset  # restore original weights
+    (M,C_group,P,Q) = f.shape
 
-    # Optional bias and affine augmentation         
-    if bias is not None:
-        (C,U,V) = inshape                
-        UV = (U//stride)*(V//stride)
-        offset = np.abs(np.min(bias)) + 1.0
-        (row, col, val) = zip(*[(i*UV+j, 0, x+offset) for (i,x) in enumerate(bias) for j in range(0, UV)])  # preserve sparsity structure (+1)
-        lastcol = scipy.sparse.coo_matrix( (val, (row, col)), shape=(A.shape[0], 1))
-        lastcol.data -= offset  # restore original bias
-        lastrow = scipy.sparse.coo_matrix( ([1], ([0], [A.shape[1]])), shape=(1, A.shape[1]+1), dtype=np.float32)
-        A = scipy.sparse.vstack( (scipy.sparse.hstack( (A, lastcol)), lastrow) )            
+    # Filter support, transposed for convolution 
+    C_range = range(0,C_group) if as_correlation else range(C_group-1, 0-1, -1)
+    M_range = range(0,M) if as_correlation else range(M-1, 0-1, -1)
+    P_range = range(-((P-1)//2), ((P-1)//2) + 1) if P%2==1 else range(-((P-1)//2), ((P-1)//2) + 2)
+    P_range = P_range if as_correlation else range(max(list(P_range))-1, min(list(P_range))-1, -1)
+    Q_range = range(-((Q-1)//2), ((Q-1)//2) + 1) if P%2==1 else range(-((Q-1)//2), ((Q-1)//2) + 2)
+    Q_range = Q_range if as_correlation else range(max(list(Q_range))-1, min(list(Q_range))-1, -1)
+    (C_range, M_range, P_range, Q_range) = [np.array(list(r), dtype=np.int64) for r in (C_range, M_range, P_range, Q_range)]
 
-    if format == 'csr':
-        A = A.tocsr()  # indices not sorted
+    # Sparse matrix with optional bias and affine augmentation             
+    b = np.asarray(bias, dtype=np.float32) if bias is not None else np.zeros(0, dtype=np.float32)
+    (indptr, indices, data) = _sparse_toeplitz_conv2d(tuple([int(d) for d in inshape]), np.asarray(f, dtype=np.float32), b, C_range, M_range, P_range, Q_range, int(stride), int(groups))
+    shape = (M*(U//stride)*(V//stride), C*U*V) if bias is None else (M*(U//stride)*(V//stride)+1, C*U*V+1)
+    if indptr[-1] < np.iinfo(np.int32).max:
+        indptr = indptr.astype(np.int32)
+    else:
+        indices = indices.astype(np.int64)
+    A = scipy.sparse.csr_matrix( (data, indices, indptr), shape=shape)  # no copy, explicit zeros are preserved
 
-    return A
+    return A if format == 'csr' else A.asformat(format)
 
 
 def sparse_toeplitz_avgpool2d(inshape, filtershape, stride):
+    """Average pooling is a depthwise convolution with a constant filter, filtershape=(outchannels, inchannels, kernelheight, kernelwidth) with outchannels==inchannels"""
     (outchannel, inchannel, filtersize, filtersize) = filtershape
-    (M,U,V) = (inshape)
-    F = np.zeros(filtershape, dtype=np.float32)
-    for k in range(0,outchannel):
-        F[k,k,:,:] = 1.0 / (filtersize*filtersize)
-    return sparse_toeplitz_conv2d(inshape, F, bias=np.zeros(outchannel, dtype=np.float32), stride=stride)
+    assert outchannel == inchannel and inchannel == inshape[0], "Average pooling must preserve channels"
+    F = np.ones( (outchannel, 1, filtersize, filtersize), dtype=np.float32) / (filtersize*filtersize)
+    return sparse_toeplitz_conv2d(inshape, F, bias=np.zeros(outchannel, dtype=np.float32), stride=stride, groups=inchannel)
 
 
 def sparse_block_diagonal(mats, shape=None, format='coo', dtype=np.float32):
@@ -371,6 +392,549 @@ def is_scipy_sparse(A):
     return scipy.sparse.issparse(A)
 
 
+@numba.jit(nopython=True, parallel=False, nogil=True)
+def _csr_monomial_rows(indptr, indices, data, n_cols):
+    """Return (True, cols, vals) if every row of the CSR matrix has at most one nonzero excluding the last column, such that row i has value vals[i] at column cols[i] (cols[i]=-1 if empty)"""
+    n_rows = len(indptr)-1
+    (cols, vals) = (np.full(n_rows, -1, dtype=np.int64), np.zeros(n_rows, dtype=data.dtype))
+    for i in range(0, n_rows):
+        for k in range(indptr[i], indptr[i+1]):
+            if indices[k] != n_cols-1:
+                if cols[i] >= 0:
+                    return (False, cols, vals)
+                (cols[i], vals[i]) = (indices[k], data[k])
+    return (True, cols, vals)
+
+
+@numba.jit(nopython=True, parallel=False, nogil=True)
+def _csr_split_column(indptr, indices, data, n_rows, col, b):
+    """In place, move column col of the first n_rows rows of the CSR matrix into dense b, compacting indices, data and indptr[0:n_rows+1].  Returns the remaining nonzeros."""
+    (n, k_start) = (0, indptr[0])
+    for i in range(0, n_rows):
+        (k_end, indptr[i]) = (indptr[i+1], n)
+        for k in range(k_start, k_end):
+            if indices[k] == col:
+                b[i] += data[k]
+            else:
+                (indices[n], data[n]) = (indices[k], data[k])
+                n += 1
+        k_start = k_end
+    indptr[n_rows] = n
+    return n
+
+
+@numba.jit(nopython=True, parallel=True, nogil=True)
+def _csr_row_gather(a_cols, a_vals, a_last, indptr, indices, data, dtype):
+    """C = A_r*B + a*B[-1,:] where row i of A_r is a_vals[i] at column a_cols[i], and a=a_last is the last column of A"""
+    n_rows = len(a_cols)
+    (k_last_start, k_last_end) = (indptr[len(indptr)-2], indptr[len(indptr)-1])  # last row of B
+    c_indptr = np.zeros(n_rows+1, dtype=np.int64)
+    for i in numba.prange(0, n_rows):
+        n = 0 if a_cols[i] < 0 else indptr[a_cols[i]+1] - indptr[a_cols[i]]
+        if a_last[i] != 0:
+            for kl in range(k_last_start, k_last_end):
+                found = False
+                if a_cols[i] >= 0:
+                    for k in range(indptr[a_cols[i]], indptr[a_cols[i]+1]):
+                        found = found or (indices[k] == indices[kl])
+                n += int(not found)
+        c_indptr[i+1] = n
+    c_indptr = np.cumsum(c_indptr)
+    c_indices = np.empty(c_indptr[-1], dtype=indices.dtype)
+    c_data = np.zeros(c_indptr[-1], dtype=dtype)
+    for i in numba.prange(0, n_rows):
+        (n, j) = (c_indptr[i], a_cols[i])
+        if j >= 0:
+            for k in range(indptr[j], indptr[j+1]):
+                c_indices[n] = indices[k]
+                c_data[n] = a_vals[i]*data[k]
+                n += 1
+        if a_last[i] != 0:
+            for kl in range(k_last_start, k_last_end):
+                found = False
+                for k in range(c_indptr[i], n):
+                    if c_indices[k] == indices[kl]:
+                        c_data[k] += a_last[i]*data[kl]
+                        found = True
+                if not found:
+                    c_indices[n] = indices[kl]
+                    c_data[n] = a_last[i]*data[kl]
+                    n += 1
+    return (c_indptr, c_indices, c_data)
+
+
+@numba.jit(nopython=True, parallel=True, nogil=True)
+def _csr_column_remap(indptr, indices, data, b_cols, b_vals, b_last, n_cols, dtype):
+    """C = A*B_r + (A*b)*e^T where row k of B_r is b_vals[k] at column b_cols[k], and b=b_last is the last column of B"""
+    n_rows = len(indptr)-1
+    c_indptr = np.zeros(n_rows+1, dtype=np.int64)
+    for i in numba.prange(0, n_rows):
+        (n, has_bias) = (0, False)
+        for k in range(indptr[i], indptr[i+1]):
+            n += int(b_cols[indices[k]] >= 0)
+            has_bias = has_bias or (b_last[indices[k]] != 0)
+        c_indptr[i+1] = n + int(has_bias)
+    c_indptr = np.cumsum(c_indptr)
+    c_indices = np.empty(c_indptr[-1], dtype=indices.dtype)
+    c_data = np.zeros(c_indptr[-1], dtype=dtype)
+    for i in numba.prange(0, n_rows):
+        n = c_indptr[i]
+        for k in range(indptr[i], indptr[i+1]):
+            if b_cols[indices[k]] >= 0:
+                c_indices[n] = b_cols[indices[k]]
+                c_data[n] = data[k]*b_vals[indices[k]]
+                n += 1
+        if n < c_indptr[i+1]:
+            c_indices[n] = n_cols-1
+            for k in range(indptr[i], indptr[i+1]):
+                c_data[n] += data[k]*b_last[indices[k]]
+    return (c_indptr, c_indices, c_data)
+
+
+@numba.jit(nopython=True, parallel=True, nogil=True)
+def _csr_spgemm(a_indptr, a_indices, a_data, b_indptr, b_indices, b_data, n_cols, n_chunks, dtype, index_dtype):
+    """C=A*B for CSR matrices, row partitioned into n_chunks in parallel, with the same accumulation order and output order as scipy csr_matmat"""
+    n_rows = len(a_indptr)-1
+    chunksize = (n_rows + n_chunks - 1) // n_chunks
+    c_nnz = np.zeros(n_rows+1, dtype=np.int64)
+
+    # Symbolic: upper bound on nonzeros per row
+    for c in numba.prange(0, n_chunks):
+        mask = np.full(n_cols, -1, dtype=np.int64)
+        for i in range(c*chunksize, min((c+1)*chunksize, n_rows)):
+            n = 0
+            for jj in range(a_indptr[i], a_indptr[i+1]):
+                j = a_indices[jj]
+                for kk in range(b_indptr[j], b_indptr[j+1]):
+                    if mask[b_indices[kk]] != i:
+                        mask[b_indices[kk]] = i
+                        n += 1
+            c_nnz[i+1] = n
+    c_indptr_max = np.cumsum(c_nnz)
+    c_indices = np.empty(c_indptr_max[-1], dtype=index_dtype)
+    c_data = np.empty(c_indptr_max[-1], dtype=dtype)
+
+    # Numeric: accumulate with linked list of nonzero columns, drop zeros 
+    for c in numba.prange(0, n_chunks):
+        (nextcol, sums) = (np.full(n_cols, -1, dtype=np.int64), np.zeros(n_cols, dtype=dtype))
+        for i in range(c*chunksize, min((c+1)*chunksize, n_rows)):
+            (head, length) = (-2, 0)
+            for jj in range(a_indptr[i], a_indptr[i+1]):
+                (j, v) = (a_indices[jj], a_data[jj])
+                for kk in range(b_indptr[j], b_indptr[j+1]):
+                    k = b_indices[kk]
+                    sums[k] += v*b_data[kk]
+                    if nextcol[k] == -1:
+                        nextcol[k] = head
+                        head = k
+                        length += 1
+            n = c_indptr_max[i]
+            for jj in range(0, length):
+                if sums[head] != 0:
+                    c_indices[n] = head
+                    c_data[n] = sums[head]
+                    n += 1
+                k = head
+                head = nextcol[head]
+                (nextcol[k], sums[k]) = (-1, 0)
+            c_nnz[i+1] = n - c_indptr_max[i]
+    c_indptr = np.cumsum(c_nnz)
+    if c_indptr[-1] == c_indptr_max[-1]:
+        return (c_indptr, c_indices, c_data)
+
+    # Compact rows with dropped zeros
+    (c_indices_compact, c_data_compact) = (np.empty(c_indptr[-1], dtype=index_dtype), np.empty(c_indptr[-1], dtype=dtype))
+    for i in numba.prange(0, n_rows):
+        for k in range(0, c_indptr[i+1]-c_indptr[i]):
+            c_indices_compact[c_indptr[i]+k] = c_indices[c_indptr_max[i]+k]
+            c_data_compact[c_indptr[i]+k] = c_data[c_indptr_max[i]+k]
+    return (c_indptr, c_indices_compact, c_data_compact)
+
+
+def sparse_spgemm(A, B):
+    """Return sparse matrix A*B as csr_matrix using the keynet.globals.spgemm() backend.  The 'numba' backend is row parallel over numba threads and bit-identical to 'scipy'"""
+    assert A.shape[1] == B.shape[0], "Non-conformal shape for A=%s, B=%s" % (str(A.shape), str(B.shape))
+    if keynet.globals.spgemm() == 'scipy':
+        return scipy.sparse.csr_matrix(A.dot(B))
+    (A, B) = (scipy.sparse.csr_matrix(A), scipy.sparse.csr_matrix(B))
+    dtype = np.result_type(A.dtype, B.dtype)
+    index_dtype = np.int32 if max(A.indices.dtype.itemsize, B.indices.dtype.itemsize) == 4 and B.shape[1] < np.iinfo(np.int32).max else np.int64
+    (indptr, indices, data) = _csr_spgemm(A.indptr, A.indices, A.data.astype(dtype, copy=False), B.indptr, B.indices, B.data.astype(dtype, copy=False), 
+                                          B.shape[1], max(1, min(A.shape[0], 4*numba.get_num_threads())), dtype, index_dtype)
+    index_dtype = np.int32 if max(len(indices), B.shape[1]) < np.iinfo(np.int32).max else np.int64
+    return scipy.sparse.csr_matrix( (data, indices.astype(index_dtype, copy=False), indptr.astype(index_dtype, copy=False)), shape=(A.shape[0], B.shape[1]))
+
+
+def sparse_key_dot(A, B):
+    """Return sparse matrix A*B, where A or B are keys composed of permutations, diagonals and a homogeneous bias column.
+
+       Write A = A_r + a*e^T where a is the last (bias) column of A.  If A_r has at most one nonzero per row, then A_r*B is a row gather and scale of B 
+       and a*e^T*B adds a times the last row of B.  Otherwise, if B_r has at most one nonzero per row, then A*B_r is a column remap and scale of A 
+       and A*b is a matrix-vector product.  Otherwise, this falls back to general sparse matrix multiplication.  All cases are O(nnz) except the 
+       fallback.  Zeros are eliminated as in scipy matrix multiplication. 
+    """
+    assert A.shape[1] == B.shape[0], "Non-conformal shape for A=%s, B=%s" % (str(A.shape), str(B.shape))
+    if isinstance(A, AffineKey):
+        return A.dot(B)  # key composition or structured left multiply
+    elif isinstance(B, AffineKey):
+        return B.rdot(A)  # structured right multiply 
+    (A, B) = (scipy.sparse.csr_matrix(A), scipy.sparse.csr_matrix(B))
+    dtype = np.result_type(A.dtype, B.dtype)
+
+    (is_monomial, cols, vals) = _csr_monomial_rows(A.indptr, A.indices, A.data, A.shape[1])
+    if is_monomial:
+        a_last = A[:, -1].toarray().flatten().astype(dtype)
+        (indptr, indices, data) = _csr_row_gather(cols, vals.astype(dtype), a_last, B.indptr, B.indices, B.data.astype(dtype, copy=False), dtype)
+        C = scipy.sparse.csr_matrix( (data, indices, indptr), shape=(A.shape[0], B.shape[1]))
+    else:
+        (is_monomial, cols, vals) = _csr_monomial_rows(B.indptr, B.indices, B.data, B.shape[1])
+        if is_monomial:
+            b_last = B[:, -1].toarray().flatten().astype(dtype)
+            (indptr, indices, data) = _csr_column_remap(A.indptr, A.indices, A.data.astype(dtype, copy=False), cols, vals.astype(dtype), b_last, B.shape[1], dtype)
+            C = scipy.sparse.csr_matrix( (data, indices, indptr), shape=(A.shape[0], B.shape[1]))
+            if len(np.unique(cols[cols>=0])) != np.sum(cols>=0):
+                C.sum_duplicates()  # not a generalized permutation 
+        else:
+            return sparse_spgemm(A, B)  # general SpGEMM
+
+    C.eliminate_zeros()
+    return C
+
+
+def sparse_key_compose(*mats):
+    """Return the product mats[0]*mats[1]*...*mats[-1] computed left to right with sparse_key_dot, skipping None (e.g. optional outkey), such that keying a layer is sparse_key_compose(A, W, Ainv)"""
+    mats = [M for M in mats if M is not None]
+    assert len(mats) > 0
+    C = mats[0]
+    for M in mats[1:]:
+        C = sparse_key_dot(C, M)
+    return C
+
+
+def dense_key_compose(A, W, Ainv, dtype=np.float32):
+    """Return A*W*Ainv as a C-contiguous dense array of dtype for a dense layer matrix W (e.g. nn.Linear), where the keys A and Ainv are AffineKey, scipy sparse or None (e.g. optional outkey).
+       The keys multiply W as sparse*dense and dense*sparse products, so that W is never converted to a sparse matrix.
+    """
+    W = np.asarray(W, dtype=dtype)
+    if A is not None:
+        W = np.asarray(A.dot(W) if isinstance(A, AffineKey) else scipy.sparse.csr_matrix(A).dot(W), dtype=dtype)
+    if Ainv is not None:
+        W = np.asarray(Ainv.rdot(W) if isinstance(Ainv, AffineKey) else scipy.sparse.csr_matrix(Ainv).T.dot(W.T).T, dtype=dtype)  # W*Ainv = (Ainv^T*W^T)^T
+    return np.ascontiguousarray(W)
+
+
+def _sparse_key_compose_panel(mats):
+    return sparse_key_compose(*mats)
+
+
+def _sparse_key_panel_args(A, W, Ainv, i, j):
+    """Return the arguments of sparse_key_compose for the row panel A[i:j]*W*Ainv, where W is restricted to the rows used by the nonzero columns of A[i:j]"""
+    if A is None:
+        return (W[i:j], Ainv)
+    Ap = A[i:j]
+    cols = np.unique(Ap.indices)
+    Ap = scipy.sparse.csr_matrix( (Ap.data, np.searchsorted(cols, Ap.indices), Ap.indptr), shape=(j-i, len(cols)))  # compact columns
+    return (Ap, W[cols], Ainv)
+
+
+def sparse_key_compose_rows(A, W, Ainv, i, j):
+    """Return rows i:j of sparse_key_compose(A, W, Ainv) without keying the other rows"""
+    W = scipy.sparse.csr_matrix(W)
+    A = (A.tocsr() if isinstance(A, AffineKey) else scipy.sparse.csr_matrix(A)) if A is not None else None
+    return _sparse_key_compose_panel(_sparse_key_panel_args(A, W, Ainv, i, j)).tocsr()
+
+
+def sparse_key_compose_rowpanels(A, W, Ainv, panels, f_map=map):
+    """Return sparse_key_compose(A, W, Ainv) computed as independent row panels A[i:j]*W*Ainv stacked vertically, where each panel only includes the rows of W 
+       used by the nonzero columns of A[i:j].  Panels are computed with f_map(f, iterable) which is builtin map (serial) or a distributed map (e.g. dask client.map)
+    """
+    W = scipy.sparse.csr_matrix(W)
+    A = (A.tocsr() if isinstance(A, AffineKey) else scipy.sparse.csr_matrix(A)) if A is not None else None
+    n = A.shape[0] if A is not None else W.shape[0]
+    rows = np.unique(np.linspace(0, n, max(1, panels)+1).astype(np.int64))
+    args = [_sparse_key_panel_args(A, W, Ainv, i, j) for (i,j) in zip(rows[0:-1], rows[1:])]
+    return scipy.sparse.vstack(list(f_map(_sparse_key_compose_panel, args)), format='csr')
+
+
+class MonomialKey(object):
+    """Affine key y = gain*x[perm] + bias for an n-dimensional x, stored as vectors where None is identity (perm=arange(n), gain=1, bias=0).
+       This is the homogeneous (n+1)x(n+1) matrix [D*P b; 0 1] for permutation matrix P, diagonal D and bias b, so that permutations, 
+       gains and biases (and their compositions and inverses) are O(n).
+    """
+    def __init__(self, n, perm=None, gain=None, bias=None, dtype=np.float32):
+        assert perm is None or len(perm) == n
+        assert gain is None or len(gain) == n
+        assert bias is None or len(bias) == n
+        self._n = n
+        self._perm = np.asarray(perm, dtype=np.int64) if perm is not None else None
+        self._gain = np.asarray(gain, dtype=dtype).flatten() if gain is not None else None
+        self._bias = np.asarray(bias, dtype=dtype).flatten() if bias is not None else None
+        self.dtype = dtype
+
+    def __repr__(self):
+        return '<keynet.MonomialKey: n=%d%s%s%s>' % (self._n, ', perm' if self._perm is not None else '', ', gain' if self._gain is not None else '', ', bias' if self._bias is not None else '')
+
+    def is_identity(self):
+        return self._perm is None and self._gain is None and self._bias is None
+
+    def _homogeneous(self):
+        """Return (cols, vals, lastcol) for the rows of the homogeneous matrix for sparse_key_dot kernels"""
+        cols = np.append(self._perm if self._perm is not None else np.arange(self._n), -1)
+        vals = np.append(self._gain if self._gain is not None else np.ones(self._n, dtype=self.dtype), 0).astype(self.dtype)
+        last = np.append(self._bias if self._bias is not None else np.zeros(self._n, dtype=self.dtype), 1).astype(self.dtype)
+        return (cols, vals, last)
+
+    def compose(self, other):
+        """Return MonomialKey for self*other, such that y = self(other(x))"""
+        assert isinstance(other, MonomialKey) and other._n == self._n
+        take = lambda v: v[self._perm] if (v is not None and self._perm is not None) else v
+        perm = take(other._perm) if other._perm is not None else self._perm
+        gain = take(other._gain)
+        gain = gain*self._gain if (gain is not None and self._gain is not None) else (gain if gain is not None else self._gain)
+        bias = take(other._bias)
+        bias = bias*self._gain if (bias is not None and self._gain is not None) else bias
+        bias = bias+self._bias if (bias is not None and self._bias is not None) else (bias if bias is not None else self._bias)
+        return MonomialKey(self._n, perm, gain, bias, dtype=self.dtype)
+
+    def inverse(self):
+        """x[perm] = (y-bias)/gain"""
+        perm = np.argsort(self._perm) if self._perm is not None else None
+        take = lambda v: v[perm] if (v is not None and perm is not None) else v
+        gain = 1.0 / take(self._gain).astype(np.float64) if self._gain is not None else None
+        bias = -take(self._bias)*(gain if gain is not None else 1) if self._bias is not None else None
+        return MonomialKey(self._n, perm, gain, bias, dtype=self.dtype)
+
+    def dot(self, X):
+        """Return self*X for homogeneous (n+1)xk dense or sparse X"""
+        if is_scipy_sparse(X):
+            X = X.tocsr()
+            (cols, vals, last) = self._homogeneous()
+            dtype = np.result_type(self.dtype, X.dtype)
+            (indptr, indices, data) = _csr_row_gather(cols, vals.astype(dtype), last.astype(dtype), X.indptr, X.indices, X.data.astype(dtype, copy=False), dtype)
+            Y = scipy.sparse.csr_matrix( (data, indices, indptr), shape=X.shape)
+            Y.eliminate_zeros()
+            return Y
+        X = np.asarray(X)
+        Y = np.array(X[:-1][self._perm] if self._perm is not None else X[:-1], dtype=np.result_type(self.dtype, X.dtype))
+        Y = Y*(self._gain.reshape(-1, *[1]*(X.ndim-1))) if self._gain is not None else Y
+        Y = Y+np.multiply.outer(self._bias, X[-1]) if self._bias is not None else Y
+        return np.concatenate( (Y, X[-1:]), axis=0)
+
+    def rdot(self, X):
+        """Return X*self for homogeneous kx(n+1) dense or sparse X"""
+        if is_scipy_sparse(X):
+            X = X.tocsr()
+            (cols, vals, last) = self._homogeneous()
+            dtype = np.result_type(self.dtype, X.dtype)
+            (indptr, indices, data) = _csr_column_remap(X.indptr, X.indices, X.data.astype(dtype, copy=False), cols, vals.astype(dtype), last.astype(dtype), self._n+1, dtype)
+            Y = scipy.sparse.csr_matrix( (data, indices, indptr), shape=X.shape)
+            Y.eliminate_zeros()
+            return Y
+        X = np.asarray(X)
+        Y = np.array(X, dtype=np.result_type(self.dtype, X.dtype))
+        Y[:, -1] += X[:, :-1].dot(self._bias) if self._bias is not None else 0
+        Z = X[:, :-1]*self._gain if self._gain is not None else X[:, :-1]
+        if self._perm is not None:
+            Y[:, self._perm] = Z
+        else:
+            Y[:, :-1] = Z
+        return Y
+
+    def tocsr(self):
+        return self.dot(scipy.sparse.eye(self._n+1, dtype=self.dtype, format='csr'))
+
+    def to_arrays(self):
+        return dict({'type':np.array('monomial'), 'n':np.array(self._n), 'dtype':np.array(np.dtype(self.dtype).name)}, 
+                    **{k:v for (k,v) in (('perm', self._perm), ('gain', self._gain), ('bias', self._bias)) if v is not None})
+
+
+def _key_asformat(M, format, blocksizes):
+    """Key matrices are square and unpadded, so BSR blocksizes must evenly divide the key"""
+    (format, blocksize) = sparse_best_format(M, blocksizes, formats=('csr', 'bsr', 'dia'), pad=False) if format == 'auto' else (format, blocksizes[0] if format == 'bsr' else None)
+    assert format in ['csr', 'bsr', 'dia'] and (blocksize is None or M.shape[0] % blocksize == 0), "Invalid key format"
+    return M if M.format == format and (blocksize is None or M.blocksize == (blocksize, blocksize)) else sparse_asformat(M, format, blocksize)
+
+
+class BlockDiagonalKey(object):
+    """Linear key y = diag(B,B,...,B)*x for an nxn block B repeated along the diagonal of an n-dimensional x, stored as the block and its inverse"""
+    def __init__(self, n, B, Binv):
+        assert B.shape[0] == B.shape[1] and B.shape == Binv.shape and n % B.shape[0] == 0, "Block must be square and evenly divide n=%d" % n
+        (self._n, self._B, self._Binv) = (n, scipy.sparse.csr_matrix(B), scipy.sparse.csr_matrix(Binv))
+        self.dtype = self._B.dtype
+
+    def __repr__(self):
+        return '<keynet.BlockDiagonalKey: n=%d, blockshape=%s>' % (self._n, str(self._B.shape))
+
+    def is_identity(self):
+        return False
+
+    def inverse(self):
+        return BlockDiagonalKey(self._n, self._Binv, self._B)
+
+    def _linear(self):
+        return scipy.sparse.kron(scipy.sparse.eye(self._n // self._B.shape[0], dtype=self.dtype), self._B, format='csr')
+
+    def asformat(self, format='auto', blocksizes=(2,4,8,16,32,64)):
+        (self._B, self._Binv) = [_key_asformat(B, format, blocksizes) for B in (self._B, self._Binv)]
+        return self
+
+    def dot(self, X):
+        if is_scipy_sparse(X):
+            X = X.tocsr()
+            return scipy.sparse.vstack( (sparse_spgemm(self._linear(), X[:-1]), X[-1]), format='csr')
+        X = np.asarray(X)
+        b = self._B.shape[0]
+        Y = self._B.dot(X[:-1].reshape(-1, b, *X.shape[1:]).swapaxes(0,1).reshape(b, -1))  # one product over all blocks and columns
+        Y = Y.reshape(b, -1, *X.shape[1:]).swapaxes(0,1).reshape(X[:-1].shape)
+        return np.concatenate( (Y, X[-1:]), axis=0)
+
+    def rdot(self, X):
+        if is_scipy_sparse(X):
+            X = X.tocsr()
+            return scipy.sparse.hstack( (sparse_spgemm(X[:, :-1], self._linear()), X[:, -1]), format='csr')
+        X = np.asarray(X)
+        b = self._B.shape[0]
+        Y = self._B.T.dot(X[:, :-1].reshape(-1, b).T).T.reshape(X.shape[0], -1)  # (X*B) per block = (B^T*X^T)^T
+        return np.concatenate( (Y, X[:, -1:]), axis=1)
+
+    def tocsr(self):
+        return self.dot(scipy.sparse.eye(self._n+1, dtype=self.dtype, format='csr'))
+
+    def to_arrays(self):
+        return dict({'type':np.array('blockdiagonal'), 'n':np.array(self._n)}, **_prefixed('B', SparseMatrix(self._B).to_arrays()), **_prefixed('Binv', SparseMatrix(self._Binv).to_arrays()))
+
+
+class SparseKey(object):
+    """Linear key y = M*x for a general nxn sparse matrix M, stored with its inverse"""
+    def __init__(self, M, Minv):
+        assert M.shape[0] == M.shape[1] and M.shape == Minv.shape
+        (self._n, self._M, self._Minv) = (M.shape[0], scipy.sparse.csr_matrix(M), scipy.sparse.csr_matrix(Minv))
+        self.dtype = self._M.dtype
+
+    def __repr__(self):
+        return '<keynet.SparseKey: n=%d, nnz=%d>' % (self._n, self._M.nnz)
+
+    def is_identity(self):
+        return False
+
+    def inverse(self):
+        return SparseKey(self._Minv, self._M)
+
+    def asformat(self, format='auto', blocksizes=(2,4,8,16,32,64)):
+        (self._M, self._Minv) = [_key_asformat(M, format, blocksizes) for M in (self._M, self._Minv)]
+        return self
+
+    def dot(self, X):
+        if is_scipy_sparse(X):
+            X = X.tocsr()
+            return scipy.sparse.vstack( (sparse_spgemm(self._M, X[:-1]), X[-1]), format='csr')
+        X = np.asarray(X)
+        return np.concatenate( (self._M.dot(X[:-1]), X[-1:]), axis=0)
+
+    def rdot(self, X):
+        if is_scipy_sparse(X):
+            X = X.tocsr()
+            return scipy.sparse.hstack( (sparse_spgemm(X[:, :-1], self._M), X[:, -1]), format='csr')
+        X = np.asarray(X)
+        return np.concatenate( (self._M.T.dot(X[:, :-1].T).T, X[:, -1:]), axis=1)
+
+    def tocsr(self):
+        return self.dot(scipy.sparse.eye(self._n+1, dtype=self.dtype, format='csr'))
+
+    def to_arrays(self):
+        return dict({'type':np.array('sparse')}, **_prefixed('M', SparseMatrix(self._M).to_arrays()), **_prefixed('Minv', SparseMatrix(self._Minv).to_arrays()))
+
+
+def sparse_to_key(M, Minv):
+    """Return MonomialKey if nxn sparse matrix M is a scaled permutation, otherwise SparseKey"""
+    M = scipy.sparse.csr_matrix(M)
+    (is_monomial, cols, vals) = _csr_monomial_rows(M.indptr, M.indices, M.data, M.shape[1]+1)
+    if is_monomial and np.all(cols >= 0) and len(np.unique(cols)) == len(cols):
+        return MonomialKey(M.shape[0], perm=cols if np.any(cols != np.arange(len(cols))) else None, gain=vals if np.any(vals != 1) else None, dtype=M.dtype)
+    return SparseKey(M, Minv)
+
+
+class AffineKey(object):
+    """Compact homogeneous (n+1)x(n+1) affine key A = F[0]*F[1]*...*F[-1], stored as a product of factors (MonomialKey, BlockDiagonalKey, SparseKey).
+    
+       Identity factors are skipped and adjacent monomial factors are merged, so a key composed of permutations, gains and biases is stored as 
+       O(n) vectors.  Keys support dot (self*X), rdot (X*self), inverse and composition with other keys, and are materialized as a scipy sparse 
+       matrix only on request with tocsr().  sparse_key_dot() and sparse_key_compose() dispatch to these methods.
+    """
+    def __init__(self, n, factors=None):
+        self._n = n
+        self.shape = (n+1, n+1)
+        self.ndim = 2
+        self._factors = []
+        for f in (factors if factors is not None else []):
+            for g in (f._factors if isinstance(f, AffineKey) else [f]):
+                assert g._n == n, "Invalid factor shape"
+                if g.is_identity():
+                    continue  # skip
+                elif len(self._factors) > 0 and isinstance(self._factors[-1], MonomialKey) and isinstance(g, MonomialKey):
+                    self._factors[-1] = self._factors[-1].compose(g)  # merge
+                else:
+                    self._factors.append(g)
+        self.dtype = np.result_type(*[f.dtype for f in self._factors]) if len(self._factors) > 0 else np.float32
+
+    def __repr__(self):
+        return '<keynet.AffineKey: n=%d, factors=[%s]>' % (self._n, ', '.join([str(f) for f in self._factors]))
+
+    def factors(self):
+        return self._factors
+
+    def is_identity(self):
+        return len(self._factors) == 0
+
+    def inverse(self):
+        return AffineKey(self._n, [f.inverse() for f in reversed(self._factors)])
+
+    def dot(self, X):
+        """Return self*X, for X an AffineKey (returns composed AffineKey), scipy sparse (returns csr_matrix) or homogeneous dense (n+1)xk numpy array"""
+        assert X.shape[0] == self.shape[1], "Non-conformal shape"
+        if isinstance(X, AffineKey):
+            return AffineKey(self._n, self._factors + X._factors)
+        for f in reversed(self._factors):
+            X = f.dot(X)
+        return X.tocsr() if is_scipy_sparse(X) else X
+
+    def rdot(self, X):
+        """Return X*self, for X scipy sparse (returns csr_matrix) or homogeneous dense kx(n+1) numpy array"""
+        assert X.shape[1] == self.shape[0], "Non-conformal shape"
+        if isinstance(X, AffineKey):
+            return X.dot(self)
+        for f in self._factors:
+            X = f.rdot(X)
+        return X.tocsr() if is_scipy_sparse(X) else X
+
+    def torchdot(self, x_torch):
+        """Return self*x for homogeneous (n+1)xk torch tensor x, for use as a KeyedLayer weight"""
+        return torch.as_tensor(self.dot(x_torch.detach().numpy()).astype(np.float32))
+
+    def tocsr(self):
+        return self.dot(scipy.sparse.eye(self._n+1, dtype=self.dtype, format='csr'))
+
+    def tocoo(self):
+        return self.tocsr().tocoo()
+
+    def nnz(self):
+        return sum([(f._n if isinstance(f, MonomialKey) else (f._B.nnz if isinstance(f, BlockDiagonalKey) else f._M.nnz)) for f in self._factors])
+
+    def asformat(self, format='auto', blocksizes=(2,4,8,16,32,64)):
+        """Store the matrices of the BlockDiagonalKey and SparseKey factors in scipy format 'csr', 'bsr', 'dia' or 'auto' for the fewest bytes, which is used by dot() of dense arrays"""
+        for f in self._factors:
+            if isinstance(f, (BlockDiagonalKey, SparseKey)):
+                f.asformat(format, blocksizes)
+        return self
+
+    def to_arrays(self):
+        """Return dictionary of numpy arrays of the factors, such that key_from_arrays(self.to_arrays()) is equivalent to self"""
+        d = {'type':np.array('affine'), 'n':np.array(self._n)}
+        for (i,f) in enumerate(self._factors):
+            d.update(_prefixed(str(i), f.to_arrays()))
+        return d
+    
+
 def coo_range(A, rowrange, colrange):
     (rows, cols, vals) = zip(*[(i-rowrange[0], j-colrange[0], v) for (i,j,v) in zip(A.row, A.col, A.data) if i>=rowrange[0] and i<rowrange[1] and j>=colrange[0] and j<colrange[1]])
     offset = np.abs(np.min(vals)) + 1.0  
@@ -415,8 +979,187 @@ def spy(A, mindim=256, showdim=1024, range=None, eps=None):
         return vipy.image.Image(array=A_spy.astype(np.float32), colorspace='float').mat2gray().maxdim(showdim, interp='nearest').jet()
 
 
+
+PRECISION = ['float32', 'float16', 'bfloat16']
+_PRECISION_TABLE = {}
+
+
+def precision_table(precision):
+    """Return the float32 value of each of the 2^16 reduced precision 'float16' or 'bfloat16' bit patterns, so that upcasting is a table lookup"""
+    assert precision in ['float16', 'bfloat16'], "Invalid precision '%s'" % precision
+    if precision not in _PRECISION_TABLE:
+        bits = np.arange(0, 2**16, dtype=np.uint32)
+        _PRECISION_TABLE[precision] = bits.astype(np.uint16).view(np.float16).astype(np.float32) if precision == 'float16' else (bits << 16).view(np.float32)
+    return _PRECISION_TABLE[precision]
+
+
+def precision_encode(x, precision):
+    """Return numpy array or scipy sparse matrix x with values stored in precision.  Reduced precision 'float16' and 'bfloat16' (round to nearest even) values are stored as uint16 bit patterns"""
+    assert precision in PRECISION, "Invalid precision '%s' - must be %s" % (precision, str(PRECISION))
+    if is_scipy_sparse(x):
+        x = x.tocsr() if x.format not in ['csr', 'bsr', 'dia'] else x.copy()  # keep storage format
+        x.data = precision_encode(x.data, precision)
+        return x
+    x = np.asarray(x, dtype=np.float32)
+    if precision == 'float16':
+        return x.astype(np.float16).view(np.uint16)
+    elif precision == 'bfloat16':
+        u = x.view(np.uint32).astype(np.uint64)
+        return ((u + 0x7FFF + ((u >> 16) & 1)) >> 16).astype(np.uint16)
+    return x
+
+
+def precision_decode(x, precision):
+    """Return numpy array or scipy sparse matrix x stored with precision_encode() as float32"""
+    if precision == 'float32':
+        return x
+    elif is_scipy_sparse(x):
+        x = x.copy()
+        x.data = precision_table(precision)[x.data]
+        return x
+    return precision_table(precision)[x]
+
+
+def _decode(v, table):
+    pass
+
+
+@numba.extending.overload(_decode)
+def _decode_overload(v, table):
+    """Upcast reduced precision storage v (uint16) with the lookup table from precision_table(), or return v for float32 storage, resolved at compile time"""
+    if isinstance(v, numba.types.Integer):
+        return lambda v, table: table[v]
+    return lambda v, table: v
+
     
+@numba.jit(nopython=True, parallel=True, nogil=True)
+def _csr_dot_dense(indptr, indices, data, table, X, Y, rowblock, relu, bias):
+    """Y=A*X (or Y=max(A*X,0) if relu) for CSR matrix A and dense row major X and Y, parallel over blocks of rows.  Reduced precision data is upcast with table and accumulated in Y.dtype.
+       If bias is not empty, Y=A*X+bias*X[-1] for the homogeneous coordinate X[-1] of X, which is not referenced by A.
+    """
+    (n_rows, k) = (len(indptr)-1, X.shape[1])
+    for b in numba.prange(0, (n_rows + rowblock - 1) // rowblock):
+        for i in range(b*rowblock, min((b+1)*rowblock, n_rows)):
+            if k == 1:
+                acc = Y.dtype.type(0) if len(bias) == 0 else Y.dtype.type(bias[i]*X[X.shape[0]-1,0])  # single image, accumulate in register
+                for jj in range(indptr[i], indptr[i+1]):
+                    acc += _decode(data[jj], table)*X[indices[jj],0]
+                Y[i,0] = acc if (not relu or acc > 0) else 0
+            else:
+                for c in range(0, k):
+                    Y[i,c] = 0 if len(bias) == 0 else bias[i]*X[X.shape[0]-1,c]
+                for jj in range(indptr[i], indptr[i+1]):
+                    (j, v) = (indices[jj], _decode(data[jj], table))
+                    for c in range(0, k):
+                        Y[i,c] += v*X[j,c]
+                if relu:
+                    for c in range(0, k):
+                        Y[i,c] = max(Y[i,c], 0)
+    return Y
+
+
+def sparse_dot_dense(A, X, rowblock=256, out=None, relu=False, precision='float32', shape=None, bias=None):
+    """Return dense A*X for scipy sparse A and 2D numpy X using the parallel CSR kernel with keynet.globals.num_threads() threads.
+       Optionally write into preallocated row major out, and apply ReLU in place.  If A is stored with precision_encode(), the values are upcast on the fly and accumulated in float32.
+       BSR and DIA matrices use the scipy kernel for their format (float32 only, see SparseMatrix.reduce_precision()), where shape is the shape of A without the zero padding of sparse_asformat() (default A.shape).  Dense numpy A uses GEMM, upcast from reduced precision in panels of rowblock rows.
+       If bias is provided, A is the linear part of the homogeneous matrix [A bias; 0 1] (see SparseMatrix.affine()) and this returns [A*X[:-1] + bias*X[-1]; X[-1]] for homogeneous X.
+    """
+    (M, N) = shape if shape is not None else A.shape
+    (R, K) = (M + 1 if bias is not None else M, N + 1 if bias is not None else N)  # rows of output, rows of X
+    assert (is_scipy_sparse(A) or isinstance(A, np.ndarray)) and X.ndim == 2 and K == X.shape[0] and A.shape[1] >= N
+    if isinstance(A, np.ndarray) or A.format in ['bsr', 'dia']:
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        out = np.empty( (R, X.shape[1]), dtype=np.float32) if out is None else out
+        if isinstance(A, np.ndarray) and precision != 'float32':
+            panel = np.empty( (min(rowblock, M), N), dtype=np.float32)  # upcast rowblock rows at a time
+            for i in range(0, M, rowblock):
+                j = min(i+rowblock, M)
+                if precision == 'float16':
+                    panel[0:j-i] = A[i:j, 0:N].view(np.float16)
+                else:
+                    bits = panel[0:j-i].view(np.uint32)  # bfloat16 is the high half of float32, in place without index temporaries
+                    bits[:] = A[i:j, 0:N]
+                    bits <<= 16
+                np.dot(panel[0:j-i], X[0:N], out=out[i:j])  # GEMM
+        elif isinstance(A, np.ndarray):
+            np.dot(np.asarray(A, dtype=np.float32), X[0:N], out=out[0:M])  # GEMM
+        else:
+            X_pad = np.concatenate( (X[0:N], np.zeros( (A.shape[1]-N, X.shape[1]), dtype=np.float32)), axis=0) if A.shape[1] > N else X[0:N]  # padded columns
+            assert precision == 'float32', "BSR and DIA are float32 only"
+            out[0:M] = A.dot(X_pad)[0:M]  # format kernel
+        if bias is not None:
+            out[0:M] += bias.reshape(-1,1)*X[N].reshape(1,-1)
+        if relu:
+            np.maximum(out[0:M], 0, out=out[0:M])
+        if bias is not None:
+            out[M] = X[N]  # homogeneous coordinate
+        return out
+    A = A.tocsr() if not scipy.sparse.isspmatrix_csr(A) else A
+    table = precision_table(precision) if precision != 'float32' else np.zeros(0, dtype=np.float32)
+    out = np.empty( (R, X.shape[1]), dtype=np.result_type(A.dtype, X.dtype) if precision == 'float32' else np.float32) if out is None else out
+    assert out.shape == (R, X.shape[1]) and out.flags['C_CONTIGUOUS']
+    X = np.ascontiguousarray(X)
+    threads = numba.get_num_threads()
+    try:
+        if keynet.globals.num_threads() is not None:
+            numba.set_num_threads(min(keynet.globals.num_threads(), numba.config.NUMBA_NUM_THREADS))
+        _csr_dot_dense(A.indptr, A.indices, A.data, table, X, out[0:A.shape[0]], rowblock, relu, np.ascontiguousarray(bias, dtype=np.float32) if bias is not None else np.zeros(0, dtype=np.float32))
+    finally:
+        numba.set_num_threads(threads)  # other numba kernels (e.g. SpGEMM) keep their thread count
+    if bias is not None:
+        out[M] = X[N]  # homogeneous coordinate
+    return out
+
+
+def sparse_freeze(A, dtype=np.float32):
+    """Return A as csr_matrix with dtype data and contiguous int32 indices (int64 only if required), for inference"""
+    A = scipy.sparse.csr_matrix(A, dtype=dtype)
+    index_dtype = np.int32 if max(A.nnz, A.shape[1]) < np.iinfo(np.int32).max else np.int64
+    (A.indices, A.indptr) = (np.ascontiguousarray(A.indices, dtype=index_dtype), np.ascontiguousarray(A.indptr, dtype=index_dtype))
+    return A
+
+
+def sparse_best_format(A, blocksizes=(2,4,8,16,32,64), formats=('csr', 'bsr', 'dia', 'dense'), pad=True):
+    """Return (format, blocksize) for the format in formats with the fewest bytes to store the sparse matrix A: CSR, BSR with square blocks of size 
+       blocksize from blocksizes (zero padded to a multiple of blocksize if pad, otherwise only blocksizes that evenly divide A), DIA or dense.  Ties prefer CSR.
+    """
+    A = A.tocoo()
+    ((M, N), nnz) = (A.shape, A.nnz)
+    itemsize = 4 if max(M, N, nnz) < np.iinfo(np.int32).max else 8
+    valsize = A.dtype.itemsize
+    (rows, cols) = (A.row.astype(np.int64), A.col.astype(np.int64))
+    cost = {('csr', None):nnz*(valsize + itemsize) + (M+1)*itemsize}
+    if 'dense' in formats:
+        cost[('dense', None)] = valsize*M*N
+    if 'dia' in formats:
+        ndiag = len(np.unique(cols - rows))
+        cost[('dia', None)] = ndiag*(valsize*N + itemsize)
+    if 'bsr' in formats:
+        for b in [b for b in blocksizes if b > 1 and b <= min(M, N) and (pad or (M % b == 0 and N % b == 0))]:
+            nblocks = len(np.unique((rows // b)*int(np.ceil(N / float(b))) + (cols // b)))
+            cost[('bsr', b)] = nblocks*(valsize*b*b + itemsize) + (int(np.ceil(M / float(b))) + 1)*itemsize
+    return min(cost.keys(), key=lambda k: (cost[k], k[0] != 'csr'))
+
+
+def sparse_asformat(A, format, blocksize=None):
+    """Return sparse matrix A in format 'csr', 'bsr' (square blocksize, zero padded to a multiple of blocksize), 'dia' or 'dense' (numpy array)"""
+    if format == 'csr':
+        return A.tocsr()
+    elif format == 'bsr':
+        A = A.tocoo()
+        shape = tuple([int(np.ceil(d / float(blocksize)))*blocksize for d in A.shape])
+        return scipy.sparse.coo_matrix( (A.data, (A.row, A.col)), shape=shape).tobsr(blocksize=(blocksize, blocksize))
+    elif format == 'dia':
+        return A.todia()
+    elif format == 'dense':
+        return np.asarray(A.todense())
+    raise ValueError('Invalid format "%s" - must be ["csr", "bsr", "dia", "dense"]' % format)
+
+
 class SparseMatrix(object):
+    precision = 'float32'  # storage of values, see reduce_precision()
+    bias = None  # dense bias of the homogeneous matrix, see affine()
+    
     def __init__(self, A=None):
         assert A is None or self.is_scipy_sparse(A) or self.is_numpy_dense(A), "Invalid input - %s" % (str(type(A)))
         self.shape = A.shape if A is not None else (0,0)  # shape=(H,W)
@@ -430,6 +1173,7 @@ class SparseMatrix(object):
     def __add__(self, other):
         assert isinstance(other, SparseMatrix), "Invalid input"
         assert self.shape == other.shape, "Invalid shape"
+        assert self.bias is None and other.bias is None, "Affine storage is for inference only"
         self._matrix += other._matrix
         return self
         
@@ -471,6 +1215,7 @@ class SparseMatrix(object):
     
     def matmul(self, A):
         assert isinstance(A, SparseMatrix) or self.is_scipy_sparse(A)
+        assert self.precision == 'float32' and self.bias is None, "Reduced precision and affine storage is for inference only"
         #if self.is_scipy_sparse(self._matrix):
         #    self._matrix = self._matrix.tocoo()
         #if self.is_scipy_sparse(A._matrix):
@@ -483,35 +1228,136 @@ class SparseMatrix(object):
         assert self.is_numpy_dense(x_numpy)
         #if self.is_scipy_sparse(self._matrix):
         #    self._matrix = self._matrix.tocsr()
-        return scipy.sparse.coo_matrix.dot(self._matrix, np.matrix(x_numpy))
+        if (self.is_scipy_sparse(self._matrix) and self._matrix.shape != self.shape) or self.bias is not None:
+            return np.matrix(sparse_dot_dense(self._matrix, np.asarray(x_numpy, dtype=np.float32).reshape(self.shape[1], -1), precision=self.precision, shape=self._linearshape(), bias=self.bias))  # padded or affine
+        return scipy.sparse.coo_matrix.dot(precision_decode(self._matrix, self.precision), np.matrix(x_numpy))
         
     def torchdot(self, x_torch):
         if not self.is_torch_dense_float32(x_torch):
             #warnings.warn('coercing to float32')  # FIXME
             x_torch = x_torch.type(torch.FloatTensor)  # FIXME
-        return torch.as_tensor(scipy.sparse.coo_matrix.dot(self._matrix, np.matrix(x_torch.detach().numpy())))
+        if self.is_scipy_sparse(self._matrix):
+            if self._matrix.format not in ['csr', 'bsr', 'dia']:
+                self._matrix = self._matrix.tocsr()  # once
+        return torch.as_tensor(sparse_dot_dense(self._matrix, x_torch.detach().numpy(), precision=self.precision, shape=self._linearshape(), bias=self.bias))  # dense is float32 GEMM
 
     def nnz(self):
-        return self._matrix.nnz if self.is_scipy_sparse(self._matrix) else self._matrix.size
+        """Nonzeros of the homogeneous matrix, including the bias and homogeneous row if affine()"""
+        nnz = self._matrix.nnz if self.is_scipy_sparse(self._matrix) else int(np.count_nonzero(self._matrix))
+        return nnz + (int(np.count_nonzero(self.bias)) + 1 if self.bias is not None else 0)
 
     def transpose(self):
+        assert self.bias is None, "Export with tocsr() before transpose"
         self._matrix = self._matrix.transpose()
-        self.shape = self._matrix.shape
+        self.shape = (self.shape[1], self.shape[0])
         return self
 
+    def _linearshape(self):
+        """Shape of the stored matrix without zero padding, which is the linear part of the homogeneous self.shape if affine()"""
+        return (self.shape[0]-1, self.shape[1]-1) if self.bias is not None else self.shape
+
+    def _linear(self):
+        """Return the stored matrix as coo_matrix without zero padding and reduced precision"""
+        A = precision_decode(self._matrix, self.precision)
+        (M, N) = self._linearshape()
+        A = A.tocsr()[0:M, 0:N] if is_scipy_sparse(A) and A.shape != (M, N) else A  # padded
+        return A.tocoo() if is_scipy_sparse(A) else scipy.sparse.coo_matrix(A)
+
     def tocoo(self):
-        return self._matrix.tocoo() if is_scipy_sparse(self._matrix) else scipy.sparse.coo_matrix(self._matrix)
+        """Return the homogeneous matrix as coo_matrix, including the bias column and homogeneous row if affine()"""
+        A = self._linear()
+        if self.bias is not None:
+            A = scipy.sparse.bmat([[A, scipy.sparse.coo_matrix(self.bias.reshape(-1,1))], [None, scipy.sparse.coo_matrix(np.ones( (1,1), dtype=A.dtype))]], format='coo')
+        return A
+
+    def affine(self, copy=True):
+        """Store the homogeneous matrix [W b; 0 1] as the linear part W (CSR or dense) and a dense float32 bias b, so that the bias column and homogeneous row are not stored 
+           as sparse entries and forward adds the bias to W*x.  The homogeneous coordinate of the input is passed through.  tocoo() and tocsr() export the homogeneous matrix.
+           If copy=False, W is compacted in place in the buffer of the homogeneous matrix, so that the keyed matrix is not stored twice, and the input matrix is invalidated.
+        """
+        if self.bias is not None:
+            return self
+        assert self.precision == 'float32', "Store as affine before reducing precision"
+        (M, N) = (self.shape[0]-1, self.shape[1]-1)
+        if self.is_scipy_sparse(self._matrix):
+            A = self._matrix.tocsr()[0:M+1, 0:N+1] if self._matrix.shape != self.shape else self._matrix.tocsr()
+            h = A[M].tocoo()
+            assert h.nnz == 1 and h.col[0] == N and np.isclose(h.data[0], 1), "Last row must be homogeneous [0 ... 0 1]"
+            A = A.copy() if copy and A is self._matrix else A
+            b = np.zeros(M, dtype=A.dtype)
+            nnz = _csr_split_column(A.indptr, A.indices, A.data, M, N, b)  # drops the bias column and homogeneous row
+            W = scipy.sparse.csr_matrix((A.data[0:nnz], A.indices[0:nnz], A.indptr[0:M+1]), shape=(M, N), copy=False)
+        else:
+            A = np.asarray(self._matrix)
+            assert np.count_nonzero(A[M, 0:N]) == 0 and np.isclose(A[M, N], 1), "Last row must be homogeneous [0 ... 0 1]"
+            b = np.array(A[0:M, N])
+            if copy or not A.flags['C_CONTIGUOUS']:
+                W = np.ascontiguousarray(A[0:M, 0:N])
+            else:
+                a = A.reshape(-1)  # view
+                for i in range(1, M):
+                    a[i*N:(i+1)*N] = a[i*(N+1):i*(N+1)+N]  # shift rows left in place, dropping the bias column
+                W = a[0:M*N].reshape(M, N)
+        (self._matrix, self.bias) = (W, np.ascontiguousarray(b, dtype=np.float32))
+        return self
 
     def tocsr(self):
-        self._matrix = self._matrix.tocsr()
+        if self.bias is not None:
+            (self._matrix, self.bias) = (precision_encode(self.tocoo().tocsr(), self.precision), None)  # export homogeneous
+            return self
+        if not self.is_scipy_sparse(self._matrix):
+            self._matrix = scipy.sparse.csr_matrix(self._matrix)  # dense
+        self._matrix = self._matrix.tocsr() if self._matrix.shape == self.shape else self._matrix.tocsr()[0:self.shape[0], 0:self.shape[1]]
+        return self
+
+    def format(self):
+        """Storage format 'csr', 'bsr', 'dia', 'coo' or 'dense'"""
+        return self._matrix.format if self.is_scipy_sparse(self._matrix) else 'dense'
+    
+    def asformat(self, format='auto', blocksizes=(2,4,8,16,32,64)):
+        """Store in format 'csr', 'bsr', 'dia' or 'dense' (see sparse_asformat()), or 'auto' for the format with the fewest bytes (see sparse_best_format()).
+           Forward uses the kernel for the format.  BSR is zero padded to a multiple of the blocksize, and self.shape is unchanged.
+        """
+        assert self.precision == 'float32', "Change format before reducing precision"
+        (format, blocksize) = sparse_best_format(self._linear(), blocksizes) if format == 'auto' else (format, blocksizes[0] if format == 'bsr' else None)
+        if format != self.format():
+            self._matrix = sparse_asformat(self._linear(), format, blocksize)  # linear part if affine()
         return self
 
     def tocsc(self):
         self._matrix = self._matrix.tocsc()
         return self
 
-    def from_torch_conv2d(self, inshape, w, b, stride):
-        return SparseMatrix(sparse_toeplitz_conv2d(inshape, w.detach().numpy(), bias=b.detach().numpy(), stride=stride))
+    def from_torch_conv2d(self, inshape, w, b, stride, groups=1):
+        return SparseMatrix(sparse_toeplitz_conv2d(inshape, w.detach().numpy(), bias=b.detach().numpy(), stride=stride, groups=groups))
+
+    def reduce_precision(self, precision):
+        """Store values in precision 'float16' or 'bfloat16' for inference, which halves the bytes of the values.  Values are upcast on the fly in torchdot() and accumulated in float32.
+           The bias of affine() storage stays float32.  BSR and DIA storage is converted to CSR without zero padding, since the scipy kernels for these formats cannot upcast on the fly.
+        """
+        assert self.precision == 'float32' or precision == self.precision, "Precision is already reduced to '%s'" % self.precision
+        if precision != self.precision:
+            if self.is_scipy_sparse(self._matrix) and self._matrix.format in ['bsr', 'dia']:
+                (M, N) = self._linearshape()
+                self._matrix = self._matrix.tocsr()[0:M, 0:N]  # crop padding
+                self._matrix.eliminate_zeros()  # stored zeros of blocks or diagonals
+            self._matrix = precision_encode(self._matrix, precision)
+            self.precision = precision
+        return self
+    
+    def to_arrays(self):
+        """Return dictionary of numpy arrays for saving, such that sparse_matrix_from_arrays(self.to_arrays()) is equivalent to self"""
+        bias = {'bias':self.bias} if self.bias is not None else {}
+        if self.is_scipy_sparse(self._matrix) and self._matrix.format == 'bsr':
+            A = self._matrix
+            return dict({'format':np.array('bsr'), 'indptr':A.indptr, 'indices':A.indices, 'data':A.data, 'shape':np.array(self.shape), 'bsrshape':np.array(A.shape), 'precision':np.array(self.precision)}, **bias)
+        elif self.is_scipy_sparse(self._matrix) and self._matrix.format == 'dia':
+            A = self._matrix
+            return dict({'format':np.array('dia'), 'offsets':A.offsets, 'data':A.data, 'shape':np.array(self.shape), 'precision':np.array(self.precision)}, **bias)
+        elif self.is_scipy_sparse(self._matrix):
+            A = self._matrix.tocsr()
+            return dict({'format':np.array('csr'), 'indptr':A.indptr, 'indices':A.indices, 'data':A.data, 'shape':np.array(self.shape), 'precision':np.array(self.precision)}, **bias)
+        return dict({'format':np.array('dense'), 'data':np.asarray(self._matrix), 'shape':np.array(self.shape), 'precision':np.array(self.precision)}, **bias)
 
 
 class TiledMatrix(SparseMatrix):
@@ -544,31 +1390,39 @@ class TiledMatrix(SparseMatrix):
         (h,w) = tileshape
         (H,W) = self.shape        
 
-        d_blockidx_to_tile = defaultdict(list)
-        for (i,j,v) in zip(T.row, T.col, T.data):
-            (ii,jj,vv) = (int(i), int(j), float(v))  # casting to native python types 
-            (bi,bj) = (ii//h, jj//w)
-            d_blockidx_to_tile[(bi, bj)].append( (ii-bi*h, jj-bj*w, vv) )                
-
+        # Bucket nonzeros by block with one sort over nnz, rowmajor within each block
+        (row, col) = (T.row.astype(np.int64), T.col.astype(np.int64))
+        (bi, bj) = (row // h, col // w)
+        blockid = bi*int(np.ceil(W / float(w))) + bj
+        k_sort = np.lexsort( (col, row, blockid) )  
+        (blockid, bi, bj) = (blockid[k_sort], bi[k_sort], bj[k_sort])
+        (row, col, data) = ((row[k_sort]-bi*h).astype(np.int32), (col[k_sort]-bj*w).astype(np.int32), T.data[k_sort])  # tile offsets
+        k_start = np.flatnonzero(np.concatenate( ([True], blockid[1:] != blockid[0:-1]))) if len(blockid)>0 else np.zeros(0, dtype=np.int64)
+        k_end = np.concatenate( (k_start[1:], [len(blockid)])).astype(np.int64)
+        k_first = np.minimum.reduceat(k_sort, k_start) if len(k_start)>0 else k_start  # tile index assigned in order of first nonzero, as in T 
+
+        # Deduplicate blocks by hashing the canonical buffer of each block 
         d_blockhash_to_index = dict()
         self._tiles = []
         self._blocks = []
-        for ((bi,bj), ijv) in d_blockidx_to_tile.items():
-            blockshape = (tileshape[0] if ((bi*h + h) <= H) else (H-bi*h),
-                          tileshape[1] if ((bj*w + w) <= W) else (W-bj*w))
-            blockhash = hash(str(sorted(ijv, key=lambda x: (x[0], x[1])))+str(blockshape))
+        for (ks, ke) in zip(k_start[np.argsort(k_first)], k_end[np.argsort(k_first)]):
+            (bi_k, bj_k) = (int(bi[ks]), int(bj[ks]))
+            blockshape = (tileshape[0] if ((bi_k*h + h) <= H) else (H-bi_k*h),
+                          tileshape[1] if ((bj_k*w + w) <= W) else (W-bj_k*w))
+            blockhash = xxhash.xxh3_128(row[ks:ke].tobytes())
+            blockhash.update(col[ks:ke].tobytes())
+            blockhash.update(data[ks:ke].tobytes())
+            blockhash.update(np.array(blockshape, dtype=np.int64).tobytes())
+            blockhash = blockhash.intdigest()
             if blockhash not in d_blockhash_to_index:
-                (row, col, val) = zip(*ijv)
-                offset = np.abs(np.min(val))+1.0
-                val = np.array(val)+offset   # filter structure preserving
-                t = scipy.sparse.coo_matrix( (val, (row, col)), shape=blockshape)                
-                t.data -= offset  # weight preserving
+                t = scipy.sparse.coo_matrix( (data[ks:ke], (row[ks:ke], col[ks:ke])), shape=blockshape)  # coo preserves explicit zeros
                 self._tiles.append(self._tiletype(t))  # coo
                 d_blockhash_to_index[blockhash] = len(self._tiles)-1
-            self._blocks.append( (bi*h, bj*w, d_blockhash_to_index[blockhash]) )
+            self._blocks.append( (bi_k*h, bj_k*w, d_blockhash_to_index[blockhash]) )
 
 
         self._blocks = sorted(self._blocks, key=lambda x: (x[0], x[1]))  # rowmajor order
+        self._tilegroup = None
 
     def __repr__(self):
         return str('<keynet.TiledMatrix: H=%d, W=%d, tileshape=%s, tiles=%d>' % (*self.shape, str(self.tileshape()), len(self.tiles())))
@@ -597,18 +1451,38 @@ class TiledMatrix(SparseMatrix):
     def copy(self, blocks, tiles):
         self._blocks = blocks
         self._tiles = tiles
+        self._tilegroup = None
         return self
 
+    def tilegroups(self):
+        """Return {k:(rows, cols)} such that all blocks with upper left corner (rows[n], cols[n]) share the submatrix self._tiles[k], cached until the blocks change"""
+        if getattr(self, '_tilegroup', None) is None:
+            blocks = np.array([(i,j,k) for (i,j,k) in self.__iter__()], dtype=np.int64).reshape(-1,3)
+            blocks = blocks[np.argsort(blocks[:,2], kind='stable')]  # group by tile index, rowmajor within group
+            (k_unique, k_start) = np.unique(blocks[:,2], return_index=True)
+            self._tilegroup = {int(k):(b[:,0], b[:,1]) for (k,b) in zip(k_unique, np.split(blocks, k_start[1:]))}
+        return self._tilegroup
 
     def torchdot(self, x):
-        """Input is (C*H*W+1)xN tensor, compute right matrix multiplication T*x, return (-1)xN"""
+        """Input is (C*H*W+1)xN tensor, compute right matrix multiplication T*x, return (-1)xN
+        
+           The tiled matrix is never expanded.  All blocks sharing a tile are computed together by gathering the input row slices for 
+           each block as columns of a single right hand side, so there is one sparse matrix-matrix product per unique tile.
+        """
         assert self.shape[1] == x.shape[0], "Non-conformal shape for W=%s, x=%s" % (str(self.shape), str(x.shape))
 
         if not self.is_numpy_dense(x):
             x = x.detach().numpy()
-
-        W = self.tocsr()   # slow for large matrices, garbage collected
-        y = W.dot(x).astype(np.float32)  # MKL multi-threaded with scipy-intel package for fast sparse matrix multiplication
+        x = np.asarray(x, dtype=np.float32).reshape(x.shape[0], -1)  # (M,N)
+
+        (M,N) = x.shape
+        y = np.zeros( (self.shape[0], N), dtype=np.float32)
+        for (k, (rows, cols)) in self.tilegroups().items():
+            t = precision_decode(self._tiles[k], self.precision)  # upcast unique tile
+            (h,w) = t.shape
+            x_k = x[cols.reshape(-1,1) + np.arange(0,w).reshape(1,-1), :]  # (blocks, w, N) gathered input slices
+            y_k = t.dot(x_k.transpose(1,0,2).reshape(w, -1))  # (h, blocks*N) multi right hand side product
+            np.add.at(y, rows.reshape(-1,1) + np.arange(0,h).reshape(1,-1), np.asarray(y_k).reshape(h, len(rows), N).transpose(1,0,2))  # scatter, blocks may share rows 
         return torch.as_tensor(y) 
                         
     def transpose(self):
@@ -616,12 +1490,13 @@ class TiledMatrix(SparseMatrix):
         self._tiles = [t.transpose() for t in self._tiles]
         self._tileshape = (self._tileshape[1], self._tileshape[0])
         self.shape = (self.shape[1], self.shape[0])
+        self._tilegroup = None
         return self
 
     def tosparse(self, format='coo'):
         """Convert to Scipy COOrdinate sparse matrix, this is an expensive operation that should be used for small matrices only and for testing purposes"""
         ((H,W), (h,w)) = (self.shape, self._tileshape)
-        tiles = [t.tocoo() for t in self._tiles]  # preconvert, expensive for small range
+        tiles = [precision_decode(t, self.precision).tocoo() for t in self._tiles]  # preconvert, expensive for small range
 
         (rows, cols, vals) = ([],[],[])
         for (ii, jj, k) in self.__iter__():
@@ -649,6 +1524,23 @@ class TiledMatrix(SparseMatrix):
     def nnz(self):
         return sum([t.nnz for t in self._tiles])
 
+    def reduce_precision(self, precision):
+        assert self.precision == 'float32' or precision == self.precision, "Precision is already reduced to '%s'" % self.precision
+        if precision != self.precision:
+            self._tiles = [precision_encode(t, precision) for t in self._tiles]
+            self.precision = precision
+        return self
+    
+    def to_arrays(self):
+        tiles = [t.tocoo() for t in self._tiles]
+        return {'format':np.array('tiled'), 'shape':np.array(self.shape), 'tileshape':np.array(self._tileshape), 'dtype':np.array(np.dtype(self.dtype).str), 'precision':np.array(self.precision),
+                'blocks':np.array(self._blocks, dtype=np.int64).reshape(-1,3),
+                'tile_ptr':np.cumsum([0]+[t.nnz for t in tiles]).astype(np.int64),
+                'tile_shape':np.array([t.shape for t in tiles], dtype=np.int64).reshape(-1,2),
+                'tile_row':np.concatenate([t.row for t in tiles]+[np.zeros(0, dtype=np.int32)]).astype(np.int32),
+                'tile_col':np.concatenate([t.col for t in tiles]+[np.zeros(0, dtype=np.int32)]).astype(np.int32),
+                'tile_data':np.concatenate([t.data for t in tiles]+[np.zeros(0, dtype=self.dtype if self.precision == 'float32' else np.uint16)])}
+
     def spy(self, mindim=256, showdim=1024):
         return spy(self.tocoo(), mindim, showdim)
 
@@ -676,6 +1568,7 @@ class DiagonalTiledMatrix(TiledMatrix):
         (h,w) = self._tileshape
         self._tiles = [self._tiletype(B)] 
         self._blocks = None
+        self._tilegroup = None
         
         if (H % h != 0) or (W % w != 0):
             self._tiles.append(self._tiletype(scipy.sparse.eye(max(h,w)).tocsr()[0:H%h, 0:W%w].astype(np.float32)))
@@ -723,6 +1616,9 @@ class Conv2dTiledMatrix(TiledMatrix):
         self._inshape = inshape
         self._outshape = outshape
         self._tileshape = tileshape
+        self._bias = bias
+        self._tilegroup = None
+        self._tiletable = None
         self.shape = T.shape
 
         assert tileshape[0] <= T.shape[0] and tileshape[1] <= T.shape[1]
@@ -776,52 +1672,125 @@ class Conv2dTiledMatrix(TiledMatrix):
         self._blocks = sorted(self._blocks, key=lambda x: (x[0], x[1]))
 
     def nnz(self):
-        return sum([v.size for ((i,j,k),v) in self._tiles.items()])
+        return len(self.tiletable()[-1])
+
+    def reduce_precision(self, precision):
+        assert self.precision == 'float32' or precision == self.precision, "Precision is already reduced to '%s'" % self.precision
+        if precision != self.precision:
+            self._tiles = {k:precision_encode(v, precision) for (k,v) in self._tiles.items()}
+            (self.precision, self._tilegroup, self._tiletable) = (precision, None, None)
+        return self
+    
+    def to_arrays(self):
+        keys = list(self._tiles.keys())
+        values = [np.asarray(self._tiles[k], dtype=np.float32 if self.precision == 'float32' else np.uint16) for k in keys]
+        return {'format':np.array('conv2dtiled'), 'shape':np.array(self.shape), 'tileshape':np.array(self._tileshape), 'inshape':np.array(self._inshape), 'outshape':np.array(self._outshape), 
+                'bias':np.array(bool(self._bias)), 'blocks':np.array(self._blocks, dtype=np.int64).reshape(-1,3), 'precision':np.array(self.precision),
+                'tile_keys':np.array(keys, dtype=np.int64).reshape(-1,3), 'tile_shape':np.array([v.shape for v in values], dtype=np.int64).reshape(-1,2),
+                'value_ptr':np.cumsum([0]+[v.size for v in values]).astype(np.int64), 'values':np.concatenate([v.flatten() for v in values]+[np.zeros(0, dtype=values[0].dtype if len(values)>0 else np.float32)])}
+
+    def tilegroups(self):
+        """Return ({kt:(rows, cols, unique)}, {kt:[(it, jt, channels), ...]}, bias) such that all spatial blocks with upper left corner (rows[n], cols[n]) 
+           share the (Cout x Cin) channel mixing tiles at offset (it,jt) of tile kt, and the bias column as a dense vector (or None), cached
+        """
+        if getattr(self, '_tilegroup', None) is None:
+            (Cin, Hin, Win) = self._inshape
+            d_tileindex_to_blocks = {k:(rows[cols<Cin*Hin*Win], cols[cols<Cin*Hin*Win]) for (k,(rows,cols)) in super(Conv2dTiledMatrix, self).tilegroups().items()}
+            d_tileindex_to_blocks = {k:(rows, cols, len(np.unique(rows)) == len(rows)) for (k,(rows,cols)) in d_tileindex_to_blocks.items() if len(rows) > 0}
+            d_tileindex_to_channels = defaultdict(list)
+            for ((it,jt,kt), v) in self._tiles.items():
+                if kt in d_tileindex_to_blocks:
+                    d_tileindex_to_channels[kt].append( (it, jt, v) )
+
+            bias = None
+            if self._bias:
+                bias = np.zeros(self.shape[0], dtype=np.float32)
+                d_biasindex_to_rows = defaultdict(list)
+                for (i,j,k) in self._blocks:
+                    if j == Cin*Hin*Win:
+                        d_biasindex_to_rows[k].append(i)  
+                for ((it,jt,kt), v) in self._tiles.items():
+                    for i in d_biasindex_to_rows.get(kt, []):
+                        bias[i+it] = precision_decode(v, self.precision).item()
+                        
+            self._tilegroup = (d_tileindex_to_blocks, dict(d_tileindex_to_channels), bias)
+        return self._tilegroup
+
+    def torchdot(self, x):
+        """Input is (Cin*Hin*Win+1)xN tensor, compute right matrix multiplication T*x, return (Cout*Hout*Wout+1)xN
+
+           This is a keyed im2col without the Toeplitz matrix.  Each (Cout x Cin) channel mixing tile at offset (it,jt) of tile kt is applied to the input 
+           pixels (cols+jt) of all blocks sharing kt as one (Cout x Cin) x (Cin x blocks*N) product over a strided view of the input, then added to output pixels (rows+it).
+        """
+        assert self.shape[1] == x.shape[0], "Non-conformal shape for W=%s, x=%s" % (str(self.shape), str(x.shape))
+
+        if not self.is_numpy_dense(x):
+            x = x.detach().numpy()
+        x = np.asarray(x, dtype=np.float32).reshape(x.shape[0], -1)
+
+        ((Cin, Hin, Win), (Cout, Hout, Wout)) = (self._inshape, self._outshape)
+        (d_tileindex_to_blocks, d_tileindex_to_channels, bias) = self.tilegroups()
+        N = x.shape[1]
+        y = np.zeros( (self.shape[0], N), dtype=np.float32)
+        x_channels = x[0:Cin*Hin*Win].reshape(Cin, Hin*Win, N)  # view
+        y_channels = y[0:Cout*Hout*Wout].reshape(Cout, Hout*Wout, N)  # view
+        for (kt, (rows, cols, unique)) in d_tileindex_to_blocks.items():
+            for (it, jt, v) in d_tileindex_to_channels[kt]:
+                y_k = precision_decode(v, self.precision).dot(x_channels[:, cols+jt, :].reshape(Cin, -1)).reshape(Cout, len(rows), N)  # (Cout x Cin) x (Cin x blocks*N), upcast
+                if unique:
+                    y_channels[:, rows+it, :] += y_k  
+                else:
+                    np.add.at(y_channels, (slice(None), rows+it), y_k)  # blocks in the same row share a tile
+        if bias is not None:
+            y += bias.reshape(-1,1)*x[-1].reshape(1,-1)  # homogeneous coordinate
+        return torch.as_tensor(y)
+        
+    def tiletable(self):
+        """Return a CSR-like index (tile_ptr, it, jt, tileshape, value_ptr, values) of the tile dictionary, cached.
+        
+           The channel tiles (it,jt,k) for tile index k are entries tile_ptr[k]:tile_ptr[k+1], and the row major values of entry e are values[value_ptr[e]:value_ptr[e+1]] with shape tileshape[e]
+        """
+        if getattr(self, '_tiletable', None) is None:
+            keys = sorted(self._tiles.keys(), key=lambda x: (x[2], x[0], x[1]))  # group by tile index
+            k_tiles = np.array([k for (i,j,k) in keys], dtype=np.int64)
+            k_max = max([k for (i,j,k) in self._blocks] + k_tiles.tolist() + [-1])
+            tile_ptr = np.searchsorted(k_tiles, np.arange(0, k_max+2)).astype(np.int64)
+            it = np.array([i for (i,j,k) in keys], dtype=np.int64)
+            jt = np.array([j for (i,j,k) in keys], dtype=np.int64)
+            tileshape = np.array([self._tiles[k].shape for k in keys], dtype=np.int64).reshape(-1,2)
+            value_ptr = np.concatenate( ([0], np.cumsum(np.prod(tileshape, axis=1)))).astype(np.int64)
+            values = np.concatenate([np.asarray(self._tiles[k]).flatten() for k in keys]) if len(keys)>0 else np.zeros(0, dtype=np.float32)  # storage precision
+            self._tiletable = (tile_ptr, it, jt, tileshape, value_ptr, values)
+        return self._tiletable
         
     @staticmethod
-    @numba.jit(nopython=True, parallel=False, nogil=False)
-    def _tosparse(blocks, tiles, inshape, outshape):
-
-        # Get memory size
-        d_tileindex_to_size = dict()
-        for ((i, j, k), v) in tiles.items():  
-            if k not in d_tileindex_to_size:
-                d_tileindex_to_size[k] = 0
-            d_tileindex_to_size[k] += v.size
-        k_rcd = 0
-        for (i, j, k) in blocks:
-            k_rcd += d_tileindex_to_size[k]
-
-        # Allocate memory (parallelizable)
-        (rows, cols, data) = (np.zeros(k_rcd, dtype=np.int32), np.zeros(k_rcd, dtype=np.int32), np.zeros(k_rcd, dtype=np.float32))
-
-        # Create sparse array indexes
-        k_rcd = 0
+    @numba.jit(nopython=True, parallel=True, nogil=True)
+    def _tosparse(blocks, block_ptr, tile_ptr, tile_it, tile_jt, tileshape, value_ptr, values, inshape, outshape):
         (Cout, Hout, Wout) = outshape        
         (Cin, Hin, Win) = inshape
-        for kb in range(0, len(blocks)):   
-            (i, j, k) = blocks[kb]  # channel (0,0) spatial block offset 
-            for (it, jt, kt) in tiles:  # repeated tile index
-                if kt == k:  # yuck, search
-                    v = tiles[(it,jt,kt)]
-                    for ic in range(0, v.shape[0]):              
-                        for jc in range(0, v.shape[1]):           
-                            rows[k_rcd] = i + it + (ic*Hout*Wout)  # block offset + tile offset + broadcast channel offset
-                            cols[k_rcd] = j + jt + (jc*Hin*Win)  # block offset + tile offset + broadcast channel offset
-                            data[k_rcd] = float(v[ic, jc])  # channel broadcast
-                            k_rcd += 1  # impure loop
+        (rows, cols, data) = (np.empty(block_ptr[-1], dtype=np.int32), np.empty(block_ptr[-1], dtype=np.int32), np.empty(block_ptr[-1], dtype=np.float32))
+
+        # Output offsets for each block are known, so blocks are independent
+        for kb in numba.prange(0, blocks.shape[0]):
+            (i, j, k) = (blocks[kb,0], blocks[kb,1], blocks[kb,2])  # channel (0,0) spatial block offset 
+            k_rcd = block_ptr[kb]
+            for e in range(tile_ptr[k], tile_ptr[k+1]):  # tiles for tile index k
+                (it, jt, m, n, v) = (tile_it[e], tile_jt[e], tileshape[e,0], tileshape[e,1], value_ptr[e])
+                for ic in range(0, m):
+                    for jc in range(0, n):
+                        rows[k_rcd] = i + it + (ic*Hout*Wout)  # block offset + tile offset + broadcast channel offset
+                        cols[k_rcd] = j + jt + (jc*Hin*Win)  # block offset + tile offset + broadcast channel offset
+                        data[k_rcd] = values[v + ic*n + jc]  # channel broadcast
+                        k_rcd += 1  
 
         return (rows, cols, data)
     
     def tosparse(self, format='coo'):
-        nb_blocks = numba.typed.List()
-        [nb_blocks.append(b) for b in self._blocks]  # no reflection
-
-        nb_tiles = numba.typed.Dict()        
-        for ((i,j,k),v) in self._tiles.items():
-            nb_tiles[(i,j,k)] = v  # python to numba
-
-        (rows, cols, data) = self._tosparse(nb_blocks, nb_tiles, self._inshape, self._outshape)
+        (tile_ptr, it, jt, tileshape, value_ptr, values) = self.tiletable()
+        blocks = np.array(self._blocks, dtype=np.int64).reshape(-1,3)
+        tilesize = value_ptr[tile_ptr[1:]] - value_ptr[tile_ptr[0:-1]]  # nonzeros per tile index 
+        block_ptr = np.concatenate( ([0], np.cumsum(tilesize[blocks[:,2]]))).astype(np.int64)
+        (rows, cols, data) = self._tosparse(blocks, block_ptr, tile_ptr, it, jt, tileshape, value_ptr, precision_decode(values, self.precision), tuple([int(d) for d in self._inshape]), tuple([int(d) for d in self._outshape]))
 
         if format == 'csr':
             T = scipy.sparse.csr_matrix( (data, (rows, cols)), shape=self.shape)
@@ -836,5 +1805,91 @@ class Conv2dTiledMatrix(TiledMatrix):
 
 
 
+def _prefixed(prefix, d):
+    return {'%s.%s' % (prefix, k):v for (k,v) in d.items()}
+
+
+def _unprefixed(prefix, d):
+    return {k[len(prefix)+1:]:v for (k,v) in d.items() if k.startswith('%s.' % prefix)}
+
+
+def key_to_arrays(K):
+    """Return dictionary of numpy arrays for the key K (AffineKey, scipy sparse or None) for saving without pickle, such that key_from_arrays(key_to_arrays(K)) is equivalent to K"""
+    if K is None:
+        return {'type':np.array('none')}
+    elif isinstance(K, AffineKey):
+        return K.to_arrays()
+    elif is_scipy_sparse(K):
+        return dict({'type':np.array('matrix')}, **_prefixed('K', SparseMatrix(K).to_arrays()))
+    raise ValueError('Invalid key type "%s"' % str(type(K)))
+
+
+def key_from_arrays(d):
+    """Return the key from the dictionary of numpy arrays returned by key_to_arrays().  Arrays are used without copying, so memory mapped arrays are shared read-only"""
+    fmt = str(d['type'])
+    matrix = lambda prefix: sparse_matrix_from_arrays(_unprefixed(prefix, d))._matrix
+    if fmt == 'none':
+        return None
+    elif fmt == 'matrix':
+        return matrix('K')
+    elif fmt == 'monomial':
+        dtype = np.dtype(str(d['dtype']))
+        return MonomialKey(int(d['n']), perm=d.get('perm'), gain=d.get('gain'), bias=d.get('bias'), dtype=dtype)
+    elif fmt == 'blockdiagonal':
+        f = BlockDiagonalKey(int(d['n']), matrix('B'), matrix('Binv'))
+        (f._B, f._Binv) = (matrix('B'), matrix('Binv'))  # keep storage format
+        return f
+    elif fmt == 'sparse':
+        f = SparseKey(matrix('M'), matrix('Minv'))
+        (f._M, f._Minv) = (matrix('M'), matrix('Minv'))  # keep storage format
+        return f
+    elif fmt == 'affine':
+        factors = sorted(set([int(k.split('.')[0]) for k in d.keys() if k.split('.')[0].isdigit()]))
+        return AffineKey(int(d['n']), [key_from_arrays(_unprefixed(str(i), d)) for i in factors])
+    raise ValueError('Invalid key type "%s"' % fmt)
+
+
+def sparse_matrix_from_arrays(d):
+    """Return SparseMatrix, TiledMatrix or Conv2dTiledMatrix from the dictionary of numpy arrays (e.g. np.load()) returned by to_arrays().  
+       Arrays are used without copying, so memory mapped arrays are shared read-only
+    """
+    fmt = str(d['format'])
+    totuple = lambda x: tuple(int(i) for i in x)
+    precision = str(d['precision']) if 'precision' in d else 'float32'
+    bias = d['bias'] if 'bias' in d else None  # affine
+    if fmt in ['csr', 'bsr', 'dia', 'dense']:
+        shape = totuple(d['shape']) if 'shape' in d else d['data'].shape
+        linearshape = (shape[0]-1, shape[1]-1) if bias is not None else shape
+        if fmt == 'csr':
+            T = SparseMatrix(scipy.sparse.csr_matrix( (d['data'], d['indices'], d['indptr']), shape=linearshape))
+        elif fmt == 'bsr':
+            T = SparseMatrix(scipy.sparse.bsr_matrix( (d['data'], d['indices'], d['indptr']), shape=totuple(d['bsrshape'])))
+        elif fmt == 'dia':
+            T = SparseMatrix(scipy.sparse.dia_matrix( (d['data'], d['offsets']), shape=linearshape))
+        else:
+            T = SparseMatrix(np.asarray(d['data']))
+        (T.shape, T.precision, T.bias) = (shape, precision, bias)
+        return T
+    elif fmt == 'tiled':
+        T = TiledMatrix.__new__(TiledMatrix)
+        (T._tileshape, T.dtype, T.shape, T.ndim, T._tilegroup) = (totuple(d['tileshape']), np.dtype(str(d['dtype'])), totuple(d['shape']), 2, None)
+        (ptr, row, col, data) = (d['tile_ptr'], d['tile_row'], d['tile_col'], d['tile_data'])
+        T._tiles = [scipy.sparse.coo_matrix( (data[ptr[k]:ptr[k+1]], (row[ptr[k]:ptr[k+1]], col[ptr[k]:ptr[k+1]])), shape=totuple(shape)) for (k, shape) in enumerate(d['tile_shape'])]
+        T._blocks = [totuple(b) for b in d['blocks']]
+        T.precision = precision
+        return T
+    elif fmt == 'conv2dtiled':
+        T = Conv2dTiledMatrix.__new__(Conv2dTiledMatrix)
+        (T._inshape, T._outshape, T._tileshape, T._bias) = (totuple(d['inshape']), totuple(d['outshape']), totuple(d['tileshape']), bool(d['bias']))
+        (T._tilegroup, T._tiletable, T.shape) = (None, None, totuple(d['shape']))
+        (ptr, values) = (d['value_ptr'], d['values'])
+        T._tiles = {totuple(k):np.asarray(values[ptr[n]:ptr[n+1]], dtype=np.float32 if precision == 'float32' else np.uint16).reshape(totuple(shape)) for (n, (k, shape)) in enumerate(zip(d['tile_keys'], d['tile_shape']))}
+        T._blocks = [totuple(b) for b in d['blocks']]
+        T.precision = precision
+        return T
+    else:
+        raise ValueError('Unknown format "%s"' % fmt)
+
+    
 def _test_matmul(A,B,C):
     pass
@@ -13,43 +13,181 @@ from keynet.sparse import sparse_permutation_matrix, sparse_identity_matrix, spa
 from keynet.sparse import sparse_uniform_random_diagonal_matrix, sparse_gaussian_random_diagonal_matrix, sparse_random_diagonally_dominant_doubly_stochastic_matrix
 from keynet.sparse import sparse_channelorder_to_blockorder_matrix, sparse_affine_to_linear, sparse_block_diagonal, sparse_orthogonal_block_diagonal
 from keynet.sparse import sparse_orthogonal_matrix
+from keynet.sparse import AffineKey, MonomialKey, BlockDiagonalKey, SparseKey, sparse_to_key, sparse_spgemm
 from keynet.blockpermute import hierarchical_block_permutation_matrix
 import keynet.layer
 import keynet.fiberbundle
+import keynet.util
+import keynet.profile
+import keynet.globals
 from keynet.util import blockview
-from keynet.globals import verbose
+from keynet.globals import verbose, num_processes, dask_client, GLOBAL
 import copy 
 from vipy.util import Stopwatch
 import warnings
+import os
+import json
+import xxhash
+import uuid
+import joblib
+
+
+def keying_bytes(module, inshape, outshape, A, Ainv):
+    """Return a conservative estimate of the peak memory in bytes for keying the module as A*W*Ainv, from the nonzeros of the unkeyed W expanded by the density of the keys"""
+    fanin = {nn.Conv2d:lambda m: (m.in_channels // m.groups)*np.prod(m.kernel_size),
+             nn.Linear:lambda m: m.in_features,
+             nn.AvgPool2d:lambda m: np.prod(m.kernel_size) if isinstance(m.kernel_size, tuple) else m.kernel_size**2}
+    nnz = np.prod(outshape)*(fanin[type(module)](module) if type(module) in fanin else 1)
+    density = lambda K: max(1.0, (K.nnz() if callable(K.nnz) else K.nnz) / K.shape[0]) if K is not None else 1.0  # AffineKey or scipy.sparse
+    return int(3*12*nnz*density(A)*density(Ainv))  # (data, indices) for W, A*W and A*W*Ainv
+
+
+def _keylayer(f_layergen, settings, args):
+    GLOBAL.update(settings)  # worker process
+    return f_layergen(*args)
+
+
+def keylayers(f_layergen, d_name_to_args, maxbytes=None):
+    """Return {layername:f_layergen(*args)} for the dictionary {layername:(module, inshape, outshape, A, Ainv)}.  f_layergen may be a dictionary {layername:f_layergen} for per-layer options.
+    
+       If keynet.globals.num_processes() > 1, layers are keyed in parallel using the local dask client (if set up with num_processes(n, backend='dask')) or a joblib process pool.
+       With dask, the largest layer is keyed first in row panels distributed over all workers (see keynet.layer.key_layer), then the remaining layers are keyed one per worker.
+       Concurrency is limited so that the estimated keying memory of the largest concurrent layers does not exceed maxbytes (default: available memory).
+    """
+    f_layergen = (lambda d: lambda k: d[k])(f_layergen) if isinstance(f_layergen, dict) else (lambda f: lambda k: f)(f_layergen)  # per layer
+    n = min(num_processes(), len(d_name_to_args))
+    if n <= 1:
+        return {k:f_layergen(k)(*args) for (k,args) in d_name_to_args.items()}
+
+    # Memory aware concurrency: the n largest layers must fit together, largest first so that the slowest layers start immediately
+    maxbytes = keynet.util.available_memory() if maxbytes is None else maxbytes
+    jobbytes = {k:keying_bytes(*args) for (k,args) in d_name_to_args.items()}
+    order = sorted(d_name_to_args.keys(), key=lambda k: jobbytes[k], reverse=True)
+    while n > 1 and sum([jobbytes[k] for k in order[0:n]]) > maxbytes:
+        n -= 1
+    if verbose():
+        print('[keynet.system]: Keying %d layers with %d processes' % (len(order), n))
+    if n <= 1:
+        return {k:f_layergen(k)(*d_name_to_args[k]) for k in order}
+
+    settings = {k:v for (k,v) in GLOBAL.items() if k not in ['DASK_CLIENT', 'PROCESSES']}  # worker keying is serial
+    if GLOBAL['DASK_CLIENT'] is not None:
+        from dask.distributed import as_completed
+        client = dask_client()
+        d_name_to_keyedmodule = {order[0]:f_layergen(order[0])(*d_name_to_args[order[0]])}  # largest layer first, keyed in row panels on all workers
+        order = order[1:]
+        submit = lambda k: client.submit(_keylayer, f_layergen(k), settings, d_name_to_args[k], key='keylayer-%s-%s' % (k, uuid.uuid4().hex), pure=False)
+        d_future_to_name = {submit(k):k for k in order[0:n]}  # at most n layers in flight
+        pending = iter(order[n:])
+        ac = as_completed(list(d_future_to_name.keys()))
+        for f in ac:
+            d_name_to_keyedmodule[d_future_to_name.pop(f)] = f.result()
+            k = next(pending, None)
+            if k is not None:
+                f_next = submit(k)
+                d_future_to_name[f_next] = k
+                ac.add(f_next)
+        return d_name_to_keyedmodule
+    else:
+        return dict(zip(order, joblib.Parallel(n_jobs=n, backend='loky')(joblib.delayed(_keylayer)(f_layergen(k), settings, d_name_to_args[k]) for k in order)))
+        
+
+def cached_layergen(f_layergen, cachedir, cachekey=None):
+    """Return a layergen function that loads a keyed layer from cachedir if the xxhash digest of (module weights and config, inshape, outshape, keys, cachekey) 
+       was already built, otherwise keys the layer and saves it to cachedir.  The cachekey must include build options that change the keyed layer (e.g. tileshape).
+    """
+    os.makedirs(cachedir, exist_ok=True)
+    def f(module, inshape, outshape, A, Ainv):
+        cachefile = os.path.join(cachedir, '%s.npz' % keynet.util.digest( (str(module), module.state_dict(), inshape, outshape, A, Ainv, cachekey) ))
+        if os.path.exists(cachefile):
+            if verbose():
+                print('[keynet.system]: Loading cached keyed layer "%s"' % cachefile)
+            return keynet.layer.KeyedLayer.load(cachefile)
+        layer = f_layergen(module, inshape, outshape, A, Ainv)
+        layer.save(cachefile)
+        return layer
+    return f
+
+
+def keyed_netshape(net, inshape):
+    """Return keynet.torch.netshape(net, inshape) with identity layers (dropout) bypassed in the prevlayer and nextlayer links, as used for key assignment"""
+    netshape = keynet.torch.netshape(net, inshape)
+        
+    # Remove identity layers from keying (doubly linked list - delete node)
+    identity_layers = ['dropout']
+    for prefix in identity_layers:
+        netshape = {k:v for (k,v) in netshape.items() if k not in prefix}  # remove identity layer
+        for (k,v) in netshape.items():
+            if v['nextlayer'] is not None and prefix in v['nextlayer']:
+                v['nextlayer'] = netshape[v['nextlayer']]['nextlayer']  # bypass next layer
+            elif v['prevlayer'] is not None and prefix in v['prevlayer']:
+                v['prevlayer'] = netshape[v['prevlayer']]['prevlayer']  # bypass prev layer
+    return netshape
+
+
+class LayerKeys(object):
+    """Keys for each layer {'A':outkey, 'Ainv':inverse outkey of previous layer}, with keypairs generated by f_layername_to_keypair on first use and held only until released"""
+    def __init__(self, netshape, inkey, f_layername_to_keypair, do_output_encryption=False):
+        (self._netshape, self._inkey, self._f_keypair, self._do_output_encryption) = (netshape, inkey, f_layername_to_keypair, do_output_encryption)
+        self._output = netshape['output']['prevlayer']
+        (self._keypair, self._released) = ({}, set())
+
+    def __contains__(self, k):
+        return k in self._netshape
+
+    def keypair(self, k):
+        if k not in self._keypair:
+            assert k not in self._released, 'Keypair for layer "%s" was released'  % k  # regenerated keys would not match
+            self._keypair[k] = self._f_keypair(k, self._netshape[k]['outshape'])
+        return self._keypair[k]
+    
+    def __getitem__(self, k):
+        (o, prevlayer) = (self._output, self._netshape[k]['prevlayer'])
+        return {'A':self.keypair(k)[0] if k!=o or self._do_output_encryption else None,
+                'Ainv':self._inkey if prevlayer == 'input' else self.keypair(prevlayer)[1]}
+
+    def outputkey(self):
+        return self.keypair(self._output)[1] if self._do_output_encryption else None  # private 
+
+    def release(self, keep):
+        for k in [k for k in self._keypair.keys() if k not in keep and k != self._output]:
+            del self._keypair[k]
+            self._released.add(k)
+        return self
+
+
+_UNKEYED = {'ReLU':nn.ReLU, 'Identity':nn.Identity}  # parameter free layers of a KeyedModel, rebuilt by name in KeyedModel.load()
 
 
 class KeyedModel(object):
-    def __init__(self, net, inshape, inkey, f_layername_to_keypair, f_module_to_keyedmodule=None, do_output_encryption=False):
+    def __init__(self, net, inshape, inkey, f_layername_to_keypair, f_module_to_keyedmodule=None, do_output_encryption=False, cachedir=None, cachekey=None, spilldir=None, spillbytes=0, f_layername_to_layergen=None):
+        """Key all layers in net.  Keys are generated on first use and released after keying the next layer, and layers are keyed as they are reached.  
+           If spilldir is provided, keyed layers are saved to spilldir and memory mapped once keyed layers exceed spillbytes, so that peak memory is bounded 
+           by the largest layer plus spillbytes.  Otherwise, if keynet.globals.num_processes() > 1, layers are keyed in parallel after key assignment.
+           If f_layername_to_layergen is provided, layer k is keyed by f_layername_to_layergen(k) instead of f_module_to_keyedmodule (e.g. per-layer tileshape).
+        """
         # Assign layerkeys using provided lambda function
         net.eval()
-        netshape = keynet.torch.netshape(net, inshape)
-        
-        # Remove identity layers from keying (doubly linked list - delete node)
-        identity_layers = ['dropout']
-        for prefix in identity_layers:
-            netshape = {k:v for (k,v) in netshape.items() if k not in prefix}  # remove identity layer
-            for (k,v) in netshape.items():
-                if v['nextlayer'] is not None and prefix in v['nextlayer']:
-                    v['nextlayer'] = netshape[v['nextlayer']]['nextlayer']  # bypass next layer
-                elif v['prevlayer'] is not None and prefix in v['prevlayer']:
-                    v['prevlayer'] = netshape[v['prevlayer']]['prevlayer']  # bypass prev layer
-
-        # Generate keypairs
-        (i,o) = (netshape['input']['nextlayer'], netshape['output']['prevlayer'])              
-        layerkey = {k:{'outkeypair':f_layername_to_keypair(k, v['outshape']),
-                       'prevlayer':v['prevlayer']}
-                    for (k,v) in netshape.items() if k not in set(['input', 'output'])}
-
-        leafkey = {'input':inkey, 'output':layerkey[o]['outkeypair'][1] if do_output_encryption else None}  # private
-        layerkey = {k:{'A':v['outkeypair'][0] if k!=o or (k==o and do_output_encryption) else None,
-                       'Ainv':inkey if v['prevlayer'] == 'input' else layerkey[v['prevlayer']]['outkeypair'][1]}
-                    for (k,v) in layerkey.items()}
-        layerkey.update(leafkey)
+        f_layername_to_layergen = f_layername_to_layergen if f_layername_to_layergen is not None else (lambda k: f_module_to_keyedmodule)
+        if cachedir is not None:
+            f_layername_to_layergen = (lambda f: lambda k: cached_layergen(f(k), cachedir, cachekey))(f_layername_to_layergen)  # reuse finished layers
+        netshape = keyed_netshape(net, inshape)
+
+        # Generate keypairs lazily
+        layerkey = LayerKeys(netshape, inkey, f_layername_to_keypair, do_output_encryption)
+        parallel = num_processes() > 1 and spilldir is None  # otherwise, stream layers
+        spilled = [0]  # bytes of keyed layers in memory
+        def keylayer(k, args):
+            if parallel:
+                return args  # keyed in parallel after key assignment
+            m = f_layername_to_layergen(k)(*args)
+            return spill(k, m) if spilldir is not None else m
+        def spill(k, m):
+            if isinstance(m, keynet.layer.KeyedLayer):
+                spilled[0] += sum([v.nbytes for v in m.to_arrays().values()])
+                if spilled[0] > spillbytes:
+                    m = keynet.layer.KeyedLayer.load(m.save(os.path.join(spilldir, k)), mmap_mode='r')  # file backed, evictable
+            return m
 
         # Iterate over named layers and replace with keyed versions
         layernames = set([k for (k,m) in net.named_children()])        
@@ -76,29 +214,21 @@ class KeyedModel(object):
 
                 # Replace module k_prev with fused weights, do not include batchnorm in final network
                 (m_prev.weight, m_prev.bias) = (torch.nn.Parameter(bn_weight), torch.nn.Parameter(bn_bias))
-                B = layerkey[k]['A'].dot(layerkey[k]['Ainv'])  # use batchnorm outkey
-                d_name_to_keyedmodule[k_prev] = f_module_to_keyedmodule(m_prev, netshape[k_prev]['inshape'], netshape[k]['outshape'], B.dot(layerkey[k_prev]['A']), layerkey[k_prev]['Ainv'])
-                if verbose():
-                    print('[keynet.layers.KeyNet]:     %s' % str(d_name_to_keyedmodule[k_prev]))
-                    print('[keynet.layers.KeyNet]:     %s' % k)
+                B = keynet.sparse.sparse_key_dot(layerkey[k]['A'], layerkey[k]['Ainv'])  # use batchnorm outkey
+                d_name_to_keyedmodule[k_prev] = keylayer(k_prev, (m_prev, netshape[k_prev]['inshape'], netshape[k]['outshape'], keynet.sparse.sparse_key_dot(B, layerkey[k_prev]['A']), layerkey[k_prev]['Ainv']))
 
             elif isinstance(m, nn.ReLU):
                 # Apply key to previous layer (which was skipped) and make this layer unkeyed, forward is ReLU only
                 k_prev = netshape[k]['prevlayer']
                 if '_bn' not in k_prev:
                     m_prev = getattr(net, k_prev)
-                    B = layerkey[k]['A'].dot(layerkey[k]['Ainv'])  # use relu outkey
-                    d_name_to_keyedmodule[k_prev] = f_module_to_keyedmodule(m_prev, netshape[k_prev]['inshape'], netshape[k_prev]['outshape'], B.dot(layerkey[k_prev]['A']), layerkey[k_prev]['Ainv'])                
+                    B = keynet.sparse.sparse_key_dot(layerkey[k]['A'], layerkey[k]['Ainv'])  # use relu outkey
+                    d_name_to_keyedmodule[k_prev] = keylayer(k_prev, (m_prev, netshape[k_prev]['inshape'], netshape[k_prev]['outshape'], keynet.sparse.sparse_key_dot(B, layerkey[k_prev]['A']), layerkey[k_prev]['Ainv']))
                     d_name_to_keyedmodule[k] = copy.deepcopy(m)  # unkeyed, ReLU only
-                    if verbose():
-                        print('[keynet.layers.KeyNet]:     %s' % str(d_name_to_keyedmodule[k_prev]))
-                        print('[keynet.layers.KeyNet]:     %s' % str(d_name_to_keyedmodule[k]))
                 else:
                     # If previous layer is batchnorm, then we need to include an explicit ReLU layer, this is expensive
                     warnings.warn('Keying ReLU since previous layer "%s" is already keyed - Avoid sequential batchnorm and ReLU layers for efficient keying' % k_prev)
-                    d_name_to_keyedmodule[k] = f_module_to_keyedmodule(m, netshape[k]['inshape'], netshape[k]['outshape'], layerkey[k]['A'], layerkey[k]['Ainv'])                
-                    if verbose():
-                        print('[keynet.layers.KeyNet]:     %s' % str(d_name_to_keyedmodule[k]))
+                    d_name_to_keyedmodule[k] = keylayer(k, (m, netshape[k]['inshape'], netshape[k]['outshape'], layerkey[k]['A'], layerkey[k]['Ainv']))
 
             elif isinstance(m, nn.Dropout):    
                 if verbose():
@@ -108,18 +238,55 @@ class KeyedModel(object):
             elif netshape[k]['nextlayer'] is not None and (('%s_bn' % k) == netshape[k]['nextlayer'] or 'relu' in netshape[k]['nextlayer']):                
                 pass  # Key this layer by merging with next layer 
             else:
-                d_name_to_keyedmodule[k] = f_module_to_keyedmodule(m, netshape[k]['inshape'], netshape[k]['outshape'], layerkey[k]['A'], layerkey[k]['Ainv'])
-                if verbose():
-                    print('[keynet.layers.KeyNet]:     %s' % str(d_name_to_keyedmodule[k]))
-
+                d_name_to_keyedmodule[k] = keylayer(k, (m, netshape[k]['inshape'], netshape[k]['outshape'], layerkey[k]['A'], layerkey[k]['Ainv']))
+            layerkey.release(keep=[k, netshape[k]['prevlayer'], netshape[netshape[k]['prevlayer']]['prevlayer']])  # keys are no longer needed after next layer
+
+        # Key layers, each layer depends only on its own module, shapes and keypair
+        d_name_to_args = {k:v for (k,v) in d_name_to_keyedmodule.items() if isinstance(v, tuple)}
+        d_name_to_keyedmodule.update(keylayers({k:f_layername_to_layergen(k) for k in d_name_to_args.keys()}, d_name_to_args))
+        if verbose():
+            for (k,m) in d_name_to_keyedmodule.items():
+                print('[keynet.layers.KeyNet]:     %s' % str(m))
         self._keynet = nn.Sequential(d_name_to_keyedmodule)  # layers in insertion order
-        self._embeddingkey = layerkey['output']
-        self._imagekey = layerkey['input']
+        self._embeddingkey = layerkey.outputkey()
+        self._imagekey = inkey
         self._layernames = layernames
         self._outshape = netshape['output']['outshape']
 
     def __repr__(self):
         return self._keynet.__repr__()
+
+    def save(self, outfile, compressed=False):
+        """Save keyed layers to a single npz archive, which includes the image and embedding keys unless public().  If outfile does not end in .npz, 
+           save to a directory of uncompressed .npy files instead, so that KeyedModel.load(outfile) memory maps the keyed weights for multi-process serving.  Save after freeze() so that freeze() of the loaded model does not copy.
+        """
+        assert all([isinstance(m, keynet.layer.KeyedLayer) or type(m).__name__ in _UNKEYED for m in self._keynet.children()]), "Unkeyed layers must be one of %s" % str(sorted(_UNKEYED.keys()))
+        arrays = {'__meta__':np.array(json.dumps({'layers':[(k, isinstance(m, keynet.layer.KeyedLayer), type(m).__name__) for (k,m) in self._keynet.named_children()],
+                                                     'outshape':[int(x) for x in self._outshape], 'layernames':sorted(self._layernames)}))}
+        arrays.update({'__imagekey__/%s' % a:v for (a,v) in keynet.sparse.key_to_arrays(self._imagekey).items()})
+        arrays.update({'__embeddingkey__/%s' % a:v for (a,v) in keynet.sparse.key_to_arrays(self._embeddingkey).items()})
+        for (k,m) in self._keynet.named_children():
+            if isinstance(m, keynet.layer.KeyedLayer):
+                arrays.update({'%s/%s' % (k, a):v for (a,v) in m.to_arrays().items()})  # unkeyed layers are rebuilt from __meta__
+        return keynet.util.savez(outfile, arrays, compressed=compressed) if outfile.endswith('.npz') else keynet.util.savedir(outfile, arrays)
+
+    @staticmethod
+    def load(infile, mmap_mode='r'):
+        """Load KeyedModel from npz archive or directory created with save().  Directories are memory mapped with mmap_mode, and forward runs directly on the 
+           mapped read-only buffers, so that all workers on a host share one copy of the keyed weights.  Use mmap_mode=None to read into memory.
+        """
+        d = keynet.util.loaddir(infile, mmap_mode) if os.path.isdir(infile) else np.load(infile)  # no pickled objects
+        meta = json.loads(str(d['__meta__']))
+        prefixed = lambda k: {a[len(k)+1:]:d[a] for a in d.keys() if a.startswith('%s/' % k)}
+        layers = OrderedDict()
+        for (k, is_keyed, module) in meta['layers']:
+            assert is_keyed or module in _UNKEYED, 'Invalid unkeyed layer "%s"' % module
+            layers[k] = keynet.layer.KeyedLayer.from_arrays(prefixed(k)) if is_keyed else _UNKEYED[module]()
+        model = KeyedModel.__new__(KeyedModel)
+        model._keynet = nn.Sequential(layers)
+        (model._outshape, model._layernames) = (tuple(meta['outshape']), set(meta['layernames']))
+        (model._imagekey, model._embeddingkey) = (keynet.sparse.key_from_arrays(prefixed('__imagekey__')), keynet.sparse.key_from_arrays(prefixed('__embeddingkey__')))
+        return model
     
     def __getattr__(self, attr):
         try:
@@ -129,13 +296,98 @@ class KeyedModel(object):
     
     def forward(self, img_cipher, outkey=None):
         outkey = outkey if outkey is not None else self.embeddingkey()
-        y_cipher = self._keynet.forward(img_cipher)
-        return keynet.torch.linear_to_affine(self.decrypt(y_cipher, outkey) if outkey is not None else y_cipher, self._outshape)
+        if getattr(self, '_frozen', None) is not None:
+            return self._frozen_forward(img_cipher, outkey)
+        if keynet.globals.profile():
+            y_cipher = img_cipher
+            for (k,m) in self._keynet.named_children():
+                with keynet.profile.stage(self._forward_profile(), 'forward', layer=k) as r:
+                    y_cipher = m(y_cipher)
+                    r['batch'] = y_cipher.shape[0]
+        else:
+            y_cipher = self._keynet.forward(img_cipher)
+        outshape = self._outshape if img_cipher.shape[0] == 1 else (img_cipher.shape[0], *self._outshape)
+        return keynet.torch.linear_to_affine(self.decrypt(y_cipher, outkey) if outkey is not None else y_cipher, outshape)
+
+    def _forward_profile(self):
+        if getattr(self, '_profile', None) is None:
+            self._profile = []  # forward records, unbounded while profiling
+        return self._profile
+
+    def profile(self, reset=False):
+        """Return keynet.profile.Report of the keying and forward records of each layer, recorded when keynet.globals.profile(True).  If reset, clear forward records after reporting"""
+        records = [dict(r, layer=k) for (k,m) in self._keynet.named_children() for r in getattr(m, '_profile', [])]  # keying
+        report = keynet.profile.Report(records + self._forward_profile())
+        if reset:
+            self._profile = []
+        return report
+
+    def forward_batch(self, x_cipher, outkey=None, batchsize=None, maxbytes=2**30):
+        """Forward Nx(C*H*W+1) encrypted tensor in micro-batches of batchsize (or bounded by maxbytes of activations if None), return Nx(outshape)"""
+        batchsize = batchsize if batchsize is not None else self.batchsize(maxbytes)
+        return torch.cat([self.forward(x, outkey).reshape(x.shape[0], *self._outshape) for x in keynet.util.microbatch(x_cipher, batchsize)])
+
+    def batchsize(self, maxbytes=2**30):
+        """Largest batch such that the two float32 activations of the widest layer fit in maxbytes"""
+        width = max([m.W.shape[0] for m in self._keynet.children() if isinstance(m, keynet.layer.KeyedLayer)] + [np.prod(self._outshape)+1])
+        return max(1, int(maxbytes // (2*4*width)))
     
     def decrypt(self, y_cipher, outkey=None): 
         outkey = outkey if outkey is not None else self.embeddingkey()
-        return keynet.layer.KeyedLayer(W=outkey).forward(y_cipher) if outkey is not None else y_cipher
+        if outkey is None:
+            return y_cipher
+        W = outkey if isinstance(outkey, keynet.sparse.AffineKey) else keynet.sparse.SparseMatrix(outkey)
+        return W.torchdot(y_cipher.t()).t()
+
+    def reduce_precision(self, precision):
+        """Store all keyed layers in precision 'float16' or 'bfloat16', see keynet.layer.KeyedLayer.reduce_precision()"""
+        for m in self._keynet.children():
+            if isinstance(m, keynet.layer.KeyedLayer):
+                m.reduce_precision(precision)
+        return self.freeze(self._check) if getattr(self, '_frozen', None) is not None else self
+
+    def freeze(self, check=False):
+        """Inference mode: freeze each keyed layer once to CSR with int32 indices and float32 (or reduced precision) values, fuse following ReLU layers, and run forward with 
+           activations in one (features x batch) layout using preallocated ping-pong buffers.  Dense keyed layers (e.g. Linear) run as float32 GEMM into the same buffers.  If check=True, verify that the homogeneous 
+           coordinate of the output is one.  Layers that are not scipy sparse (e.g. tiled) use their own forward.
+        """
+        stages = []
+        for (k,m) in self._keynet.named_children():
+            if isinstance(m, keynet.layer.KeyedLayer) and type(m.W) is keynet.sparse.SparseMatrix and m.W.format() not in ['bsr', 'dia', 'dense']:
+                m.W._matrix = keynet.sparse.sparse_freeze(m.W._matrix, dtype=np.float32 if m.W.precision == 'float32' else np.uint16)  # shared with unfrozen forward
+                stages.append([m.W._matrix, 'ReLU' in m._layertype, m.W.precision, m.W.bias])
+            elif isinstance(m, keynet.layer.KeyedLayer) and type(m.W) is keynet.sparse.SparseMatrix and m.W.format() == 'dense':
+                stages.append([m.W._matrix, 'ReLU' in m._layertype, m.W.precision, m.W.bias])
+            elif isinstance(m, nn.ReLU) and len(stages) > 0 and (keynet.sparse.is_scipy_sparse(stages[-1][0]) or isinstance(stages[-1][0], np.ndarray)):
+                stages[-1][1] = True  # fused
+            else:
+                stages.append([m, False, None, None])
+        (self._frozen, self._check, self._buffers) = (stages, check, None)
+        return self
 
+    def unfreeze(self):
+        (self._frozen, self._buffers) = (None, None)
+        return self
+
+    def _frozen_forward(self, img_cipher, outkey=None):
+        x = np.ascontiguousarray(img_cipher.detach().numpy().transpose(), dtype=np.float32)  # (features x batch) for all layers
+        rows = lambda A, bias: A.shape[0] + (1 if bias is not None else 0)  # homogeneous row of affine storage
+        n = max([rows(A, bias) for (A, relu, precision, bias) in self._frozen if keynet.sparse.is_scipy_sparse(A) or isinstance(A, np.ndarray)] + [0]) * x.shape[1]
+        if self._buffers is None or self._buffers[0].size < n:
+            self._buffers = (np.empty(n, dtype=np.float32), np.empty(n, dtype=np.float32))  # ping-pong
+        k = 0
+        for (A, relu, precision, bias) in self._frozen:
+            if keynet.sparse.is_scipy_sparse(A) or isinstance(A, np.ndarray):
+                y = self._buffers[k % 2][0:rows(A, bias)*x.shape[1]].reshape(rows(A, bias), x.shape[1])
+                x = keynet.sparse.sparse_dot_dense(A, x, out=y, relu=relu, precision=precision, bias=bias)  # CSR kernel or GEMM
+                k += 1
+            else:
+                x = np.ascontiguousarray(A.forward(torch.as_tensor(x.transpose())).detach().numpy().transpose())  # unfrozen layer
+        if outkey is not None:
+            x = outkey.dot(x) if isinstance(outkey, keynet.sparse.AffineKey) else keynet.sparse.sparse_dot_dense(outkey, x)
+        outshape = self._outshape if x.shape[1] == 1 else (x.shape[1], *self._outshape)
+        return keynet.torch.linear_to_affine(torch.as_tensor(x.transpose().copy()), outshape, check=self._check)  # copy out of buffer
+    
     def imagekey(self):
         """Return key for decryption of image (if desired)"""
         return self._imagekey
@@ -164,7 +416,7 @@ class KeyedSensor(keynet.layer.KeyedLayer):
         self._inshape = (1, *inshape)  # 1xCxHxW
         self._tensor = None
         self._im = None
-        self.W = keynet.sparse.SparseMatrix(self._encryptkey)
+        self.W = keynet.sparse.SparseMatrix(self._encryptkey) if keynet.sparse.is_scipy_sparse(self._encryptkey) else self._encryptkey  # AffineKey has torchdot
         self._layertype = 'input'
         
     def __repr__(self):
@@ -241,8 +493,8 @@ class KeyedSensor(keynet.layer.KeyedLayer):
         return self._decryptkey
     
     def isencrypted(self):
-        """An encrypted image is converted from NxCxHxW tensor to Nx(C*H*W+1)"""
-        return self.isloaded() and self._tensor.ndim == 2 and self._tensor.shape == (1, np.prod(self._inshape)+1)
+        """An encrypted image (or batch of images) is converted from NxCxHxW tensor to Nx(C*H*W+1)"""
+        return self.isloaded() and self._tensor.ndim == 2 and self._tensor.shape[1] == np.prod(self._inshape)+1
 
     def isloaded(self):
         return self._tensor is not None
@@ -253,13 +505,19 @@ class KeyedSensor(keynet.layer.KeyedLayer):
         if not self.isencrypted():
             self._tensor = self.forward(keynet.torch.affine_to_linear(self._tensor))
         return self
+
+    def encrypt_batch(self, x, batchsize=None):
+        """Return Nx(C*H*W+1) homogenized and encrypted tensor for NxCxHxW tensor x, computed in micro-batches of batchsize (default all N), without changing the loaded image"""
+        assert x.ndim == 4 and tuple(x.shape[1:]) == self._inshape[1:], "Input must be NxCxHxW for CxHxW=%s" % str(self._inshape[1:])
+        batchsize = batchsize if batchsize is not None else x.shape[0]
+        return torch.cat([self.forward(keynet.torch.affine_to_linear(x_batch.type(torch.FloatTensor))) for x_batch in keynet.util.microbatch(x, batchsize)])
         
     def decrypt(self):
         """x_cipher is Nx(C*H*W+1) homogenized, convert to NxCxHxW decrypted"""
         assert self.isloaded(), "Load image first"
         if self.isencrypted():
             x_raw = super(KeyedSensor, self).decrypt(self._decryptkey, self._tensor)
-            self._tensor = keynet.torch.linear_to_affine(x_raw, self._inshape)
+            self._tensor = keynet.torch.linear_to_affine(x_raw, (x_raw.shape[0], *self._inshape[1:]))
         return self
 
     
@@ -300,16 +558,28 @@ class OpticalFiberBundle(KeyedSensor):
         return self._im
     
 
-def layergen(module, inshape, outshape, A, Ainv, tileshape=None, backend='scipy'):
+def layer_tileshape(tileshape, inshape, outshape):
+    """Return the non-ragged spatial tileshape closest to tileshape for a layer with the given input and output shapes"""
+    return (keynet.util.find_closest_positive_divisor(outshape[1], tileshape[0]), keynet.util.find_closest_positive_divisor(inshape[1], tileshape[1])) if tileshape is not None else None
+
+
+def key_tileshape(tileshape, blocksize=None):
+    """Return the tileshape for keygen() of all layers given the Keynet tileshape, which may be a dictionary {layername:tileshape}.  Keys are tile compressible if any layer is tiled"""
+    if isinstance(tileshape, dict):
+        tiled = [t for t in tileshape.values() if t is not None]
+        return None if len(tiled) == 0 else ((blocksize, blocksize) if blocksize is not None else tiled[0])
+    return tileshape
+
+
+def layergen(module, inshape, outshape, A, Ainv, tileshape=None, backend='scipy', precision='float32', format='csr', mindensity=0.25, blocksize=None):
     if tileshape is not None:
-        new_tileshape = (keynet.util.find_closest_positive_divisor(outshape[1], tileshape[0]),  # force non-ragged spatial tileshape
-                         keynet.util.find_closest_positive_divisor(inshape[1], tileshape[1])) 
+        new_tileshape = layer_tileshape(tileshape, inshape, outshape)  # force non-ragged spatial tileshape
         if verbose() and new_tileshape != tileshape:
             print('[layergen]: Ragged spatial tileshape=%s, forcing non-ragged tileshape "%s" for inshape="%s", outshape="%s"' % (str(tileshape), str(new_tileshape), str(inshape), str(outshape)))
         tileshape = new_tileshape
 
     if backend == 'scipy':
-        return keynet.layer.KeyedLayer(module, inshape, outshape, A, Ainv, tileshape=tileshape)
+        return keynet.layer.KeyedLayer(module, inshape, outshape, A, Ainv, tileshape=tileshape, precision=precision, format=format, mindensity=mindensity, blocksize=blocksize)
     else:
         raise ValueError('invalid backend "%s"' % backend)
 
@@ -345,20 +615,24 @@ def keygen(shape, global_geometric, local_geometric, global_photometric, local_p
             H = height*width  # channel repeated transformation
             blocknumel = blocksize*blocksize  # spatially repeated transformation
 
+    identity = MonomialKey(N)  # skipped when composed
+    is_repeatable = (H % blocknumel == 0 and N % H == 0) if blocksize is not None else False  # local transformations repeat evenly, otherwise materialize
+    
     if memoryorder == 'channel':
         (c, cinv) = (sparse_identity_matrix(N), sparse_identity_matrix(N))
+        C = identity
     elif memoryorder == 'block':
         assert blocksize is not None
         (c, cinv) = sparse_channelorder_to_blockorder_matrix(shape, blocksize, withinverse=True)
+        C = sparse_to_key(c, cinv)
     else:
         raise ValueError("Invalid memory order '%s' - must be in '%s'" % (memoryorder, str(allowable_memoryorder)))
-    (C, Cinv) = (sparse_affine_to_linear(c), sparse_affine_to_linear(cinv))
     
     if global_geometric == 'identity':
-        (G, Ginv) = (sparse_identity_matrix(N), sparse_identity_matrix(N))
+        G = identity
     elif global_geometric == 'permutation':
         assert tileshape is None, "Global permutation is not tile compressible"
-        (G, Ginv) = sparse_permutation_matrix(N, withinverse=True)
+        G = MonomialKey(N, perm=np.random.permutation(N))
     elif global_geometric == 'hierarchical_permutation':
         assert hierarchical_blockshape is not None and hierarchical_permute_at_level is not None
         hierarchical_permute_at_level = tolist(hierarchical_permute_at_level) 
@@ -366,9 +640,10 @@ def keygen(shape, global_geometric, local_geometric, global_photometric, local_p
         hierarchical_permute_at_level = [] if (height==1 and width==1) else hierarchical_permute_at_level
         (A, Ainv) = keynet.sparse.sparse_channelorder_to_pixelorder_matrix((channels, height, width), withinverse=True) 
         (G, Ginv) = hierarchical_block_permutation_matrix((height, width, channels), hierarchical_blockshape, hierarchical_permute_at_level, min_blocksize=8, seed=seed, twist=False, withinverse=True, strict=False)
-        (G, Ginv) = (Ainv.dot(G).dot(A), Ainv.dot(Ginv).dot(A))  # CxHxW -> HxWxC -> hierarchical permute in HxWxC order -> CxHxW
+        (G, Ginv) = (sparse_spgemm(sparse_spgemm(Ainv, G), A), sparse_spgemm(sparse_spgemm(Ainv, Ginv), A))  # CxHxW -> HxWxC -> hierarchical permute in HxWxC order -> CxHxW
         if memoryorder != 'channel':
-            (G, Ginv) = (c.dot(G).dot(cinv), c.dot(Ginv).dot(cinv))        
+            (G, Ginv) = (sparse_spgemm(sparse_spgemm(c, G), cinv), sparse_spgemm(sparse_spgemm(c, Ginv), cinv))        
+        G = sparse_to_key(G, Ginv)
     elif global_geometric == 'hierarchical_rotation':
         assert hierarchical_blockshape is not None and hierarchical_permute_at_level is not None
         hierarchical_permute_at_level = tolist(hierarchical_permute_at_level) 
@@ -376,113 +651,142 @@ def keygen(shape, global_geometric, local_geometric, global_photometric, local_p
         hierarchical_permute_at_level = [] if (height==1 and width==1) else hierarchical_permute_at_level
         (A, Ainv) = keynet.sparse.sparse_channelorder_to_pixelorder_matrix((channels, height, width), withinverse=True)                
         (G, Ginv) = hierarchical_block_permutation_matrix((height, width, channels), hierarchical_blockshape, hierarchical_permute_at_level, min_blocksize=8, seed=seed, twist=True, withinverse=True, strict=False)
-        (G, Ginv) = (Ainv.dot(G).dot(A), Ainv.dot(Ginv).dot(A))  # CxHxW -> HxWxC -> hierarchical permute in HxWxC order -> CxHxW
+        (G, Ginv) = (sparse_spgemm(sparse_spgemm(Ainv, G), A), sparse_spgemm(sparse_spgemm(Ainv, Ginv), A))  # CxHxW -> HxWxC -> hierarchical permute in HxWxC order -> CxHxW
         if memoryorder != 'channel':
-            (G, Ginv) = (c.dot(G).dot(cinv), c.dot(Ginv).dot(cinv))        
+            (G, Ginv) = (sparse_spgemm(sparse_spgemm(c, G), cinv), sparse_spgemm(sparse_spgemm(c, Ginv), cinv))        
+        G = sparse_to_key(G, Ginv)
     elif global_geometric == 'givens_orthogonal':
         assert alpha is not None
         assert tileshape is None, "Global givens rotation orthogonal matrix is not tile compressible"
-        (G, Ginv) = sparse_orthogonal_matrix(N, int(alpha), balanced=True, withinverse=True)        
+        G = SparseKey(*sparse_orthogonal_matrix(N, int(alpha), balanced=True, withinverse=True))
     else:
         raise ValueError("Invalid global geometric transform '%s' - must be in '%s'" % (global_geometric, str(allowable_global_geometric)))
-    (G, Ginv) = (sparse_affine_to_linear(G), sparse_affine_to_linear(Ginv))
     
     if local_geometric == 'identity':
-        (g, ginv) = (sparse_identity_matrix(N), sparse_identity_matrix(N))        
+        g = identity
     elif local_geometric == 'permutation':
         assert blocksize is not None and height==width
-        g = keynet.sparse.DiagonalTiledMatrix(sparse_permutation_matrix(blocknumel), shape=(H, H)).tocoo().astype(np.float32)   # spatial repeat
-        g = keynet.sparse.DiagonalTiledMatrix(g, shape=(N,N)).tocoo().astype(np.float32)  # channel repeat
-        ginv = g.transpose()
-
+        if is_repeatable:
+            g = MonomialKey(N, perm=(np.arange(0, N, blocknumel).reshape(-1,1) + np.random.permutation(blocknumel).reshape(1,-1)).flatten())  # spatial, channel repeat
+        else:
+            g = keynet.sparse.DiagonalTiledMatrix(sparse_permutation_matrix(blocknumel), shape=(H, H)).tocoo().astype(np.float32)   # spatial repeat
+            g = keynet.sparse.DiagonalTiledMatrix(g, shape=(N,N)).tocoo().astype(np.float32)  # channel repeat
+            g = sparse_to_key(g, g.transpose())
     elif local_geometric == 'doubly_stochastic':
         assert blocksize is not None and alpha is not None and height == width
         assert blocksize < 8192, "Blocksize %d must be less than 8192, since doubly_stochastic requires the direct inverse of a dense matrix" % blocksize
         (g, ginv) = sparse_random_diagonally_dominant_doubly_stochastic_matrix(blocknumel, int(alpha), withinverse=True)  # expensive inverse
-        g = keynet.sparse.DiagonalTiledMatrix(keynet.sparse.DiagonalTiledMatrix(g, shape=(H, H)).tocoo(), shape=(N,N)).tocoo()  # spatial, channel repeat
-        ginv = keynet.sparse.DiagonalTiledMatrix(keynet.sparse.DiagonalTiledMatrix(ginv, shape=(H, H)).tocoo(), shape=(N,N)).tocoo()  # spatial, channel repeat
+        if is_repeatable:
+            g = BlockDiagonalKey(N, g, ginv)  # spatial, channel repeat
+        else:
+            g = keynet.sparse.DiagonalTiledMatrix(keynet.sparse.DiagonalTiledMatrix(g, shape=(H, H)).tocoo(), shape=(N,N)).tocoo()  # spatial, channel repeat
+            ginv = keynet.sparse.DiagonalTiledMatrix(keynet.sparse.DiagonalTiledMatrix(ginv, shape=(H, H)).tocoo(), shape=(N,N)).tocoo()  # spatial, channel repeat
+            g = SparseKey(g, ginv)
     elif local_geometric == 'givens_orthogonal':
         assert alpha is not None and blocksize is not None and height == width
         (g, ginv) = sparse_orthogonal_matrix(blocknumel, int(alpha), balanced=True, withinverse=True)
         (A, Ainv) = sparse_permutation_matrix(blocknumel, withinverse=True)
-        (g, ginv) = (A.dot(g), ginv.dot(Ainv))
-        g = keynet.sparse.DiagonalTiledMatrix(keynet.sparse.DiagonalTiledMatrix(g, shape=(H, H)).tocoo(), shape=(N,N)).tocoo().astype(np.float32)  # spatial, channel repeat
-        ginv = keynet.sparse.DiagonalTiledMatrix(keynet.sparse.DiagonalTiledMatrix(ginv, shape=(H, H)).tocoo(), shape=(N,N)).tocoo().astype(np.float32)  # spatial, channel repeat
+        (g, ginv) = (A.dot(g).astype(np.float32), ginv.dot(Ainv).astype(np.float32))
+        if is_repeatable:
+            g = BlockDiagonalKey(N, g, ginv)  # spatial, channel repeat
+        else:
+            g = keynet.sparse.DiagonalTiledMatrix(keynet.sparse.DiagonalTiledMatrix(g, shape=(H, H)).tocoo(), shape=(N,N)).tocoo().astype(np.float32)  # spatial, channel repeat
+            ginv = keynet.sparse.DiagonalTiledMatrix(keynet.sparse.DiagonalTiledMatrix(ginv, shape=(H, H)).tocoo(), shape=(N,N)).tocoo().astype(np.float32)  # spatial, channel repeat
+            g = SparseKey(g, ginv)
     else:
         raise ValueError("Invalid local geometric transform '%s' - must be in '%s'" % (local_geometric, str(allowable_local_geometric)))        
-    (g, ginv) = (sparse_affine_to_linear(g), sparse_affine_to_linear(ginv))
     
     if global_photometric == 'identity':
-        (P, Pinv) = (sparse_affine_to_linear(sparse_identity_matrix(N)), sparse_affine_to_linear(sparse_identity_matrix(N)))
+        P = identity
     elif global_photometric == 'uniform_random_gain':
         assert tileshape is None, "Global permutation is not tile compressible"
         assert beta is not None and beta > 0
-        (P, Pinv) = sparse_uniform_random_diagonal_matrix(N, beta, bias=1, withinverse=True)
-        (P, Pinv) = (sparse_affine_to_linear(P), sparse_affine_to_linear(Pinv))
+        P = MonomialKey(N, gain=sparse_uniform_random_diagonal_matrix(N, beta, bias=1).diagonal())
     elif global_photometric == 'uniform_random_bias':
         assert gamma is not None and gamma > 0
-        (P, Pinv) = diagonal_affine_to_linear(sparse_identity_matrix(N), gamma*np.random.rand(N,1), withinverse=True)
+        P = MonomialKey(N, bias=gamma*np.random.rand(N,1))
     elif global_photometric == 'linear_bias':
         assert gamma is not None and gamma > 0
-        (P, Pinv) = diagonal_affine_to_linear(sparse_identity_matrix(N), (gamma/float(N))*np.array(range(0,N)).reshape(N,1), withinverse=True)
+        P = MonomialKey(N, bias=(gamma/float(N))*np.array(range(0,N)))
     elif global_photometric == 'uniform_random_affine':
         assert tileshape is None, "Global permutation is not tile compressible"
         assert beta is not None and beta > 0 and gamma is not None and gamma > 0
-        P = sparse_uniform_random_diagonal_matrix(N, beta, bias=1)
-        (P, Pinv) = diagonal_affine_to_linear(P, gamma*np.random.rand(N,1), withinverse=True)
+        gain = sparse_uniform_random_diagonal_matrix(N, beta, bias=1).diagonal()
+        P = MonomialKey(N, gain=gain, bias=gamma*np.random.rand(N,1))
     elif global_photometric == 'blockwise_constant_bias':
         assert gamma is not None and gamma > 0
         assert blocksize is not None
         bias = gamma*np.random.rand(int(np.ceil(N//blocksize)), 1).dot(np.ones( (1, blocknumel))).flatten()[0:N].reshape(N,1)
-        (P, Pinv) = diagonal_affine_to_linear(sparse_identity_matrix(N), bias, withinverse=True)        
+        P = MonomialKey(N, bias=bias)
     else:
         raise ValueError("Invalid global photometric transform '%s' - must be in '%s'" % (global_photometric, str(allowable_photometric)))                
 
     if local_photometric == 'identity':
-        (p, pinv) = (sparse_affine_to_linear(sparse_identity_matrix(N)), sparse_affine_to_linear(sparse_identity_matrix(N)))
+        p = identity
     elif local_photometric == 'uniform_random_gain':
         assert blocksize is not None
         assert beta is not None and beta > 0
-        (p, pinv) = sparse_uniform_random_diagonal_matrix(blocknumel, beta, bias=1, withinverse=True)
-        (p, pinv) = (sparse_block_diagonal(p, shape=(N,N)), sparse_block_diagonal(pinv, shape=(N,N)))
-        (p, pinv) = (sparse_affine_to_linear(p), sparse_affine_to_linear(pinv))
+        gain = sparse_uniform_random_diagonal_matrix(blocknumel, beta, bias=1).diagonal()
+        p = MonomialKey(N, gain=np.tile(gain, int(np.ceil(N / blocknumel)))[0:N])  # block repeat
     elif local_photometric == 'uniform_random_bias':
         # FIXME: local bias does not respect memoryorder
         assert blocksize is not None 
         assert gamma is not None and gamma > 0
         bias = np.tile(gamma*np.random.rand(blocknumel), int(np.ceil(N / blocknumel)))[0:N].reshape(N,1)
-        (p, pinv) = diagonal_affine_to_linear(sparse_identity_matrix(N), bias=bias, withinverse=True)        
+        p = MonomialKey(N, bias=bias)
     elif local_photometric == 'uniform_random_affine':
         assert blocksize is not None 
         assert beta is not None and beta > 0 and gamma is not None and gamma > 0
-        p = sparse_uniform_random_diagonal_matrix(blocknumel, beta, bias=1)
+        gain = sparse_uniform_random_diagonal_matrix(blocknumel, beta, bias=1).diagonal()
         bias = np.tile(gamma*np.random.rand(blocknumel), int(np.ceil(N / blocknumel)))[0:N].reshape(N,1)
-        (p, pinv) = diagonal_affine_to_linear(sparse_block_diagonal(p, shape=(N,N)), bias=bias, withinverse=True)
+        p = MonomialKey(N, gain=np.tile(gain, int(np.ceil(N / blocknumel)))[0:N], bias=bias)
     elif local_photometric == 'blockwise_constant_bias':
         raise ValueError('blockwise_constant_bias supported for global_photometric testing only')
     else:
         raise ValueError("Invalid local photometric transform '%s' - must be in '%s'" % (local_photometric, str(allowable_photometric)))                
     
-    # Compose!
-    A = Cinv.dot(p.dot(g.dot(P.dot(G.dot(C)))))
-    Ainv = Cinv.dot(Ginv.dot(Pinv.dot(ginv.dot(pinv.dot(C)))))
+    # Compose!  Identity factors are skipped and monomial factors are merged 
+    A = AffineKey(N, [C.inverse(), p, g, P, G, C])
+    Ainv = A.inverse()  # Cinv*Ginv*Pinv*ginv*pinv*C
     return (A, Ainv)
 
 
+def layer_keygen_options(layername, global_photometric, local_photometric, global_geometric, local_geometric):
+    """Return the keygen transforms for the outkey of the named layer.  ReLU outkeys must commute with the ReLU, so they are limited to local permutation and positive gain"""
+    return {'global_photometric':global_photometric if 'relu' not in layername or global_photometric == 'identity' else 'identity',
+            'local_photometric':local_photometric if 'relu' not in layername or local_photometric == 'identity' else 'uniform_random_gain',
+            'global_geometric':global_geometric if 'relu' not in layername or global_geometric == 'identity' else 'identity',
+            'local_geometric':local_geometric if 'relu' not in layername or local_geometric == 'identity' else 'permutation'}
+
+
 def Keynet(inshape, net=None, backend='scipy', global_photometric='identity', local_photometric='identity', global_geometric='identity', local_geometric='identity', memoryorder='channel',
-           do_output_encryption=False, alpha=None, beta=None, gamma=None, hierarchical_blockshape=None, hierarchical_permute_at_level=None, blocksize=None, tileshape=None):
+           do_output_encryption=False, alpha=None, beta=None, gamma=None, hierarchical_blockshape=None, hierarchical_permute_at_level=None, blocksize=None, tileshape=None, seed=None, cachedir=None, spilldir=None, spillbytes=0, f_layername_to_layergen=None, precision='float32', format='csr'):
+    """Return (sensor, model) for a keyed network.  If seed is provided, keys are reproducible per layer name, so that a rebuild with cachedir reuses keyed layers.
+       If spilldir is provided, keyed layers beyond spillbytes are spilled to spilldir and memory mapped (see KeyedModel).  The tileshape may be a dictionary 
+       {layername:tileshape} for per-layer tiling (e.g. from keynet.tune.tune()), where missing layers are not tiled.  If f_layername_to_layergen is provided, it replaces 
+       layergen as the function of layer name returning f(module, inshape, outshape, A, Ainv) for the keyed layer.  Keyed layers are stored in precision 'float32', 
+       or in reduced precision 'float16' or 'bfloat16' with float32 accumulation (see keynet.benchmark.precision_report() for the accuracy).  Untiled keyed layers
+       and the sensor and embedding keys are stored in scipy format 'csr', or analyzed after construction and stored as BSR, DIA or dense if format='auto', where BSR
+       considers the key blocksize first.
+    """
     
-    f_layergen = lambda module, inshape, outshape, A, Ainv: layergen(module, inshape, outshape, A, Ainv, tileshape=tileshape, backend=backend)
+    layertileshape = (lambda k: tileshape.get(k)) if isinstance(tileshape, dict) else (lambda k: tileshape)
+    if f_layername_to_layergen is None:
+        f_layername_to_layergen = lambda k: (lambda module, inshape, outshape, A, Ainv: layergen(module, inshape, outshape, A, Ainv, tileshape=layertileshape(k), backend=backend, precision=precision, format=format, blocksize=blocksize))
+    keytileshape = key_tileshape(tileshape, blocksize)
     f_keypair = lambda layername, shape:  keygen(shape, 
-                                                 global_photometric=global_photometric if 'relu' not in layername or global_photometric == 'identity' else 'identity',
-                                                 local_photometric=local_photometric if 'relu' not in layername or local_photometric == 'identity' else 'uniform_random_gain',
-                                                 global_geometric=global_geometric if 'relu' not in layername or global_geometric == 'identity' else 'identity',
-                                                 local_geometric=local_geometric if 'relu' not in layername or local_geometric == 'identity' else 'permutation',
+                                                 **layer_keygen_options(layername, global_photometric, local_photometric, global_geometric, local_geometric),
                                                  memoryorder=memoryorder,                                                                                                  
-                                                 blocksize=blocksize, tileshape=tileshape, alpha=alpha, beta=beta, gamma=gamma, hierarchical_blockshape=hierarchical_blockshape, hierarchical_permute_at_level=hierarchical_permute_at_level)
+                                                 blocksize=blocksize, tileshape=keytileshape, alpha=alpha, beta=beta, gamma=gamma, hierarchical_blockshape=hierarchical_blockshape, hierarchical_permute_at_level=hierarchical_permute_at_level,
+                                                 seed=xxhash.xxh32_intdigest(layername.encode(), seed=seed) if seed is not None else None)
     
     sensor = KeyedSensor(inshape, f_keypair('input', inshape))
-    model = KeyedModel(net, inshape, sensor.key(), f_keypair, f_layergen, do_output_encryption=do_output_encryption) if net is not None else None
+    model = KeyedModel(net, inshape, sensor.key(), f_keypair, do_output_encryption=do_output_encryption, cachedir=cachedir, cachekey=(backend, tileshape) if (precision, format) == ('float32', 'csr') else (backend, tileshape, precision, format, blocksize), 
+                       spilldir=spilldir, spillbytes=spillbytes, f_layername_to_layergen=f_layername_to_layergen) if net is not None else None
+    if format != 'csr':
+        for K in [sensor.W, model.embeddingkey() if model is not None else None]:
+            if isinstance(K, keynet.sparse.AffineKey):
+                K.asformat(format if format != 'dense' else 'auto', blocksizes=((blocksize,) if blocksize is not None else ()) + (2,4,8,16,32,64))  # after keying, for encryption and decryption
     return (sensor, model)
 
 
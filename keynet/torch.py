@@ -68,10 +68,10 @@ def affine_to_linear(x):
     return torch.cat( (x.view(N,C*H*W), torch.ones(N,1, dtype=x.dtype)), dim=1)
 
 
-def linear_to_affine(x, outshape=None):
-    """Convert Nx(K+1) tensor to NxK by removing last column (which must be one), and reshaping NxK -> NxCxHxW==outshape"""
+def linear_to_affine(x, outshape=None, check=True):
+    """Convert Nx(K+1) tensor to NxK by removing last column (which must be one if check=True), and reshaping NxK -> NxCxHxW==outshape"""
     assert len(x.shape) == 2
-    if not np.allclose(x[:,-1].detach().numpy(), 1, atol=1E-3):
+    if check and not np.allclose(x[:,-1].detach().numpy(), 1, atol=1E-3):
         raise ValueError('invalid affine vector "%s"' % (str(x)))
     x_affine = torch.narrow(x, 1, 0, x.shape[1]-1)
     return x_affine.reshape(outshape) if outshape is not None else x_affine
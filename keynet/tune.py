@@ -0,0 +1,137 @@
+"""Autotune the per-layer tileshape and key blocksize of a keyed network for memory or latency under a budget.
+
+   (config, results) = keynet.tune.tune(net, (1,28,28), objective='latency', maxbytes=16E6, tilesizes=(4,7,14), local_geometric='permutation', blocksize=7)
+   (sensor, knet) = keynet.system.Keynet((1,28,28), net, **config)
+"""
+import time
+import numpy as np
+import torch
+from torch import nn
+import keynet.system
+import keynet.plan
+import keynet.sparse
+from keynet.globals import verbose
+
+
+class _Candidates(nn.Module):
+    """Placeholder layer carrying the candidate costs of a layer, returned in place of the keyed layer so that estimation also works with parallel keying"""
+    def __init__(self, candidates):
+        super(_Candidates, self).__init__()
+        self.candidates = candidates
+
+
+def _measure(T, inshape, outshape, tileshape, depthwise, batchsize, repeat=3):
+    """Return (bytes, seconds per image) of the storage for the matrix T with the given input and output shapes, as constructed by KeyedLayer"""
+    if tileshape is None:
+        M = keynet.sparse.SparseMatrix(T).affine()
+        nbytes = sum([v.nbytes for v in M.to_arrays().values() if v.ndim > 0])
+    else:
+        M = keynet.sparse.TiledMatrix(T, tileshape) if depthwise else keynet.sparse.Conv2dTiledMatrix(T, inshape, outshape, tileshape, bias=True, sanitycheck=False)
+        nbytes = sum([v.nbytes for v in M.to_arrays().values() if isinstance(v, np.ndarray)])
+    x = torch.rand(T.shape[1], batchsize)
+    M.torchdot(x)  # warmup, excludes numba compilation
+    seconds = []
+    for r in range(0, repeat):
+        t = time.perf_counter()
+        M.torchdot(x)
+        seconds.append(time.perf_counter() - t)
+    return (nbytes, min(seconds) / batchsize)
+
+
+def _candidates(module, inshape, outshape, A, Ainv, tilesizes, batchsize):
+    """Return {tileshape:(bytes, seconds)} for the keyed layer, including tileshape=None for untiled, measured on sublayers of the keyed channel blocks of 
+       the first output channels and fit to the full layer (see keynet.plan.sample_channels())
+    """
+    if not isinstance(module, (nn.Conv2d, nn.AvgPool2d)):
+        return None  # not tileable
+    depthwise = isinstance(module, nn.AvgPool2d) or module.groups > 1
+    tileshapes = [None] + sorted(set([keynet.system.layer_tileshape((t,t), inshape, outshape) for t in tilesizes]))
+    m = keynet.plan.sample_channels(module, inshape, outshape, A, Ainv, lambda T, i, o: np.array([_measure(T, i, o, t, depthwise, batchsize) for t in tileshapes]).flatten())
+    return {t:(int(m[2*j]), float(m[2*j+1])) for (j,t) in enumerate(tileshapes)}
+
+
+def _layergen(tilesizes, batchsize):
+    def f_layername_to_layergen(layername):
+        def f(module, inshape, outshape, A, Ainv):
+            if verbose():
+                print('[keynet.tune]: estimating "%s"' % layername)
+            return _Candidates(_candidates(module, inshape, outshape, A, Ainv, tilesizes, batchsize))
+        return f
+    return f_layername_to_layergen
+
+
+def _tile_compressible(inshape, keytileshape, **kwargs):
+    """Return True if keygen() accepts keytileshape for the key family in kwargs, using the validity checks of keynet.plan.key_structure() without generating the key"""
+    try:
+        keynet.plan.key_structure(inshape, tileshape=keytileshape, **kwargs)
+        return True
+    except AssertionError:
+        return False
+
+
+def _select(layers, objective, budget):
+    """Greedy per-layer selection of {layername:tileshape} minimizing the sum of the objective with the sum of the constraint at most budget (or None)"""
+    (obj, con) = (0, 1) if objective == 'memory' else (1, 0)  # index into (bytes, seconds)
+    choice = {k:min(c.keys(), key=lambda t: (c[t][obj], c[t][con])) for (k,c) in layers.items()}
+    total = lambda i: sum([layers[k][t][i] for (k,t) in choice.items()])
+    while budget is not None and total(con) > budget:
+        swaps = [((layers[k][t][obj] - layers[k][choice[k]][obj]) / (layers[k][choice[k]][con] - layers[k][t][con]), k, t)
+                 for (k,c) in layers.items() for t in c.keys() if c[t][con] < c[choice[k]][con]]
+        if len(swaps) == 0:
+            break  # infeasible
+        (r, k, t) = min(swaps, key=lambda s: s[0])  # smallest objective increase per constraint decrease
+        choice[k] = t
+    return (choice, total(0), total(1))
+
+
+def tune(net, inshape, objective='memory', maxbytes=None, maxseconds=None, tilesizes=(2,4,8,16,32), blocksizes=None, batchsize=16, **kwargs):
+    """Return (config, results) for the per-layer tileshape and key blocksize of keynet.system.Keynet(inshape, net, **kwargs) which minimizes the objective under a budget.
+
+       Inputs:
+         -objective: 'memory' to minimize total bytes of the keyed layers subject to seconds per image <= maxseconds, or 'latency' to minimize seconds per image subject to bytes <= maxbytes
+         -tilesizes: candidate square tile sizes for each conv and pool layer, normalized per layer to be non-ragged as in keynet.system.layergen.  Untiled is always a candidate, 
+                     and the only candidate if the key family is not tile compressible (e.g. global_geometric='permutation').
+         -blocksizes: candidate key blocksizes, default is the blocksize in kwargs.  Each candidate keys the network once.
+         -batchsize: batch size for the short forward timings, seconds are reported per image
+         -kwargs: keynet.system.Keynet options for the key family (e.g. local_geometric='permutation', local_photometric='uniform_random_affine')
+
+       Outputs:
+         -config: Keynet kwargs including the selected blocksize and tileshape={layername:tileshape} such that keynet.system.Keynet(inshape, net, **config) constructs the tuned network
+         -results: {'objective', 'blocksize', 'bytes', 'seconds', 'layers':{layername:{'tileshape', 'bytes', 'seconds', 'candidates'}}, 'blocksizes':{blocksize:{'bytes', 'seconds', 'feasible'}}}
+
+       Conv and pool layers are estimated by keying the first output channels and timing sublayers of their keyed channel blocks (see _candidates()),
+       other layers are estimated by keynet.plan and are not tuned.  Raises ValueError if no candidate configuration is within the budget.
+    """
+    assert objective in ['memory', 'latency'], "objective must be 'memory' or 'latency'"
+    budget = maxseconds if objective == 'memory' else maxbytes
+    blocksizes = blocksizes if blocksizes is not None else [kwargs.get('blocksize')]
+    kwargs = {k:v for (k,v) in kwargs.items() if k not in ['blocksize', 'tileshape', 'f_layername_to_layergen']}
+    tilesizes = [t for t in tilesizes if t is not None]
+
+    best = None
+    results = {'objective':objective, 'blocksizes':{}}
+    for blocksize in blocksizes:
+        # Keys as built by Keynet for the returned config: tile compressible if any layer is tiled, otherwise tiled candidates are dropped
+        tiled = {k:(tilesizes[0], tilesizes[0]) for (k,m) in net.named_children() if isinstance(m, (nn.Conv2d, nn.AvgPool2d))} if len(tilesizes) > 0 else {}
+        if len(tiled) > 0 and not _tile_compressible(inshape, keynet.system.key_tileshape(tiled, blocksize), blocksize=blocksize, **kwargs):
+            if verbose():
+                print('[keynet.tune]: keys are not tile compressible for blocksize=%s, estimating untiled layers only' % str(blocksize))
+            tiled = {}
+        (sensor, model) = keynet.system.Keynet(inshape, net, blocksize=blocksize, tileshape=tiled, f_layername_to_layergen=_layergen(tilesizes if len(tiled) > 0 else [], batchsize), **kwargs)
+        fixed = keynet.plan.plan(net, inshape, blocksize=blocksize, **kwargs)  # untuned layers
+        layers = {k:(m.candidates if m.candidates is not None else {None:(fixed.layer(k)['bytes'], fixed.layer(k)['forward_seconds'])}) for (k,m) in model._keynet.named_children() if isinstance(m, _Candidates)}
+        (choice, nbytes, seconds) = _select(layers, objective, budget)
+        feasible = (maxbytes is None or nbytes <= maxbytes) and (maxseconds is None or seconds <= maxseconds)
+        results['blocksizes'][blocksize] = {'bytes':nbytes, 'seconds':seconds, 'feasible':feasible}
+        if verbose():
+            print('[keynet.tune]: blocksize=%s, bytes=%d, seconds=%1.2E, feasible=%s' % (str(blocksize), nbytes, seconds, str(feasible)))
+        if feasible and (best is None or (nbytes, seconds)[0 if objective == 'memory' else 1] < (best[2], best[3])[0 if objective == 'memory' else 1]):
+            best = (blocksize, choice, nbytes, seconds, layers)
+
+    if best is None:
+        raise ValueError('No configuration within budget (maxbytes=%s, maxseconds=%s), closest is %s' % (str(maxbytes), str(maxseconds), str(results['blocksizes'])))
+    (blocksize, choice, nbytes, seconds, layers) = best
+    config = dict(kwargs, blocksize=blocksize, tileshape={k:t for (k,t) in choice.items() if t is not None})
+    results.update({'blocksize':blocksize, 'bytes':nbytes, 'seconds':seconds,
+                    'layers':{k:{'tileshape':t, 'bytes':layers[k][t][0], 'seconds':layers[k][t][1], 'candidates':layers[k]} for (k,t) in choice.items()}})
+    return (config, results)
@@ -7,10 +7,12 @@ import PIL
 import uuid
 import tempfile
 import os
+import shutil
 import time
 from vipy.util import groupbyasdict
 from numpy.lib.stride_tricks import as_strided
 import vipy
+import xxhash
 
 
 def find_closest_positive_divisor(a, b):
@@ -28,6 +30,81 @@ def find_closest_positive_divisor(a, b):
     return a  # should never get here, since bh=a is always a solution
 
     
+def microbatch(x, batchsize):
+    """Split tensor x (NxCxHxW or NxK) along the first dimension into views of at most batchsize rows, to bound the memory of batched encryption and inference"""
+    assert batchsize > 0
+    for k in range(0, x.shape[0], batchsize):
+        yield x[k:k+batchsize]
+
+    
+def digest(obj, h=None):
+    """Return xxhash hex digest of nested python objects containing numpy arrays, torch tensors, scipy sparse matrices, dicts, lists, tuples, scalars and objects (by attributes)"""
+    h = xxhash.xxh3_128() if h is None else h
+    if isinstance(obj, np.ndarray):
+        h.update(('ndarray%s%s' % (obj.dtype.str, str(obj.shape))).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, torch.Tensor):
+        digest(obj.detach().cpu().numpy(), h)
+    elif scipy.sparse.issparse(obj):
+        A = obj.tocsr()
+        [digest(x, h) for x in ('sparse', A.shape, A.indptr, A.indices, A.data)]
+    elif isinstance(obj, dict):
+        h.update(b'dict')
+        [digest(x, h) for kv in obj.items() for x in kv]
+    elif isinstance(obj, (list, tuple)):
+        h.update(('%s%d' % (type(obj).__name__, len(obj))).encode())
+        [digest(x, h) for x in obj]
+    elif isinstance(obj, (type, np.dtype)):
+        h.update(str(obj).encode())
+    elif hasattr(obj, '__dict__'):
+        h.update(type(obj).__name__.encode())
+        digest(sorted(vars(obj).items()), h)
+    else:
+        h.update(('%s:%s' % (type(obj).__name__, str(obj))).encode())  # scalar
+    return h.hexdigest()
+
+
+def savez(outfile, arrays, compressed=False):
+    """Atomically write dictionary of numpy arrays to the npz archive outfile, so that an interrupted write never leaves a partial archive"""
+    tmpfile = '%s.%s.tmp' % (outfile, uuid.uuid4().hex)
+    with open(tmpfile, 'wb') as f:
+        (np.savez_compressed if compressed else np.savez)(f, **arrays)
+    os.replace(tmpfile, outfile)
+    return outfile
+
+
+def available_memory():
+    """Return the available physical memory in bytes"""
+    return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+
+
+def savedir(outdir, arrays):
+    """Write dictionary of numpy arrays to outdir as one uncompressed .npy file per array (keys containing '/' are subdirectories), so that
+       loaddir(outdir, mmap_mode='r') maps each array read-only and all processes on a host share one page cache copy.  An existing outdir is 
+       renamed aside and removed only after the new directory is renamed into place, so that outdir is missing only between the two renames rather than 
+       while the new arrays are written, and arrays already mapped from the old directory stay valid.
+    """
+    outdir = outdir.rstrip(os.sep)
+    tmpdir = '%s.%s.tmp' % (outdir, uuid.uuid4().hex)
+    for (k,v) in arrays.items():
+        npyfile = os.path.join(tmpdir, '%s.npy' % k)
+        os.makedirs(os.path.dirname(npyfile), exist_ok=True)
+        np.save(npyfile, v)
+    olddir = '%s.%s.old' % (outdir, uuid.uuid4().hex) if os.path.isdir(outdir) else None
+    if olddir is not None:
+        os.replace(outdir, olddir)  # aside, a rename on the same filesystem
+    os.replace(tmpdir, outdir)
+    if olddir is not None:
+        shutil.rmtree(olddir)  # unlinked files stay valid for existing memory maps
+    return outdir
+
+
+def loaddir(indir, mmap_mode='r'):
+    """Return dictionary of numpy arrays written by savedir(), memory mapped with the provided np.load() mmap_mode (None to read into memory)"""
+    return {os.path.relpath(os.path.join(d, f), indir)[:-4].replace(os.sep, '/'):np.load(os.path.join(d, f), mmap_mode=mmap_mode)
+            for (d, subdirs, files) in os.walk(indir) for f in sorted(files) if f.endswith('.npy')}
+
+
 def matrix_blockview(W, inshape, n):
     """Reorder a sparse matrix W such that:  W*x.flatten() == matrix_blockview(W, x.shape, n)*blockview(x,n).flatten()"""
     d = {v:k for (k,v) in enumerate(blockview(np.array(range(0,np.prod(inshape))).reshape(inshape), n).flatten())}
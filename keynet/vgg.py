@@ -39,60 +39,65 @@ class VGG16(nn.Module):
     """
     The VGG16 network, with average pooling replacing maxpooling
     """
-    def __init__(self, num_classes=2622, avgpool=True):
+    def __init__(self, num_classes=2622, avgpool=True, width=64, features=4096, imsize=224):
+        """Default is VGG16 for 3x224x224 images.  A reduced VGG16 (e.g. for benchmarking) has fewer channels (conv1_1 has width output channels), fewer features in fc6/fc7 and smaller square images"""
         super(VGG16, self).__init__()
+        (c1, c2, c3, c4) = (width, 2*width, 4*width, 8*width)
+        self._imsize = imsize
+        for k in range(0, 5):
+            imsize = int(np.ceil((imsize-3)/2.0))+1 if avgpool else int(np.ceil((imsize-2)/2.0))+1  # ceil_mode pooling
 
         # Layers must be repeated in order for netshape to work
-        self.conv1_1 = nn.Conv2d(3,64,(3, 3),(1, 1),(1, 1))
+        self.conv1_1 = nn.Conv2d(3,c1,(3, 3),(1, 1),(1, 1))
         self.relu1_1 = nn.ReLU()        
-        self.conv1_2 = nn.Conv2d(64,64,(3, 3),(1, 1),(1, 1))
+        self.conv1_2 = nn.Conv2d(c1,c1,(3, 3),(1, 1),(1, 1))
         self.relu1_2 = nn.ReLU()
         self.pool1_2 = nn.AvgPool2d((3, 3),(2, 2),(0, 0),ceil_mode=True) if avgpool else nn.MaxPool2d((2, 2),(2, 2),(0, 0),ceil_mode=True)
         
-        self.conv2_1 = nn.Conv2d(64,128,(3, 3),(1, 1),(1, 1))
+        self.conv2_1 = nn.Conv2d(c1,c2,(3, 3),(1, 1),(1, 1))
         self.relu2_1 = nn.ReLU()
-        self.conv2_2 = nn.Conv2d(128,128,(3, 3),(1, 1),(1, 1))
+        self.conv2_2 = nn.Conv2d(c2,c2,(3, 3),(1, 1),(1, 1))
         self.relu2_2 = nn.ReLU()
         self.pool2_2 = nn.AvgPool2d((3, 3),(2, 2),(0, 0),ceil_mode=True) if avgpool else nn.MaxPool2d((2, 2),(2, 2),(0, 0),ceil_mode=True)
                 
-        self.conv3_1 = nn.Conv2d(128,256,(3, 3),(1, 1),(1, 1))
+        self.conv3_1 = nn.Conv2d(c2,c3,(3, 3),(1, 1),(1, 1))
         self.relu3_1 = nn.ReLU()        
-        self.conv3_2 = nn.Conv2d(256,256,(3, 3),(1, 1),(1, 1))
+        self.conv3_2 = nn.Conv2d(c3,c3,(3, 3),(1, 1),(1, 1))
         self.relu3_2 = nn.ReLU()        
-        self.conv3_3 = nn.Conv2d(256,256,(3, 3),(1, 1),(1, 1))
+        self.conv3_3 = nn.Conv2d(c3,c3,(3, 3),(1, 1),(1, 1))
         self.relu3_3 = nn.ReLU()
         self.pool3_3 = nn.AvgPool2d((3, 3),(2, 2),(0, 0),ceil_mode=True) if avgpool else nn.MaxPool2d((2, 2),(2, 2),(0, 0),ceil_mode=True)
         
-        self.conv4_1 = nn.Conv2d(256,512,(3, 3),(1, 1),(1, 1))
+        self.conv4_1 = nn.Conv2d(c3,c4,(3, 3),(1, 1),(1, 1))
         self.relu4_1 = nn.ReLU()                
-        self.conv4_2 = nn.Conv2d(512,512,(3, 3),(1, 1),(1, 1))
+        self.conv4_2 = nn.Conv2d(c4,c4,(3, 3),(1, 1),(1, 1))
         self.relu4_2 = nn.ReLU()                        
-        self.conv4_3 = nn.Conv2d(512,512,(3, 3),(1, 1),(1, 1))
+        self.conv4_3 = nn.Conv2d(c4,c4,(3, 3),(1, 1),(1, 1))
         self.relu4_3 = nn.ReLU()
         self.pool4_3 = nn.AvgPool2d((3, 3),(2, 2),(0, 0),ceil_mode=True) if avgpool else nn.MaxPool2d((2, 2),(2, 2),(0, 0),ceil_mode=True)
 
-        self.conv5_1 = nn.Conv2d(512,512,(3, 3),(1, 1),(1, 1))
+        self.conv5_1 = nn.Conv2d(c4,c4,(3, 3),(1, 1),(1, 1))
         self.relu5_1 = nn.ReLU()        
-        self.conv5_2 = nn.Conv2d(512,512,(3, 3),(1, 1),(1, 1))
+        self.conv5_2 = nn.Conv2d(c4,c4,(3, 3),(1, 1),(1, 1))
         self.relu5_2 = nn.ReLU()                
-        self.conv5_3 = nn.Conv2d(512,512,(3, 3),(1, 1),(1, 1))
+        self.conv5_3 = nn.Conv2d(c4,c4,(3, 3),(1, 1),(1, 1))
         self.relu5_3 = nn.ReLU()
         self.pool5_3 = nn.AvgPool2d((3, 3),(2, 2),(0, 0),ceil_mode=True) if avgpool else nn.MaxPool2d((2, 2),(2, 2),(0, 0),ceil_mode=True)
 
-        self.fc6 = nn.Linear(25088,4096)
+        self.fc6 = nn.Linear(c4*imsize*imsize,features)
         self.relu6 = nn.ReLU()
                              
         self.dropout7 = nn.Dropout(0.5)                             
-        self.fc7 = nn.Linear(4096,4096)        
+        self.fc7 = nn.Linear(features,features)        
         self.relu7 = nn.ReLU()
 
         self.dropout8 = nn.Dropout(0.5)                                     
-        self.fc8 = nn.Linear(4096, num_classes)
+        self.fc8 = nn.Linear(features, num_classes)
 
 
     def forward(self, input):
         assert len(input.size()) == 4
-        assert input.shape[1] == 3 and input.shape[2] == 224 and input.shape[3] == 224, "Invalid input shape - must be Nx3n224x224"
+        assert input.shape[1] == 3 and input.shape[2] == getattr(self, "_imsize", 224) and input.shape[3] == getattr(self, "_imsize", 224), "Invalid input shape - must be Nx3x%dx%d" % (getattr(self, "_imsize", 224), getattr(self, "_imsize", 224))
 
         e1_1 = self.relu1_1(self.conv1_1(input))
         e1_2 = self.pool1_2(self.relu1_2(self.conv1_2(e1_1)))
@@ -1,8 +1,13 @@
 import sys
+import os
+import shutil
+import tempfile
+import json
 import numpy as np
 import scipy.linalg
 import PIL
 import copy
+import pytest
 import torch 
 from torch import nn
 import torch.nn.functional as F
@@ -17,6 +22,12 @@ import keynet.mnist
 import keynet.cifar10
 import keynet.torch
 import keynet.system
+import keynet.layer
+import keynet.profile
+import keynet.benchmark
+import keynet.plan
+import keynet.tune
+import keynet.globals
 import keynet.vgg
 import vipy
 from vipy.util import Stopwatch
@@ -80,6 +91,352 @@ def test_photometric_keynet():
     print('[test_keynet]:  Analog Affine Keynet  -  PASSED')
         
 
+def test_batch_keynet():
+    inshape = (1,28,28)
+    x = torch.randn(5, *inshape)
+    net = keynet.mnist.LeNet_AvgPool()
+    net.load_state_dict(torch.load('./models/mnist_lenet_avgpool.pth'))
+
+    (sensor, knet) = keynet.system.Keynet(inshape, net, global_geometric='permutation', global_photometric='uniform_random_affine', beta=1.0, gamma=1.0)
+    x_cipher = sensor.encrypt_batch(x, batchsize=2)
+    assert x_cipher.shape == (5, np.prod(inshape)+1)
+    assert np.allclose(x_cipher[3:4].numpy(), sensor.fromtensor(x[3:4]).encrypt().astensor().numpy())
+    assert np.allclose(sensor.fromtensor(x).encrypt().decrypt().astensor().numpy(), x.numpy(), atol=1E-5)  # batch roundtrip
+    
+    y = net.forward(x).detach().numpy()
+    for batchsize in [1, 2, 5, None]:
+        yh = knet.forward_batch(x_cipher, batchsize=batchsize).detach().numpy()
+        assert yh.shape == (5, 10, 1, 1) and np.allclose(yh.reshape(5,-1), y, atol=1E-4)
+    assert knet.batchsize(maxbytes=4*2*(6*28*28+1)) == 1
+    print('[test_keynet]:  batch Keynet  -  PASSED')    
+
+
+def test_frozen_keynet():
+    inshape = (1,28,28)
+    x = torch.randn(3, *inshape)
+    net = keynet.mnist.LeNet_AvgPool()
+    net.load_state_dict(torch.load('./models/mnist_lenet_avgpool.pth'))
+
+    (sensor, knet) = keynet.system.Keynet(inshape, net, global_geometric='permutation', global_photometric='uniform_random_affine', beta=1.0, gamma=1.0)
+    x_cipher = sensor.forward(affine_to_linear(x))
+    y = [knet.forward(x_cipher[k:k+1]).detach().numpy() for k in range(0, 3)]
+    knet.freeze(check=True)
+    for k in range(0, 3):
+        assert np.allclose(knet.forward(x_cipher[k:k+1]).detach().numpy(), y[k], atol=1E-6)  # reuses buffers
+    yh = knet.forward(x_cipher).detach().numpy()
+    assert yh.shape == (3, *y[0].shape) and np.allclose(yh, np.stack(y), atol=1E-6)
+    assert np.allclose(yh.reshape(3,-1), net.forward(x).detach().numpy(), atol=1E-4)
+    knet.unfreeze()
+    print('[test_keynet]:  frozen Keynet  -  PASSED')    
+
+
+def test_saveload_keynet():
+    inshape = (1,28,28)
+    x = torch.randn(2, *inshape)
+    net = keynet.mnist.LeNet_AvgPool()
+    net.load_state_dict(torch.load('./models/mnist_lenet_avgpool.pth'))
+    cachedir = tempfile.mkdtemp()
+
+    for tileshape in [None, (7,7)]:
+        (sensor, knet) = keynet.system.Keynet(inshape, net, local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=7, beta=1.0, gamma=1.0, tileshape=tileshape, seed=42, cachedir=cachedir)
+        x_cipher = sensor.encrypt_batch(x)
+        y = knet.forward(x_cipher).detach().numpy()
+        outfile = knet.save(os.path.join(cachedir, 'lenet.npz'))
+        knet_loaded = keynet.system.KeyedModel.load(outfile)
+        assert np.allclose(knet_loaded.forward(x_cipher).detach().numpy(), y, atol=1E-6)
+        assert np.allclose(knet_loaded.decrypt(knet_loaded.forward(x_cipher)).detach().numpy(), knet.decrypt(knet.forward(x_cipher)).detach().numpy(), atol=1E-6)
+        assert np.allclose(knet_loaded.imagekey().dot(np.arange(knet.imagekey().shape[1])), knet.imagekey().dot(np.arange(knet.imagekey().shape[1])))  # keys saved as arrays, not pickled
+        assert all([not np.load(outfile)[k].dtype.hasobject for k in np.load(outfile).keys()])
+
+        # Memory mapped directory, forward on read-only mapped weights
+        knet_mmap = keynet.system.KeyedModel.load(knet.save(os.path.join(cachedir, 'lenet')))
+        assert np.allclose(knet_mmap.forward(x_cipher).detach().numpy(), y, atol=1E-6)
+        assert np.allclose(knet_mmap.freeze().forward(x_cipher).detach().numpy(), y, atol=1E-6)
+        knet.save(os.path.join(cachedir, 'lenet'))  # replace while mapped
+        assert np.allclose(knet_mmap.forward(x_cipher).detach().numpy(), y, atol=1E-6) and not any([f.endswith('.old') or f.endswith('.tmp') for f in os.listdir(cachedir)])
+        shutil.rmtree(os.path.join(cachedir, 'lenet'))
+
+        # Rebuild with same seed is loaded from cache
+        numcached = len(os.listdir(cachedir))
+        (sensor_cached, knet_cached) = keynet.system.Keynet(inshape, net, local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=7, beta=1.0, gamma=1.0, tileshape=tileshape, seed=42, cachedir=cachedir)
+        assert len(os.listdir(cachedir)) == numcached
+        assert np.allclose(sensor_cached.encrypt_batch(x).numpy(), x_cipher.numpy())
+        assert np.allclose(knet_cached.forward(x_cipher).detach().numpy(), y, atol=1E-6)
+    shutil.rmtree(cachedir)
+    print('[test_keynet]:  save/load Keynet  -  PASSED')    
+
+
+def test_parallel_keynet():
+    inshape = (1,28,28)
+    x = torch.randn(2, *inshape)
+    net = keynet.mnist.LeNet_AvgPool()
+    net.load_state_dict(torch.load('./models/mnist_lenet_avgpool.pth'))
+
+    (sensor, knet) = keynet.system.Keynet(inshape, net, local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=7, beta=1.0, gamma=1.0, seed=42)
+    processes = keynet.globals.num_processes()
+    try:
+        keynet.globals.num_processes(2)
+        (sensor_parallel, knet_parallel) = keynet.system.Keynet(inshape, net, local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=7, beta=1.0, gamma=1.0, seed=42)
+        assert keynet.system.keylayers(lambda m, *args: m, {'a':(nn.ReLU(), (1,), (1,), None, None), 'b':(nn.ReLU(), (1,), (1,), None, None)}, maxbytes=0)['b'].__class__ is nn.ReLU  # memory limited to serial
+    finally:
+        keynet.globals.num_processes(processes)  # later tests are serial
+    assert [k for (k,m) in knet_parallel._keynet.named_children()] == [k for (k,m) in knet._keynet.named_children()]  # layer order
+    x_cipher = sensor.encrypt_batch(x)
+    assert np.allclose(knet_parallel.forward(x_cipher).detach().numpy(), knet.forward(x_cipher).detach().numpy(), atol=1E-6)
+    print('[test_keynet]:  parallel Keynet  -  PASSED')    
+
+
+def test_dask_keynet():
+    distributed = pytest.importorskip('dask.distributed')
+    inshape = (1,28,28)
+    net = keynet.mnist.LeNet_AvgPool()
+    keygen = lambda shape, seed: keynet.system.keygen(shape, 'identity', 'permutation', 'identity', 'identity', blocksize=7, seed=seed)
+    (K_in, K_conv1, K_pool1, K_conv2) = [keygen(shape, seed) for (seed, shape) in enumerate([inshape, (6,28,28), (6,14,14), (16,14,14)])]
+    d_name_to_args = {'conv1':(net.conv1, inshape, (6,28,28), K_conv1[0], K_in[1]), 'pool1':(net.pool1, (6,28,28), (6,14,14), K_pool1[0], K_conv1[1]), 'conv2':(net.conv2, (6,14,14), (16,14,14), K_conv2[0], K_pool1[1])}
+    largest = max(d_name_to_args.keys(), key=lambda k: keynet.system.keying_bytes(*d_name_to_args[k]))
+    f_layergen = lambda k: (lambda module, inshape, outshape, A, Ainv: keynet.layer.key_layer(A, keynet.layer.toeplitz(module, inshape), Ainv, minnnz=1 if k == largest else 2**62))  # row panels for the largest layer
+    W = {k:keynet.system.keylayers(f_layergen(k), {k:args})[k] for (k, args) in d_name_to_args.items()}  # serial
+
+    (processes, client) = (keynet.globals.num_processes(), keynet.globals.GLOBAL['DASK_CLIENT'])
+    cluster = distributed.LocalCluster(n_workers=2, threads_per_worker=1, processes=False, dashboard_address=None)  # in-process
+    client_local = distributed.Client(cluster)
+    try:
+        keynet.globals.GLOBAL['DASK_CLIENT'] = client_local
+        keynet.globals.num_processes(2)
+        (A, Ainv) = (d_name_to_args['conv1'][3], d_name_to_args['conv1'][4])
+        W_panels = keynet.layer.key_layer(A, keynet.layer.toeplitz(net.conv1, inshape), Ainv, minnnz=1)  # row panels on workers
+        assert W_panels.shape == W['conv1'].shape and abs(W_panels - W['conv1']).max() < 1E-6
+        W_dask = keynet.system.keylayers({k:f_layergen(k) for k in d_name_to_args.keys()}, d_name_to_args)  # largest in row panels, then one layer per worker
+        assert sorted(W_dask.keys()) == sorted(W.keys()) and all([abs(W_dask[k] - W[k]).max() < 1E-6 for k in W.keys()])
+    finally:
+        keynet.globals.GLOBAL['DASK_CLIENT'] = client
+        keynet.globals.num_processes(processes)  # later tests are serial
+        client_local.close()
+        cluster.close()
+    print('[test_keynet]:  dask Keynet  -  PASSED')    
+
+
+def test_streaming_keynet():
+    inshape = (1,28,28)
+    x = torch.randn(2, *inshape)
+    net = keynet.mnist.LeNet_AvgPool()
+    net.load_state_dict(torch.load('./models/mnist_lenet_avgpool.pth'))
+    spilldir = tempfile.mkdtemp()
+
+    (sensor, knet) = keynet.system.Keynet(inshape, net, local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=7, beta=1.0, gamma=1.0, seed=42)
+    (sensor, knet_spilled) = keynet.system.Keynet(inshape, net, local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=7, beta=1.0, gamma=1.0, seed=42, spilldir=spilldir, spillbytes=0)
+    assert sorted(os.listdir(spilldir)) == sorted([k for (k,m) in knet_spilled._keynet.named_children() if isinstance(m, keynet.layer.KeyedLayer)])
+    assert not knet_spilled._keynet.conv1.W._matrix.data.flags.writeable  # memory mapped
+    x_cipher = sensor.encrypt_batch(x)
+    assert np.allclose(knet_spilled.forward(x_cipher).detach().numpy(), knet.forward(x_cipher).detach().numpy(), atol=1E-6)
+    shutil.rmtree(spilldir)
+    print('[test_keynet]:  streaming Keynet  -  PASSED')    
+
+
+def test_profile_keynet():
+    inshape = (1,28,28)
+    x = torch.randn(2, *inshape)
+    net = keynet.mnist.LeNet_AvgPool()
+    exported = []
+    keynet.globals.profile(True)
+    hook = keynet.profile.add_hook(lambda r: exported.append(r))
+    (sensor, knet) = keynet.system.Keynet(inshape, net, local_geometric='permutation', blocksize=7, tileshape=(7,7))
+    knet.forward(sensor.encrypt_batch(x))
+    knet.forward(sensor.encrypt_batch(x))
+    keynet.profile.remove_hook(hook)
+    keynet.globals.profile(False)
+
+    report = knet.profile()
+    assert set(report.layers()) == set([k for (k,m) in knet._keynet.named_children()])
+    assert set(report.stages()) == set(['toeplitz', 'key', 'tile', 'forward'])
+    assert len(report.records(layer='conv1', stage='forward')) == 2 and report.records(layer='conv1', stage='forward')[0]['batch'] == 2
+    assert report.records(layer='conv1', stage='tile')[0]['tiles'] == len(knet._keynet.conv1.W._tiles)
+    assert report.records(layer='fc1', stage='key')[0]['nnz'] == knet._keynet.fc1.W.nnz()
+    assert report.seconds(stage='forward') > 0 and report.peakbytes(layer='conv1', stage='toeplitz') > 0
+    assert report.summary()['conv1']['forward']['calls'] == 2
+    assert len(exported) == len(report) and len(json.loads(report.json())) == len(report)
+    assert len(knet.profile(reset=True).records(stage='forward')) > 0 and len(knet.profile().records(stage='forward')) == 0
+    print(report.table())
+    print('[test_keynet]:  profile Keynet  -  PASSED')    
+
+
+def test_benchmark():
+    outfile = os.path.join(tempfile.mkdtemp(), 'benchmark.json')
+    results = keynet.benchmark.run(['keygen_local_permutation', 'keynet_lenet_forward_frozen'], repeat=2, outfile=outfile)
+    assert set(results['results'].keys()) == set(['keygen_local_permutation', 'keynet_lenet_forward_frozen'])
+    assert results['results']['keynet_lenet_forward_frozen']['images_per_second'] > 0
+    assert keynet.benchmark.compare(results, outfile) == {}
+    baseline = copy.deepcopy(results)
+    baseline['results']['keynet_lenet_forward_frozen']['seconds'] /= 2.0
+    assert keynet.benchmark.compare(results, baseline, tolerance=0.25, mintime=0) == {'keynet_lenet_forward_frozen':(results['results']['keynet_lenet_forward_frozen']['seconds'], baseline['results']['keynet_lenet_forward_frozen']['seconds'], 2.0)}
+    assert keynet.benchmark.main(['--list']) == 0
+    shutil.rmtree(os.path.dirname(outfile))
+    print('[test_keynet]:  benchmark  -  PASSED')    
+
+
+def test_plan_keynet():
+    inshape = (1,28,28)
+    net = keynet.mnist.LeNet_AvgPool()
+    for kwargs in [dict(), 
+                   dict(local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=7, beta=1.0, gamma=1.0),
+                   dict(local_geometric='doubly_stochastic', alpha=2, blocksize=4),
+                   dict(global_geometric='hierarchical_rotation', hierarchical_blockshape=(2,2), hierarchical_permute_at_level=(0,), local_geometric='givens_orthogonal', alpha=8, blocksize=8, memoryorder='block')]:
+        plan = keynet.plan.plan(net, inshape, **kwargs)
+        (sensor, knet) = keynet.system.Keynet(inshape, net, **kwargs)
+        assert [d['layer'] for d in plan.layers()] == [k for (k,m) in knet._keynet.named_children() if isinstance(m, keynet.layer.KeyedLayer)]
+        for d in plan.layers():
+            nnz = getattr(knet._keynet, d['layer']).nnz()
+            assert abs(d['nnz'] - nnz) <= 0.3*nnz, 'Layer "%s" predicted nnz=%d, actual nnz=%d' % (d['layer'], d['nnz'], nnz)
+        assert plan.layer('fc1')['nnz'] == knet._keynet.fc1.nnz()  # dense
+    
+    plan = keynet.plan.plan(net, inshape, local_geometric='permutation', blocksize=7, tileshape=(7,7))
+    assert plan.layer('pool1')['tiles'] > 0 and plan.peakbytes() >= max([d['peakbytes'] for d in plan.layers()])
+    (sensor, knet) = keynet.system.Keynet(inshape, net, local_geometric='permutation', blocksize=7, tileshape=(7,7))
+    for d in plan.layers():
+        W = getattr(knet._keynet, d['layer']).W
+        nbytes = sum([v.nbytes for v in W.to_arrays().values() if v.ndim > 0])
+        assert abs(d['bytes'] - nbytes) <= 0.15*nbytes, 'Layer "%s" predicted bytes=%d, actual bytes=%d' % (d['layer'], d['bytes'], nbytes)  # tiled storage
+        assert d['tiles'] is None or abs(d['tiles'] - len(W._tiles)) <= 0.15*len(W._tiles), 'Layer "%s" predicted tiles=%d, actual unique tiles=%d' % (d['layer'], d['tiles'], len(W._tiles))
+    assert plan.feasible() and not plan.feasible(maxbytes=plan.peakbytes()-1) and not plan.feasible(maxseconds=0)
+    try:
+        keynet.plan.plan(net, inshape, global_geometric='permutation', tileshape=(7,7))  # not tile compressible
+        raise ValueError('Invalid configuration')
+    except AssertionError:
+        pass
+
+    with torch.no_grad():
+        net.fc1.weight.mul_((torch.rand(net.fc1.weight.shape) < 0.1).float())  # pruned, keyed as sparse
+    for kwargs in [dict(), dict(local_geometric='permutation', blocksize=7), dict(local_geometric='doubly_stochastic', alpha=2, blocksize=4)]:
+        plan = keynet.plan.plan(net, inshape, **kwargs)
+        (sensor, knet) = keynet.system.Keynet(inshape, net, **kwargs)
+        W = knet._keynet.fc1.W
+        nbytes = sum([v.nbytes for v in W.to_arrays().values() if v.ndim > 0])
+        assert abs(plan.layer('fc1')['bytes'] - nbytes) <= 0.15*nbytes, 'Layer "fc1" predicted bytes=%d, actual bytes=%d' % (plan.layer('fc1')['bytes'], nbytes)
+    print(plan.table())
+    print('[test_keynet]:  plan Keynet  -  PASSED')    
+
+
+def test_tune_keynet():
+    inshape = (1,28,28)
+    net = keynet.mnist.LeNet_AvgPool()
+    net.eval()
+    x = torch.randn(1, *inshape)
+    kwargs = dict(local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=7, beta=1.0, gamma=1.0)
+    (config, results) = keynet.tune.tune(net, inshape, objective='memory', tilesizes=(7,14), **kwargs)
+    assert config['blocksize'] == 7 and len(config['tileshape']) > 0 and all([k in ['conv1', 'pool1', 'conv2', 'pool2'] for k in config['tileshape'].keys()])
+    (sensor, knet) = keynet.system.Keynet(inshape, net, **config)
+    assert np.allclose(knet.forward(sensor.fromtensor(x).encrypt().astensor()).detach().numpy().flatten(), net.forward(x).detach().numpy().flatten(), atol=1E-5)
+    for (k, d) in results['layers'].items():
+        if d['tileshape'] is not None:
+            nbytes = sum([v.nbytes for v in getattr(knet._keynet, k).W.to_arrays().values() if isinstance(v, np.ndarray)])
+            assert abs(d['bytes'] - nbytes) <= 0.15*nbytes, 'Layer "%s" estimated bytes=%d, actual bytes=%d' % (k, d['bytes'], nbytes)
+
+    maxbytes = results['bytes'] + 0.5*(keynet.tune.tune(net, inshape, objective='latency', tilesizes=(7,14), **kwargs)[1]['bytes'] - results['bytes'])
+    (config, budgeted) = keynet.tune.tune(net, inshape, objective='latency', maxbytes=maxbytes, tilesizes=(7,14), **kwargs)
+    assert budgeted['bytes'] <= maxbytes and all([k in ['conv1', 'pool1', 'conv2', 'pool2'] for k in config['tileshape'].keys()])
+    assert config['tileshape'] == {k:d['tileshape'] for (k,d) in budgeted['layers'].items() if d['tileshape'] is not None}
+    candidates = {k:d['candidates'] for (k,d) in budgeted['layers'].items()}
+    (choice, nbytes, seconds) = keynet.tune._select(candidates, 'latency', maxbytes)  # same candidate table, no timing
+    assert choice == {k:d['tileshape'] for (k,d) in budgeted['layers'].items()} and (nbytes, seconds) == (budgeted['bytes'], budgeted['seconds'])
+    (fastest, fastest_bytes, fastest_seconds) = keynet.tune._select(candidates, 'latency', None)
+    assert fastest_seconds <= seconds and nbytes <= fastest_bytes  # budget trades latency for memory
+    try:
+        keynet.tune.tune(net, inshape, objective='latency', maxbytes=1, tilesizes=(7,14), **kwargs)
+        raise AssertionError('Infeasible budget')
+    except ValueError:
+        pass
+
+    # Keys that are not tile compressible are tuned untiled, and the config builds
+    (config, results) = keynet.tune.tune(net, inshape, global_geometric='permutation')
+    assert config['tileshape'] == {} and all([set(d['candidates'].keys()) == set([None]) for d in results['layers'].values()])
+    (sensor, knet) = keynet.system.Keynet(inshape, net, **config)
+    assert np.allclose(knet.forward(sensor.fromtensor(x).encrypt().astensor()).detach().numpy().flatten(), net.forward(x).detach().numpy().flatten(), atol=1E-5)
+    print('[test_keynet]:  tune Keynet  -  PASSED')    
+
+
+def test_precision_keynet():
+    inshape = (1,28,28)
+    net = keynet.mnist.LeNet_AvgPool()
+    net.load_state_dict(torch.load('./models/mnist_lenet_avgpool.pth'))
+    x = torch.randn(4, *inshape)
+    y = net.forward(x).detach().numpy()
+    for tileshape in [None, (7,7)]:
+        (sensor, knet) = keynet.system.Keynet(inshape, net, local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=7, beta=1.0, gamma=1.0, tileshape=tileshape, precision='float16')
+        x_cipher = sensor.encrypt_batch(x)
+        yh = knet.forward(x_cipher).detach().numpy().reshape(4,-1)
+        assert np.allclose(yh, y, atol=1E-2) and np.all(np.argmax(yh, axis=1) == np.argmax(y, axis=1))
+        assert np.allclose(knet.freeze().forward(x_cipher).detach().numpy().reshape(4,-1), yh, atol=1E-6)
+
+    try:
+        report = keynet.benchmark.precision_report(n=16, names=['mnist_lenet_avgpool'])  # real test images
+    except RuntimeError:
+        pytest.skip('MNIST test set download unavailable')
+    for (precision, r) in report['mnist_lenet_avgpool'].items():
+        assert r['bytes'] < 0.8*r['bytes_float32'] and r['relerror'] < 0.05 and r['agreement'] == 1.0 and r['accuracy'] == r['accuracy_float32'] and r['accuracy'] >= 0.75
+    print('[test_keynet]:  precision Keynet  -  PASSED')    
+
+
+def test_format_keynet():
+    inshape = (1,28,28)
+    net = keynet.mnist.LeNet_AvgPool()
+    x = torch.randn(4, *inshape)
+    y = net.forward(x).detach().numpy()
+    kwargs = dict(local_geometric='doubly_stochastic', alpha=2, blocksize=4, memoryorder='block', seed=1)
+    (sensor, knet) = keynet.system.Keynet(inshape, net, **kwargs)
+    (sensor, knet_auto) = keynet.system.Keynet(inshape, net, format='auto', **kwargs)
+    formats = {k:m.W.format() for (k,m) in knet_auto._keynet.named_children() if isinstance(m, keynet.layer.KeyedLayer)}
+    assert formats['fc1'] == 'dense' and all([f in ['csr', 'bsr', 'dia', 'dense'] for f in formats.values()])
+    nbytes = lambda knet: sum([sum([v.nbytes for v in m.to_arrays().values()]) for m in knet._keynet.children() if isinstance(m, keynet.layer.KeyedLayer)])
+    assert nbytes(knet_auto) <= nbytes(knet)
+
+    x_cipher = sensor.encrypt_batch(x)
+    yh = knet_auto.forward(x_cipher).detach().numpy().reshape(4,-1)
+    assert np.allclose(yh, y, atol=1E-4)
+    assert np.allclose(knet_auto.freeze().forward(x_cipher).detach().numpy().reshape(4,-1), yh, atol=1E-6)
+    with tempfile.TemporaryDirectory() as d:
+        knet_auto.save(os.path.join(d, 'knet'))
+        assert np.allclose(keynet.system.KeyedModel.load(os.path.join(d, 'knet')).forward(x_cipher).detach().numpy().reshape(4,-1), yh, atol=1E-6)
+
+    kwargs = dict(local_geometric='doubly_stochastic', alpha=2, blocksize=7, memoryorder='block', seed=1)  # BSR at the key blocksize, not a power of two
+    (sensor, knet_bsr) = keynet.system.Keynet(inshape, net, format='bsr', **kwargs)
+    assert all([m.W._matrix.blocksize == (7,7) for m in knet_bsr._keynet.children() if isinstance(m, keynet.layer.KeyedLayer)])
+    assert all([f._B.blocksize == (7,7) for f in sensor.W._factors if isinstance(f, keynet.sparse.BlockDiagonalKey)])
+    assert np.allclose(knet_bsr.forward(sensor.encrypt_batch(x)).detach().numpy().reshape(4,-1), y, atol=1E-4)
+    print('[test_keynet]:  format Keynet  -  PASSED')    
+
+
+def test_dense_linear_keynet():
+    inshape = (1,28,28)
+    net = keynet.mnist.LeNet_AvgPool()
+    net.eval()
+    x = torch.randn(4, *inshape)
+    y = net.forward(x).detach().numpy()
+    (sensor, knet) = keynet.system.Keynet(inshape, net, local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=7, beta=1.0, gamma=1.0)
+    for k in ['fc1', 'fc2', 'fc3']:
+        W = getattr(knet._keynet, k).W
+        assert W.format() == 'dense' and W._matrix.dtype == np.float32 and W._matrix.flags['C_CONTIGUOUS']
+    x_cipher = sensor.encrypt_batch(x)
+    yh = knet.forward(x_cipher).detach().numpy().reshape(4,-1)
+    assert np.allclose(yh, y, atol=1E-4)
+    assert np.allclose(knet.freeze().forward(x_cipher).detach().numpy().reshape(4,-1), yh, atol=1E-5)
+
+    # Keyed layers are stored as (W, b), exported as homogeneous
+    Ainv = sensor.key()
+    (B, Binv) = keynet.system.keygen((6,28,28), 'identity', 'permutation', 'identity', 'uniform_random_affine', blocksize=7, beta=1.0, gamma=1.0)
+    L = keynet.layer.KeyedLayer(net.conv1, (1,28,28), (6,28,28), B, Ainv)
+    assert L.W.bias is not None and L.W._matrix.shape == (6*28*28, 28*28)
+    assert np.allclose(L.W.tocoo().toarray(), keynet.sparse.sparse_key_compose(B, keynet.layer.toeplitz(net.conv1, (1,28,28)), Ainv).toarray(), atol=1E-5)
+
+    # Sparse keyed linear layers below mindensity are CSR
+    (A, Ainv) = keynet.system.keygen((84,1,1), 'permutation', 'identity', 'identity', 'identity')
+    L_csr = keynet.layer.KeyedLayer(net.fc3, (84,1,1), (10,1,1), None, Ainv, mindensity=1.1)
+    L_dense = keynet.layer.KeyedLayer(net.fc3, (84,1,1), (10,1,1), None, Ainv)
+    assert L_csr.W.format() == 'csr' and L_dense.W.format() == 'dense' and L_csr.nnz() == L_dense.nnz()
+    x_affine = torch.rand(2, 85)
+    assert np.allclose(L_csr.forward(x_affine).detach().numpy(), L_dense.forward(x_affine).detach().numpy(), atol=1E-5)
+    print('[test_keynet]:  dense linear Keynet  -  PASSED')    
+
+
 def test_vgg16_identity():
 
     inshape = (3,224,224)
@@ -268,6 +625,19 @@ if __name__ == '__main__':
         test_identity_keynet()
         test_permutation_keynet()
         test_photometric_keynet()
+        test_frozen_keynet()
+        test_batch_keynet()
+        test_saveload_keynet()
+        test_parallel_keynet()
+        test_dask_keynet()
+        test_streaming_keynet()
+        test_profile_keynet()
+        test_benchmark()
+        test_plan_keynet()
+        test_tune_keynet()
+        test_precision_keynet()
+        test_format_keynet()
+        test_dense_linear_keynet()
 
         test_lenet_orthogonal()
         test_lenet_orthogonal_tiled()
@@ -2,7 +2,9 @@ import numpy as np
 import scipy.linalg
 import PIL
 import copy
+import tracemalloc
 import torch 
+import numba
 from torch import nn
 import torch.nn.functional as F
 import keynet.sparse
@@ -140,6 +142,10 @@ def test_sparse_tiled_matrix():
     T = keynet.sparse.TiledMatrix(W, tileshape=(4,4))
     assert np.allclose(W.todense().astype(np.float32), T.tocoo().todense(), atol=1E-5)
 
+    W = keynet.sparse.DiagonalTiledMatrix(np.random.rand(3,3).astype(np.float32), shape=(12,12)).tosparse()
+    T = keynet.sparse.TiledMatrix(W, tileshape=(3,3))
+    assert len(T.tiles()) == 1 and len(T.blocks()) == 4  # deduplicated
+
     (U,V) = (27,26)
     W = sparse_toeplitz_conv2d( (1,U,V), np.random.rand(1,1,3,3) )    
     T = keynet.sparse.Conv2dTiledMatrix(W, inshape=(1,U,V), outshape=(1,U,V), tileshape=(3,3), bias=False)
@@ -180,7 +186,14 @@ def test_sparse_tiled_matrix():
     T1 = keynet.sparse.DiagonalTiledMatrix(np.random.rand(3,3).astype(np.float32), shape=(10,10))
     W1 = T1.tocoo().todense()
     assert np.allclose(W1.dot(x1).flatten(), T1.torchdot(x1).flatten(), atol=1E-5)
-    
+
+    W2 = sparse_toeplitz_conv2d( (2,U,V), np.random.rand(3,2,3,3), bias=np.random.rand(3)).astype(np.float32)
+    x2 = torch.tensor(np.random.rand(W2.shape[1], 5).astype(np.float32))
+    T2 = keynet.sparse.TiledMatrix(W2, tileshape=(7,5))  # ragged
+    assert np.allclose(W2.dot(x2.numpy()), T2.torchdot(x2).numpy(), atol=1E-4)
+    y2 = T2.torchdot(x2)
+    assert np.allclose(W2.transpose().dot(y2.numpy()), T2.transpose().torchdot(y2).numpy(), rtol=1E-4, atol=1E-2)
+
     T_right = keynet.sparse.Conv2dTiledMatrix(W_right, inshape=(1,U,V), outshape=(1,U,V), tileshape=(U*4, U*4), bias=True)    
     assert np.allclose(T_right.tocoo().todense().flatten(), W_right.todense().flatten(), atol=1E-5)
 
@@ -195,6 +208,14 @@ def test_sparse_tiled_matrix():
     W_right_dense = W_right.todense()        
     T_right = keynet.sparse.Conv2dTiledMatrix(W_right, inshape=(2,U,V), outshape=(4,U//2,V//2), tileshape=(2, 4), bias=True)
     assert np.allclose(T_right.tocoo().todense(), W_right_dense, atol=1E-5)    
+    x_torch = torch.tensor(np.random.rand(2*U*V+1, 3).astype(np.float32))
+    assert np.allclose(T_right.torchdot(x_torch).numpy(), W_right.dot(x_torch.numpy()), atol=1E-4)
+
+    (U,V) = (16,16)
+    W_right = sparse_toeplitz_conv2d( (3,U,V), np.random.rand(5,3,3,3), bias=np.random.rand(5), stride=1)
+    x_torch = keynet.torch.affine_to_linear(torch.rand(4,3,U,V)).t()
+    T_right = keynet.sparse.Conv2dTiledMatrix(W_right, inshape=(3,U,V), outshape=(5,U,V), tileshape=(8, 8), bias=True)
+    assert np.allclose(T_right.torchdot(x_torch).numpy(), W_right.dot(x_torch.numpy()), atol=1E-4)
 
     print('[test_block_tiled]:  PASSED')
     
@@ -246,6 +267,22 @@ def test_sparse_toeplitz_conv2d():
     y_torch = F.conv2d(torch.tensor(img), torch.tensor(f), bias=torch.tensor(b), padding=((P-1)//2, (Q-1)//2), stride=stride)
     assert(np.allclose(y_torch, yh, atol=1E-5))
     print('[test_sparse_toeplitz_conv2d]:  Correlation (torch vs. toeplitz): passed')
+
+    # Grouped and depthwise convolution
+    for (C, M, groups) in [(4,6,2), (4,4,4)]:
+        img = np.random.rand(N,C,U,V).astype(np.float32)
+        f = np.random.randn(M,C//groups,P,Q).astype(np.float32)
+        b = np.random.randn(M).astype(np.float32)
+        T = sparse_toeplitz_conv2d( (C,U,V), f, b, as_correlation=True, stride=stride, groups=groups)
+        f_full = np.zeros( (M,C,P,Q), dtype=np.float32)
+        for m in range(0,M):
+            f_full[m, (m//(M//groups))*(C//groups):(m//(M//groups)+1)*(C//groups)] = f[m]
+        T_full = sparse_toeplitz_conv2d( (C,U,V), f_full, b, as_correlation=True, stride=stride)
+        assert np.allclose(T.todense(), T_full.todense()) and (T_full.nnz - T.shape[0]) == groups*(T.nnz - T.shape[0])  # only the group support is stored
+        yh = T.dot(np.hstack((img.reshape(N,C*U*V), np.ones( (N,1) ))).transpose()).transpose()[:,:-1].reshape(N,M,U//stride,V//stride)
+        y_torch = F.conv2d(torch.tensor(img), torch.tensor(f), bias=torch.tensor(b), padding=((P-1)//2, (Q-1)//2), stride=stride, groups=groups)
+        assert(np.allclose(y_torch, yh, atol=1E-5))
+    print('[test_sparse_toeplitz_conv2d]:  Grouped correlation (torch vs. toeplitz): passed')
     
 
 def test_sparse_toeplitz_avgpool2d():
@@ -272,6 +309,207 @@ def test_sparse_toeplitz_avgpool2d():
     print('[test_sparse_toeplitz_avgpool2d]: Average pool 2D (torch vs. toeplitz)  PASSED')
 
 
+def test_sparse_dot_dense():
+    np.random.seed(0)
+    A = scipy.sparse.random(1000, 500, density=0.02, format='coo', dtype=np.float32)
+    threads = keynet.globals.num_threads()
+    for k in [1,3]:
+        x = torch.rand(k, 500)
+        y_scipy = A.tocsr().dot(x.numpy().transpose())
+        try:
+            keynet.globals.num_threads(1)
+            numba_threads = numba.get_num_threads()
+            y = keynet.sparse.SparseMatrix(A).torchdot(x.t()).t()
+            assert y.shape == (k, 1000) and np.allclose(y.numpy(), y_scipy.transpose())
+            assert numba.get_num_threads() == numba_threads  # restored
+            keynet.globals.num_threads(numba.config.NUMBA_NUM_THREADS)
+            assert np.allclose(keynet.sparse.sparse_dot_dense(A, x.numpy().transpose(), rowblock=7), y_scipy)
+        finally:
+            keynet.globals.GLOBAL['THREADS'] = threads
+    print('[test_sparse_dot_dense]:  PASSED')
+
+
+def test_sparse_precision():
+    np.random.seed(0)
+    x = np.random.randn(1000).astype(np.float32)
+    for (precision, eps) in [('float16', 1E-3), ('bfloat16', 1E-2)]:
+        assert np.allclose(keynet.sparse.precision_decode(keynet.sparse.precision_encode(x, precision), precision), x, rtol=eps, atol=1E-6)
+    assert keynet.sparse.precision_decode(keynet.sparse.precision_encode(np.array([1.00390625], dtype=np.float32), 'bfloat16'), 'bfloat16')[0] == 1.0  # round to nearest even
+
+    A = scipy.sparse.random(1000, 500, density=0.02, format='coo', dtype=np.float32)
+    x = torch.rand(500, 3)
+    for precision in ['float16', 'bfloat16']:
+        S = keynet.sparse.SparseMatrix(A).reduce_precision(precision)
+        assert S._matrix.data.dtype == np.uint16 and S._matrix.data.nbytes == A.data.nbytes // 2
+        assert np.allclose(S.torchdot(x).numpy(), A.dot(x.numpy()), rtol=1E-2, atol=1E-2)
+        assert np.allclose(keynet.sparse.sparse_matrix_from_arrays(S.to_arrays()).torchdot(x).numpy(), S.torchdot(x).numpy())
+
+        W = sparse_toeplitz_conv2d( (2,8,8), np.random.rand(4,2,3,3), bias=np.random.rand(4).astype(np.float32)).astype(np.float32)
+        x_tiled = torch.rand(W.shape[1], 3)
+        for T in [keynet.sparse.TiledMatrix(W, tileshape=(4,4)), keynet.sparse.Conv2dTiledMatrix(W, inshape=(2,8,8), outshape=(4,8,8), tileshape=(4,4), bias=True)]:
+            y = T.torchdot(x_tiled).numpy()
+            T = T.reduce_precision(precision)
+            assert np.allclose(T.torchdot(x_tiled).numpy(), y, rtol=1E-2, atol=1E-2) and np.allclose(T.tocoo().todense(), W.todense(), rtol=1E-2, atol=1E-2)
+            assert np.allclose(keynet.sparse.sparse_matrix_from_arrays(T.to_arrays()).torchdot(x_tiled).numpy(), T.torchdot(x_tiled).numpy())
+
+        # Dense reduced precision is upcast in row panels, not copied to float32
+        D = np.random.randn(2048, 1024).astype(np.float32)
+        (D_reduced, x_dense) = (keynet.sparse.precision_encode(D, precision), np.random.rand(1024, 4).astype(np.float32))
+        tracemalloc.start()
+        y = keynet.sparse.sparse_dot_dense(D_reduced, x_dense, precision=precision)
+        (size, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert peak < 0.25*D.nbytes and np.allclose(y, keynet.sparse.precision_decode(D_reduced, precision).dot(x_dense), rtol=1E-4, atol=1E-4)
+    print('[test_sparse_precision]:  PASSED')
+
+
+def test_sparse_format():
+    np.random.seed(0)
+    B = scipy.sparse.block_diag([np.random.rand(8,8).astype(np.float32) for k in range(0,16)]).tocsr()
+    B = scipy.sparse.bmat([[B, np.random.rand(128,1)], [None, np.ones( (1,1) )]]).astype(np.float32)  # affine augmented, padded to blocksize
+    D = scipy.sparse.diags([np.random.rand(100-abs(k)) for k in (-1,0,1)], [-1,0,1]).astype(np.float32)
+    F = scipy.sparse.csr_matrix(np.random.rand(10,20).astype(np.float32))
+    for (A, format) in [(B, 'bsr'), (D, 'dia'), (F, 'dense'), (scipy.sparse.random(200, 100, density=0.01, format='csr', dtype=np.float32), 'csr')]:
+        assert keynet.sparse.sparse_best_format(A)[0] == format
+        x = torch.rand(A.shape[1], 3)
+        S = keynet.sparse.SparseMatrix(A).asformat('auto')
+        assert S.format() == format and S.shape == A.shape
+        assert np.allclose(S.torchdot(x).numpy(), A.dot(x.numpy()), atol=1E-5) and np.allclose(S.tocoo().todense(), A.todense())
+        assert np.allclose(keynet.sparse.sparse_matrix_from_arrays(S.to_arrays()).torchdot(x).numpy(), A.dot(x.numpy()), atol=1E-5)
+        assert np.allclose(S.reduce_precision('float16').torchdot(x).numpy(), A.dot(x.numpy()), rtol=1E-2, atol=1E-2) and S.format() == (format if format not in ['bsr', 'dia'] else 'csr')
+        assert S.shape == A.shape and np.allclose(S.tocoo().todense(), A.todense(), rtol=1E-2, atol=1E-2) and (format not in ['bsr', 'dia'] or S.nnz() == A.nnz)
+    
+    (G, Ginv) = (scipy.sparse.block_diag([np.random.rand(4,4) for k in range(0,16)]).astype(np.float32), scipy.sparse.eye(64, dtype=np.float32))
+    K = keynet.sparse.AffineKey(64, [keynet.sparse.SparseKey(G, Ginv)])
+    x = np.random.rand(65, 2).astype(np.float32)
+    y = K.dot(x)
+    assert K.asformat('auto').factors()[0]._M.format == 'bsr' and np.allclose(K.dot(x), y)
+    print('[test_sparse_format]:  PASSED')
+
+
+def test_sparse_affine():
+    np.random.seed(0)
+    (W, b) = (scipy.sparse.random(60, 40, density=0.1, format='csr', dtype=np.float32), np.random.rand(60,1).astype(np.float32))
+    A = scipy.sparse.bmat([[W, b], [None, np.ones( (1,1) )]]).astype(np.float32).tocsr()  # homogeneous
+    x = torch.rand(41, 3)
+    x[-1] = 1
+    for format in ['csr', 'dia', 'bsr', 'dense']:
+        S = keynet.sparse.SparseMatrix(A).affine().asformat(format)
+        assert S.shape == A.shape and S._matrix.shape[0] == 60 and np.allclose(S.bias, b.flatten()) and (S.nnz() == A.nnz or format in ['dia', 'bsr'])  # stored nonzeros
+        assert np.allclose(S.torchdot(x).numpy(), A.dot(x.numpy()), atol=1E-5) and np.allclose(S.tocoo().todense(), A.todense())
+        assert np.allclose(keynet.sparse.sparse_matrix_from_arrays(S.to_arrays()).torchdot(x).numpy(), A.dot(x.numpy()), atol=1E-5)
+        assert np.allclose(S.reduce_precision('bfloat16').torchdot(x).numpy(), A.dot(x.numpy()), rtol=1E-2, atol=1E-2) and S.format() == (format if format not in ['bsr', 'dia'] else 'csr')
+        assert np.allclose(keynet.sparse.sparse_matrix_from_arrays(S.to_arrays()).torchdot(x).numpy(), S.torchdot(x).numpy())
+        assert np.allclose(S.tocsr().torchdot(x).numpy(), A.dot(x.numpy()), rtol=1E-2, atol=1E-2) and S.bias is None and S._matrix.shape == A.shape
+
+    for B in [A.copy(), A.toarray()]:
+        S = keynet.sparse.SparseMatrix(B).affine(copy=False)  # in place
+        assert np.shares_memory(S._matrix.data if S.format() == 'csr' else S._matrix, B.data if scipy.sparse.issparse(B) else B) and S.nnz() == A.nnz and np.allclose(S.bias, b.flatten())
+        assert S.format() == 'csr' or S._matrix.flags['C_CONTIGUOUS']
+        assert np.allclose(S.torchdot(x).numpy(), A.dot(x.numpy()), atol=1E-5) and np.allclose(S.tocoo().todense(), A.todense())
+
+    y = keynet.sparse.sparse_dot_dense(A[:-1,:-1], x.numpy(), relu=True, bias=b.flatten())
+    assert y.shape == (61, 3) and np.allclose(y, np.maximum(A.dot(x.numpy()), 0), atol=1E-5)
+    try:
+        keynet.sparse.SparseMatrix(A.transpose()).affine()
+        raise ValueError('Invalid homogeneous row')
+    except AssertionError:
+        pass
+    print('[test_sparse_affine]:  PASSED')
+
+
+def test_sparse_spgemm():
+    np.random.seed(0)
+    A = scipy.sparse.random(200, 150, density=0.05, format='csr', dtype=np.float32)
+    B = scipy.sparse.random(150, 100, density=0.05, format='csr', dtype=np.float32)
+    B.data[::2] *= -1
+    for (X, Y) in [(A, B), (A[0:1], B), (scipy.sparse.csr_matrix(np.array([[1,1],[1,2]], dtype=np.float32)), scipy.sparse.csr_matrix(np.array([[1,1],[-1,0]], dtype=np.float32)))]:  # cancellation
+        C_scipy = X.dot(Y)
+        try:
+            keynet.globals.spgemm('numba')
+            C = keynet.sparse.sparse_spgemm(X, Y)
+        finally:
+            keynet.globals.spgemm('scipy')
+        assert C.dtype == C_scipy.dtype and C.nnz == C_scipy.nnz
+        assert np.array_equal(C.indptr, C_scipy.indptr) and np.array_equal(C.indices, C_scipy.indices) and np.array_equal(C.data, C_scipy.data)  # bit-identical
+    print('[test_sparse_spgemm]:  PASSED')
+
+
+def test_sparse_key_compose():
+    np.random.seed(0)
+    inshape = (3,8,8)
+    W = sparse_toeplitz_conv2d(inshape, np.random.rand(4,3,3,3).astype(np.float32), bias=np.random.rand(4).astype(np.float32))
+    for (k, kw) in enumerate([dict(global_geometric='permutation', global_photometric='uniform_random_affine'),
+                              dict(local_geometric='permutation', local_photometric='uniform_random_affine', blocksize=4),
+                              dict(local_geometric='givens_orthogonal', alpha=4, blocksize=4),   # fallback 
+                              dict(global_photometric='uniform_random_bias')]):
+        keys = dict(global_geometric='identity', local_geometric='identity', global_photometric='identity', local_photometric='identity', beta=1.0, gamma=1.0)
+        keys.update(kw)
+        (A, Ainv) = keynet.system.keygen(inshape, **keys)
+        (B, Binv) = keynet.system.keygen((4,8,8), **keys)
+
+        # Keyed layer
+        WK_scipy = B.tocsr().dot(W).dot(Ainv.tocsr())
+        WK = keynet.sparse.sparse_key_compose(B, W, Ainv)
+        assert WK.shape == WK_scipy.shape
+        assert np.allclose(WK.toarray(), WK_scipy.toarray(), atol=1E-5)
+        WK = keynet.sparse.sparse_key_compose(B.tocsr(), W, Ainv.tocsr())
+        assert np.allclose(WK.toarray(), WK_scipy.toarray(), atol=1E-5)
+
+        # Row panels 
+        for panels in [1, 5, 1000]:
+            assert np.allclose(keynet.sparse.sparse_key_compose_rowpanels(B, W, Ainv, panels).toarray(), WK_scipy.toarray(), atol=1E-5)
+        assert np.allclose(keynet.sparse.sparse_key_compose_rowpanels(None, W, Ainv, 3).toarray(), W.dot(Ainv.tocsr()).toarray(), atol=1E-5)
+
+        # Dense layer
+        Wd = np.random.rand(W.shape[0], W.shape[1]).astype(np.float32)
+        for (Bk, Ainvk) in [(B, Ainv), (B.tocsr(), Ainv.tocsr()), (None, Ainv)]:
+            WKd = keynet.sparse.dense_key_compose(Bk, Wd, Ainvk)
+            assert isinstance(WKd, np.ndarray) and WKd.dtype == np.float32 and WKd.flags['C_CONTIGUOUS']
+            assert np.allclose(WKd, (Bk.tocsr().dot(Wd) if Bk is not None else Wd).dot(Ainv.tocsr().toarray()), rtol=1E-4, atol=1E-4)
+
+        # Keys compose to identity
+        I = keynet.sparse.sparse_key_dot(A.tocsr(), Ainv.tocsr())
+        assert np.allclose(I.toarray(), np.eye(A.shape[0]), atol=1E-5)
+        assert keynet.sparse.sparse_key_compose(None, W, None) is W
+    print('[test_sparse_key_compose]:  PASSED')
+
+
+def test_affine_key():
+    np.random.seed(0)
+    inshape = (3,8,8)
+    for kw in [dict(global_geometric='permutation', global_photometric='uniform_random_affine', local_photometric='uniform_random_affine', blocksize=4),
+               dict(local_geometric='givens_orthogonal', alpha=4, blocksize=4, memoryorder='block'),
+               dict(global_geometric='givens_orthogonal', alpha=4, local_geometric='doubly_stochastic', blocksize=4)]:
+        keys = dict(global_geometric='identity', local_geometric='identity', global_photometric='identity', local_photometric='identity', beta=1.0, gamma=1.0)
+        keys.update(kw)
+        (A, Ainv) = keynet.system.keygen(inshape, **keys)
+        assert isinstance(A, keynet.sparse.AffineKey) and A.shape == (np.prod(inshape)+1, np.prod(inshape)+1)
+        (Ad, Ainvd) = (A.tocsr().toarray(), Ainv.tocsr().toarray())
+        assert np.allclose(Ad.dot(Ainvd), np.eye(A.shape[0]), atol=1E-5)
+        
+        x = np.vstack( (np.random.rand(np.prod(inshape), 2), np.ones( (1,2) )) )
+        assert np.allclose(A.dot(x), Ad.dot(x), atol=1E-5)
+        assert np.allclose(A.rdot(x.T), x.T.dot(Ad), atol=1E-5)
+        assert np.allclose(Ainv.dot(A.dot(x)), x, atol=1E-5)
+        assert np.allclose(A.dot(Ainv).tocsr().toarray(), np.eye(A.shape[0]), atol=1E-5)
+        assert np.allclose(A.inverse().tocsr().toarray(), Ainvd, atol=1E-5)
+
+        # Key serialization to plain arrays
+        d = keynet.sparse.key_to_arrays(A)
+        assert all([isinstance(v, np.ndarray) and not v.dtype.hasobject for v in d.values()])
+        assert np.allclose(keynet.sparse.key_from_arrays(d).dot(x), A.dot(x), atol=1E-5)
+        assert np.allclose(keynet.sparse.key_from_arrays(keynet.sparse.key_to_arrays(Ainv)).tocsr().toarray(), Ainvd, atol=1E-5)
+
+    # Identity factors are skipped, monomial factors are merged
+    (A, Ainv) = keynet.system.keygen(inshape, 'identity', 'identity', 'identity', 'identity')
+    assert A.is_identity() and np.allclose(A.tocsr().toarray(), np.eye(A.shape[0]))
+    (A, Ainv) = keynet.system.keygen(inshape, 'permutation', 'permutation', 'uniform_random_affine', 'uniform_random_affine', beta=1.0, gamma=1.0, blocksize=4)
+    assert len(A.factors()) == 1 and isinstance(A.factors()[0], keynet.sparse.MonomialKey)
+    assert keynet.sparse.key_from_arrays(keynet.sparse.key_to_arrays(None)) is None
+    print('[test_affine_key]:  PASSED')
+
+    
 def _test_roundoff(m=512, n=1000):
     """Experiment with accumulated float32 rounding errors for deeper networks"""
     x = np.random.randn(m,1).astype(np.float32)
@@ -379,6 +617,13 @@ if __name__ == '__main__':
     test_torch_homogenize()
     test_sparse_toeplitz_conv2d()
     test_sparse_toeplitz_avgpool2d()
+    test_sparse_dot_dense()
+    test_sparse_precision()
+    test_sparse_format()
+    test_sparse_affine()
+    test_sparse_spgemm()
+    test_sparse_key_compose()
+    test_affine_key()
     test_blockview()
     test_sparse_matrix()
     test_sparse_tiled_matrix()        